@@ -0,0 +1,221 @@
+# backend/benchmarks/bench_quota_check.py
+
+"""
+Micro-benchmark: quota check as one combined query vs the old sequential path.
+
+The old path was three or four pool acquisitions per check: latest
+subscription, COUNT over today's messages, SUM over this month's
+api_usage_logs, then the is_premium fallback when there is no active plan.
+The new path is db.queries.get_user_quota_snapshot (one round trip, reading
+the usage rollups).
+
+Seeds a scratch schema (bench_quota) in the database from DATABASE_URL,
+copying table definitions from the migrated public schema, and drops it
+afterwards unless --keep is given.
+
+Usage (from backend/):
+    python -m benchmarks.bench_quota_check --users 500 --checks 2000
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import time
+
+import asyncpg
+
+import db.database as database
+from core.config import settings
+from db.queries import active_plan, get_user_quota_snapshot
+
+SCHEMA = "bench_quota"
+TABLES = (
+    "auth_users", "subscriptions", "conversations", "messages",
+    "api_usage_logs", "user_messages_daily", "user_monthly_costs",
+)
+
+
+async def seed(conn, users: int, messages_per_user: int) -> None:
+    await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+    await conn.execute(f"CREATE SCHEMA {SCHEMA}")
+    for table in TABLES:
+        await conn.execute(f"CREATE TABLE {SCHEMA}.{table} (LIKE public.{table} INCLUDING ALL)")
+
+    await conn.execute(f"SET search_path TO {SCHEMA}")
+    await conn.execute(
+        """
+        INSERT INTO auth_users (email, is_premium)
+        SELECT 'bench' || g || '@example.com', g % 7 = 0
+        FROM generate_series(1, $1) g
+        """,
+        users
+    )
+    # Two thirds of users have a subscription, some of them expired
+    await conn.execute(
+        """
+        INSERT INTO subscriptions (user_id, plan, status, expired_at, created_at)
+        SELECT id,
+               (ARRAY['pro', 'elite', 'premium'])[1 + (random() * 2)::INT],
+               CASE WHEN random() < 0.8 THEN 'active' ELSE 'cancelled' END,
+               NOW() + (random() * 60 - 15) * INTERVAL '1 day',
+               NOW() - random() * 90 * INTERVAL '1 day'
+        FROM auth_users
+        WHERE random() < 0.66
+        """
+    )
+    await conn.execute(
+        """
+        INSERT INTO conversations (user_id, title)
+        SELECT u.id, 'Conversation ' || g
+        FROM auth_users u, generate_series(1, 5) g
+        """
+    )
+    # Messages spread over the last 60 days, a third of them 'user'
+    await conn.execute(
+        """
+        INSERT INTO messages (conversation_id, role, message_text, created_at)
+        SELECT c.id,
+               CASE WHEN g % 3 = 0 THEN 'user' ELSE 'assistant' END,
+               'message ' || g,
+               NOW() - random() * 60 * INTERVAL '1 day'
+        FROM conversations c, generate_series(1, $1) g
+        """,
+        max(1, messages_per_user // 5)
+    )
+    await conn.execute(
+        """
+        INSERT INTO api_usage_logs (user_id, conversation_id, input_tokens, output_tokens, estimated_cost, created_at)
+        SELECT c.user_id, c.id, 200, 400, random() / 100,
+               NOW() - random() * 60 * INTERVAL '1 day'
+        FROM conversations c, generate_series(1, $1) g
+        """,
+        max(1, messages_per_user // 15)
+    )
+    # Rollups as add_message / log_api_usage maintain them
+    await conn.execute(
+        """
+        INSERT INTO user_messages_daily (user_id, date, message_count)
+        SELECT c.user_id, m.created_at::DATE, COUNT(*)
+        FROM messages m JOIN conversations c ON c.id = m.conversation_id
+        WHERE m.role = 'user'
+        GROUP BY c.user_id, m.created_at::DATE
+        """
+    )
+    await conn.execute(
+        """
+        INSERT INTO user_monthly_costs (user_id, year, month, total_cost, input_tokens, output_tokens)
+        SELECT user_id,
+               EXTRACT(YEAR FROM created_at)::INT, EXTRACT(MONTH FROM created_at)::INT,
+               SUM(estimated_cost), SUM(input_tokens), SUM(output_tokens)
+        FROM api_usage_logs
+        GROUP BY 1, 2, 3
+        """
+    )
+    await conn.execute("ANALYZE")
+
+
+async def legacy_quota_check(pool, user_id):
+    """The pre-rollup sequence of queries, one pool acquisition each"""
+    async with pool.acquire() as conn:
+        sub = await conn.fetchrow(
+            """
+            SELECT plan, status, expired_at FROM subscriptions
+            WHERE user_id = $1 ORDER BY created_at DESC LIMIT 1
+            """,
+            user_id
+        )
+    plan = active_plan(sub["plan"], sub["status"], sub["expired_at"]) if sub else None
+    is_premium = None
+    if plan is None:
+        async with pool.acquire() as conn:
+            is_premium = await conn.fetchval("SELECT is_premium FROM auth_users WHERE id = $1", user_id)
+    async with pool.acquire() as conn:
+        messages = await conn.fetchval(
+            """
+            SELECT COUNT(*) FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE c.user_id = $1 AND m.role = 'user' AND m.created_at >= CURRENT_DATE
+            """,
+            user_id
+        )
+    async with pool.acquire() as conn:
+        cost = await conn.fetchval(
+            """
+            SELECT COALESCE(SUM(estimated_cost), 0) FROM api_usage_logs
+            WHERE user_id = $1 AND created_at >= DATE_TRUNC('month', CURRENT_DATE)
+            """,
+            user_id
+        )
+    return plan, is_premium, messages, cost
+
+
+async def snapshot_quota_check(pool, user_id):
+    return await get_user_quota_snapshot(user_id)
+
+
+async def run(name, check, pool, user_ids, checks, concurrency):
+    latencies = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(user_id):
+        async with sem:
+            start = time.perf_counter()
+            await check(pool, user_id)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    # Warm the pool and plan caches
+    await asyncio.gather(*(one(u) for u in user_ids[:concurrency]))
+    latencies.clear()
+
+    picks = [random.choice(user_ids) for _ in range(checks)]
+    wall = time.perf_counter()
+    await asyncio.gather(*(one(u) for u in picks))
+    wall = time.perf_counter() - wall
+
+    latencies.sort()
+    p = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+    print(
+        f"{name:<10} p50={statistics.median(latencies):7.2f}ms  p95={p(0.95):7.2f}ms  "
+        f"p99={p(0.99):7.2f}ms  throughput={checks / wall:8.0f} checks/s"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--messages-per-user", type=int, default=300)
+    parser.add_argument("--checks", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help=f"keep the {SCHEMA} schema")
+    args = parser.parse_args()
+
+    conn = await asyncpg.connect(settings.DATABASE_URL)
+    try:
+        print(f"Seeding {args.users} users into schema '{SCHEMA}'...")
+        await seed(conn, args.users, args.messages_per_user)
+        user_ids = [r["id"] for r in await conn.fetch("SELECT id FROM auth_users")]
+
+        # Same pool settings as db.database, pointed at the scratch schema
+        pool = await asyncpg.create_pool(
+            dsn=settings.DATABASE_URL,
+            statement_cache_size=0,
+            min_size=10,
+            max_size=20,
+            server_settings={"search_path": SCHEMA},
+        )
+        database.pool = pool
+        try:
+            await run("legacy", legacy_quota_check, pool, user_ids, args.checks, args.concurrency)
+            await run("snapshot", snapshot_quota_check, pool, user_ids, args.checks, args.concurrency)
+        finally:
+            database.pool = None
+            await pool.close()
+    finally:
+        if not args.keep:
+            await conn.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE")
+        await conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
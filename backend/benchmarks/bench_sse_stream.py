@@ -0,0 +1,144 @@
+# backend/benchmarks/bench_sse_stream.py
+
+"""
+Benchmark: SSE frame encoding for chat streams.
+
+Streams synthetic token-sized chunks through the old per-chunk path
+(json.dumps per chunk, one frame each, `full_response += chunk`) and through
+StreamWriter (coalesced frames, sse_event, reply joined once), and reports
+frames, frames/sec and CPU time per 1k tokens. Every frame is written to a
+local socket and drained, as the server does with each response body
+message, so the per-frame send cost is included.
+
+Two runs: unpaced (one stream, chunks as fast as the loop can take them)
+and paced (many concurrent streams, each receiving --rate tokens/sec, like
+a busy worker). No database or API key needed.
+
+Usage (from backend/):
+    python -m benchmarks.bench_sse_stream --tokens 4000 --streams 200 --rate 80
+"""
+
+import argparse
+import asyncio
+import json
+import socket
+import time
+
+from utils.sse import StreamWriter, orjson, sse_event
+
+WORDS = "the model streams its answer back a few characters at a time while the client renders".split()
+
+
+async def upstream(tokens: int, rate: float):
+    """Token-sized chunks; with rate, arriving in small bursts at about rate/sec"""
+    burst = 4
+    delay = burst / rate if rate else 0
+    for i in range(tokens):
+        yield " " + WORDS[i % len(WORDS)]
+        if delay and i % burst == burst - 1:
+            await asyncio.sleep(delay)
+
+
+class Sink:
+    """One end of a socket pair; the other end is read and discarded"""
+
+    async def open(self):
+        a, b = socket.socketpair()
+        _, self.writer = await asyncio.open_connection(sock=a)
+        reader, self._peer = await asyncio.open_connection(sock=b)
+        self.bytes = 0
+        self._reading = asyncio.create_task(self._read(reader))
+        return self
+
+    async def _read(self, reader):
+        while await reader.read(65536):
+            pass
+
+    async def send(self, frame: bytes):
+        self.bytes += len(frame)
+        self.writer.write(frame)
+        await self.writer.drain()
+
+    async def close(self):
+        self.writer.close()
+        await self._reading
+        self._peer.close()
+
+
+async def legacy_stream(tokens: int, rate: float, sink: Sink):
+    full_response = ""
+    frames = 0
+    async for chunk in upstream(tokens, rate):
+        full_response += chunk
+        # StreamingResponse encodes str frames
+        await sink.send(f"data: {json.dumps({'chunk': chunk, 'done': False})}\n\n".encode())
+        frames += 1
+    return frames, len(full_response)
+
+
+async def writer_stream(tokens: int, rate: float, sink: Sink):
+    writer = StreamWriter()
+    async for text in writer.coalesce(upstream(tokens, rate)):
+        await sink.send(sse_event({"chunk": text, "done": False}))
+    return writer.frames, len(writer.text())
+
+
+async def run(kind: str, streams: int, tokens: int, rate: float):
+    fn = legacy_stream if kind == "legacy" else writer_stream
+    sinks = [await Sink().open() for _ in range(streams)]
+    cpu0, wall0 = time.process_time(), time.perf_counter()
+    results = await asyncio.gather(*(fn(tokens, rate, sink) for sink in sinks))
+    cpu, wall = time.process_time() - cpu0, time.perf_counter() - wall0
+    for sink in sinks:
+        await sink.close()
+    frames = sum(r[0] for r in results)
+    total_tokens = streams * tokens
+    return {
+        "frames": frames,
+        "frames_per_stream": frames / streams,
+        "frames_per_sec": frames / wall,
+        "bytes": sum(s.bytes for s in sinks),
+        "cpu_ms_per_1k_tokens": cpu * 1000 / (total_tokens / 1000),
+        "wall_s": wall,
+    }
+
+
+def report(title: str, legacy: dict, coalesced: dict):
+    print(title)
+    print(f"  {'':22} {'legacy':>12} {'StreamWriter':>14}")
+    for key, fmt in (
+        ("frames_per_stream", "{:12.0f}"),
+        ("frames_per_sec", "{:12.0f}"),
+        ("bytes", "{:12.0f}"),
+        ("cpu_ms_per_1k_tokens", "{:12.3f}"),
+        ("wall_s", "{:12.2f}"),
+    ):
+        print(f"  {key:22} {fmt.format(legacy[key])} {fmt.format(coalesced[key]):>14}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=4000, help="tokens per reply")
+    parser.add_argument("--streams", type=int, default=200, help="concurrent streams in the paced run")
+    parser.add_argument("--rate", type=float, default=80, help="tokens/sec per stream in the paced run")
+    args = parser.parse_args()
+
+    print(f"serializer: {'orjson' if orjson is not None else 'json'}")
+    writer = StreamWriter()
+    print(f"flush: {writer.flush_bytes} bytes / {writer.flush_seconds * 1000:.0f} ms\n")
+
+    report(
+        f"Unpaced: 1 stream x {args.tokens} tokens",
+        asyncio.run(run("legacy", 1, args.tokens, 0)),
+        asyncio.run(run("writer", 1, args.tokens, 0)),
+    )
+    paced_tokens = max(1, int(args.rate * 2))  # ~2 s per stream
+    report(
+        f"\nPaced: {args.streams} streams x {paced_tokens} tokens at {args.rate:.0f} tokens/s",
+        asyncio.run(run("legacy", args.streams, paced_tokens, args.rate)),
+        asyncio.run(run("writer", args.streams, paced_tokens, args.rate)),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# backend/benchmarks/bench_vector_memory.py
+
+"""
+Benchmark: long-term memory index build and query time.
+
+Builds one UserVectorIndex over a synthetic corpus (Zipf-distributed words,
+like chat text) with the offline HashingEmbedder, then times single and
+batched top-k queries. No database or API key needed.
+
+Usage (from backend/):
+    python -m benchmarks.bench_vector_memory --messages 1000000
+"""
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+
+from services.vector_memory import HashingEmbedder, UserVectorIndex
+
+
+def synthetic_corpus(count: int, vocabulary: int, words_per_message: int, seed: int):
+    rng = np.random.default_rng(seed)
+    vocab = np.array([f"w{i}" for i in range(vocabulary)])
+    lengths = rng.integers(words_per_message // 2, words_per_message * 2, size=count)
+    words = vocab[np.minimum(rng.zipf(1.2, size=int(lengths.sum())) - 1, vocabulary - 1)]
+    texts, start = [], 0
+    for n in lengths:
+        texts.append(" ".join(words[start:start + n]))
+        start += n
+    return texts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--vocabulary", type=int, default=50_000)
+    parser.add_argument("--words", type=int, default=25, help="average words per message")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--batch", type=int, default=4096, help="messages embedded per call while building")
+    args = parser.parse_args()
+
+    print(f"Generating {args.messages:,} synthetic messages...")
+    texts = synthetic_corpus(args.messages, args.vocabulary, args.words, seed=1)
+    embedder = HashingEmbedder(args.dim)
+    index = UserVectorIndex(args.dim, max_size=args.messages, capacity=args.messages)
+    conversation_ids = np.arange(args.messages) // 50
+
+    start = time.perf_counter()
+    embed_seconds = 0.0
+    for offset in range(0, args.messages, args.batch):
+        chunk = texts[offset:offset + args.batch]
+        t = time.perf_counter()
+        vectors = embedder.embed(chunk)
+        embed_seconds += time.perf_counter() - t
+        index.add(vectors, range(offset, offset + len(chunk)), conversation_ids[offset:offset + len(chunk)])
+    build_seconds = time.perf_counter() - start
+    print(
+        f"build      {build_seconds:8.2f}s total, {embed_seconds:8.2f}s embedding "
+        f"({args.messages / build_seconds:,.0f} msgs/s), index {index.nbytes / 2**20:,.0f} MiB"
+    )
+
+    rng = np.random.default_rng(2)
+    queries = [texts[i] for i in rng.integers(0, args.messages, size=args.queries)]
+
+    latencies = []
+    for query in queries:
+        t = time.perf_counter()
+        index.search(embedder.embed([query])[0], args.k, exclude_conversation_id=0)
+        latencies.append((time.perf_counter() - t) * 1000)
+    latencies.sort()
+    print(
+        f"query      p50={statistics.median(latencies):7.2f}ms  "
+        f"p99={latencies[int(0.99 * (len(latencies) - 1))]:7.2f}ms  (embed + search, k={args.k})"
+    )
+
+    # Batched: one matrix-matrix product for all queries
+    t = time.perf_counter()
+    query_vectors = embedder.embed(queries)
+    scores = index.vectors[:index.size] @ query_vectors.T
+    np.argpartition(-scores, args.k - 1, axis=0)[:args.k]
+    batched_ms = (time.perf_counter() - t) * 1000
+    print(f"batched    {batched_ms:8.2f}ms for {args.queries} queries ({batched_ms / args.queries:.2f}ms each)")
+
+
+if __name__ == "__main__":
+    main()
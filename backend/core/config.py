@@ -20,8 +20,24 @@ class Settings(BaseSettings):
     NEXT_PUBLIC_TREASURY_WALLET: str = ""
     SOLANA_RPC_ENDPOINT: str = "https://api.mainnet-beta.solana.com"
 
+    # Auth caching (per worker)
+    AUTH_CACHE_MAX_ENTRIES: int = 10000
+    AUTH_CACHE_TTL_SECONDS: int = 300
+    AUTH_NEGATIVE_CACHE_MAX_ENTRIES: int = 10000
+    AUTH_NEGATIVE_CACHE_TTL_SECONDS: int = 30
+
+    # Quota counters (per worker)
+    QUOTA_COUNTER_MAX_USERS: int = 100000
+    QUOTA_RESERVATION_TTL_SECONDS: int = 600  # unreleased reservations stop counting after this
+
     # API Keys
     GOOGLE_API_KEY: str
+    GOOGLE_API_KEYS: str = ""  # more keys, comma-separated, pooled with GOOGLE_API_KEY
+    # Per-key quota as configured in Google AI Studio; calls go to the key with most left
+    GEMINI_KEY_RPM_LIMIT: int = 1000
+    GEMINI_KEY_TPM_LIMIT: int = 1000000
+    GEMINI_KEY_COOLDOWN_SECONDS: float = 10.0  # after a 429, doubling per 429 in a row
+    GEMINI_KEY_MAX_COOLDOWN_SECONDS: float = 120.0
     
     # Rate Limiting (more generous with Flash)
     FREE_TIER_DAILY_LIMIT: int = 5
@@ -32,10 +48,100 @@ class Settings(BaseSettings):
     FREE_TIER_MONTHLY_COST_LIMIT: float = 10.0
     PRO_TIER_MONTHLY_COST_LIMIT: float = 50.0
     ELITE_TIER_MONTHLY_COST_LIMIT: float = 200.0
+
+    # Request-rate limits (burst per minute, concurrent streams)
+    FREE_TIER_MESSAGES_PER_MINUTE: int = 3
+    PRO_TIER_MESSAGES_PER_MINUTE: int = 10
+    ELITE_TIER_MESSAGES_PER_MINUTE: int = 20
+    FREE_TIER_MAX_CONCURRENT_STREAMS: int = 1
+    PRO_TIER_MAX_CONCURRENT_STREAMS: int = 2
+    ELITE_TIER_MAX_CONCURRENT_STREAMS: int = 4
+    STREAM_SLOT_LEASE_SECONDS: int = 600  # frees slots a crashed worker never released
+
+    # Upstream admission (per worker): Gemini calls in flight, queue bounds,
+    # and each tier's share of freed capacity while others are queued
+    GENERATION_MAX_CONCURRENT: int = 32
+    GENERATION_MAX_QUEUE: int = 256
+    GENERATION_QUEUE_TIMEOUT_SECONDS: float = 10.0
+    FREE_TIER_GENERATION_WEIGHT: int = 1
+    PRO_TIER_GENERATION_WEIGHT: int = 3
+    ELITE_TIER_GENERATION_WEIGHT: int = 6
+
+    # "memory" (per worker) or "redis" (shared across workers, needs REDIS_URL)
+    RATE_LIMIT_BACKEND: str = "memory"
+    REDIS_URL: str = ""
     
     # Model settings
     GEMINI_MODEL: str = "gemini-2.0-flash"
-    MAX_CONTEXT_MESSAGES: int = 20
+    MAX_CONTEXT_MESSAGES: int = 200  # most messages scanned; the token budget decides
+    FREE_TIER_CONTEXT_TOKEN_BUDGET: int = 4000
+    PRO_TIER_CONTEXT_TOKEN_BUDGET: int = 16000
+    ELITE_TIER_CONTEXT_TOKEN_BUDGET: int = 32000
+    SUMMARY_TRIGGER_TOKENS: int = 3000  # unsummarized history that triggers a summary update
+    SUMMARY_KEEP_RECENT_MESSAGES: int = 6  # newest messages always sent verbatim
+    SUMMARY_MAX_TOKENS: int = 512
+
+    # Chat streams: model chunks are coalesced into one SSE frame per interval / size
+    SSE_FLUSH_INTERVAL_MS: int = 50
+    SSE_FLUSH_BYTES: int = 1024
+    # Resumable streams (Last-Event-ID): how long a turn outlives its last client,
+    # how long a finished turn can still be replayed, and frames kept per turn
+    STREAM_RESUME_GRACE_SECONDS: float = 30.0
+    STREAM_RESUME_TTL_SECONDS: float = 120.0
+    STREAM_RESUME_MAX_FRAMES: int = 4096
+
+    # Usage logging: buffered, written in batches, spilled to disk if the DB is down
+    USAGE_LOG_BATCH_SIZE: int = 500
+    USAGE_LOG_FLUSH_SECONDS: float = 1.0
+    USAGE_LOG_SPILL_PATH: str = "usage_log_spill.jsonl"
+    USAGE_LOG_MAX_BUFFER: int = 100000
+
+    # Recent conversation tails kept in memory (per worker)
+    CONVERSATION_CACHE_ENABLED: bool = True
+    CONVERSATION_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+
+    # Exact-match reply cache for turns with little history (opt-in, per worker)
+    RESPONSE_CACHE_ENABLED: bool = False
+    RESPONSE_CACHE_TTL_SECONDS: int = 3600
+    RESPONSE_CACHE_MAX_ENTRIES: int = 5000
+    RESPONSE_CACHE_MAX_CONTEXT_TOKENS: int = 200  # history before the prompt; more isn't cached
+    RESPONSE_CACHE_MAX_REPLY_CHARS: int = 16000
+
+    # Gemini context caching: system instruction + older history uploaded once (opt-in)
+    CONTEXT_CACHE_ENABLED: bool = False
+    CONTEXT_CACHE_MIN_TOKENS: int = 4096  # smallest prefix worth caching; the API has a minimum too
+    CONTEXT_CACHE_TTL_SECONDS: int = 600
+    CONTEXT_CACHE_MAX_ENTRIES: int = 1000
+
+    # Long-term memory: retrieval over past messages (per worker index)
+    VECTOR_MEMORY_ENABLED: bool = True
+    VECTOR_MEMORY_DIM: int = 256
+    VECTOR_MEMORY_TOP_K: int = 4
+    VECTOR_MEMORY_MIN_SCORE: float = 0.25
+    VECTOR_MEMORY_MAX_TOKENS: int = 800  # cap on retrieved snippets per turn
+    VECTOR_MEMORY_MAX_BYTES: int = 256 * 1024 * 1024  # all users' indexes together
+    VECTOR_MEMORY_MAX_USERS: int = 1000
+    VECTOR_MEMORY_MAX_MESSAGES_PER_USER: int = 50000
+    VECTOR_MEMORY_REFRESH_SECONDS: int = 3600  # rebuild to pick up other workers' messages
+
+    # Gemini SDK calls: blocking ones run on a thread pool of this size
+    GEMINI_MAX_WORKERS: int = 16
+    # Prebuilt model objects kept (least recently used dropped past this)
+    GEMINI_MODEL_REGISTRY_MAX_ENTRIES: int = 64
+
+    # Gemini resilience: retries per model, circuit breaker, optional p95 hedging
+    GEMINI_RETRY_ATTEMPTS: int = 2
+    GEMINI_RETRY_BASE_DELAY_SECONDS: float = 0.25
+    GEMINI_RETRY_MAX_DELAY_SECONDS: float = 4.0
+    GEMINI_BREAKER_FAILURES: int = 5
+    GEMINI_BREAKER_COOLDOWN_SECONDS: float = 30.0
+    GEMINI_HEDGE_ENABLED: bool = False
+    GEMINI_HEDGE_MIN_DELAY_MS: int = 250
+    GEMINI_HEDGE_MIN_SAMPLES: int = 20  # latencies seen before p95 is trusted
+
+    # Conversation titles: first messages batched into one Gemini request
+    TITLE_BATCH_MAX_SIZE: int = 16  # first messages per batched title request
+    TITLE_BATCH_WINDOW_MS: int = 50  # how long a batch waits to fill up
     
     # CORS
     ALLOWED_ORIGINS: list = ["http://localhost:3000"]
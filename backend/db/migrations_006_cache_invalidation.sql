@@ -0,0 +1,61 @@
+-- Migration: Cache Invalidation Notifications
+-- Workers cache user rows and tiers in-process and LISTEN on the
+-- 'cache_invalidation' channel (services/invalidation_service.py).
+-- These triggers NOTIFY on writes that don't go through the backend,
+-- e.g. admin deactivation or plan edits from the Next.js API routes.
+-- Run this SQL file against your PostgreSQL database
+
+-- ============================================================================
+-- 1. NOTIFY FUNCTION
+-- ============================================================================
+CREATE OR REPLACE FUNCTION notify_user_cache_invalidation()
+RETURNS TRIGGER AS $$
+DECLARE
+  v_user_id TEXT;
+BEGIN
+  IF TG_TABLE_NAME = 'auth_users' THEN
+    v_user_id := COALESCE(NEW.id, OLD.id)::TEXT;
+  ELSE
+    v_user_id := COALESCE(NEW.user_id, OLD.user_id)::TEXT;
+  END IF;
+
+  PERFORM pg_notify(
+    'cache_invalidation',
+    json_build_object('e', 'user', 'k', v_user_id, 'o', 'db')::TEXT
+  );
+
+  -- Email logins are negatively cached by address (inactive users don't
+  -- match either): signups, reactivations and address changes clear it too
+  IF TG_TABLE_NAME = 'auth_users' THEN
+    IF TG_OP <> 'INSERT' AND OLD.email IS NOT NULL THEN
+      PERFORM pg_notify(
+        'cache_invalidation',
+        json_build_object('e', 'user_email', 'k', OLD.email, 'o', 'db')::TEXT
+      );
+    END IF;
+    IF TG_OP <> 'DELETE' AND NEW.email IS NOT NULL
+       AND (TG_OP = 'INSERT' OR NEW.email IS DISTINCT FROM OLD.email) THEN
+      PERFORM pg_notify(
+        'cache_invalidation',
+        json_build_object('e', 'user_email', 'k', NEW.email, 'o', 'db')::TEXT
+      );
+    END IF;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ============================================================================
+-- 2. TRIGGERS
+-- ============================================================================
+DROP TRIGGER IF EXISTS trigger_auth_users_cache_invalidation ON auth_users;
+CREATE TRIGGER trigger_auth_users_cache_invalidation
+    AFTER INSERT OR UPDATE OF active, is_premium, email OR DELETE ON auth_users
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_user_cache_invalidation();
+
+DROP TRIGGER IF EXISTS trigger_subscriptions_cache_invalidation ON subscriptions;
+CREATE TRIGGER trigger_subscriptions_cache_invalidation
+    AFTER INSERT OR UPDATE OR DELETE ON subscriptions
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_user_cache_invalidation();
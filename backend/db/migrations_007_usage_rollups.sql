@@ -0,0 +1,43 @@
+-- Migration: Usage Rollups
+-- user_messages_daily and user_monthly_costs become the source of truth for
+-- usage figures. db/queries.py keeps them current with UPSERTs in the same
+-- statement as the message insert / usage log insert.
+-- Run this SQL file against your PostgreSQL database (after 005)
+
+-- ============================================================================
+-- 1. user_monthly_costs: full cost precision + token totals
+-- ============================================================================
+-- Per-request costs are fractions of a cent; DECIMAL(10, 2) rounded them away
+ALTER TABLE user_monthly_costs ALTER COLUMN total_cost TYPE DECIMAL(14, 6);
+ALTER TABLE user_monthly_costs ALTER COLUMN cost_limit DROP NOT NULL;
+ALTER TABLE user_monthly_costs ADD COLUMN IF NOT EXISTS input_tokens BIGINT NOT NULL DEFAULT 0;
+ALTER TABLE user_monthly_costs ADD COLUMN IF NOT EXISTS output_tokens BIGINT NOT NULL DEFAULT 0;
+
+-- ============================================================================
+-- 2. BACKFILL FROM RAW TABLES
+-- ============================================================================
+INSERT INTO user_messages_daily (user_id, date, message_count)
+SELECT c.user_id, DATE(m.created_at), COUNT(*)
+FROM messages m
+JOIN conversations c ON c.id = m.conversation_id
+WHERE m.role = 'user'
+GROUP BY c.user_id, DATE(m.created_at)
+ON CONFLICT (user_id, date) DO UPDATE SET
+    message_count = EXCLUDED.message_count,
+    updated_at = NOW();
+
+INSERT INTO user_monthly_costs (user_id, year, month, total_cost, input_tokens, output_tokens)
+SELECT
+    user_id,
+    EXTRACT(YEAR FROM created_at)::INT,
+    EXTRACT(MONTH FROM created_at)::INT,
+    COALESCE(SUM(estimated_cost), 0),
+    COALESCE(SUM(input_tokens), 0),
+    COALESCE(SUM(output_tokens), 0)
+FROM api_usage_logs
+GROUP BY user_id, EXTRACT(YEAR FROM created_at), EXTRACT(MONTH FROM created_at)
+ON CONFLICT (user_id, year, month) DO UPDATE SET
+    total_cost = EXCLUDED.total_cost,
+    input_tokens = EXCLUDED.input_tokens,
+    output_tokens = EXCLUDED.output_tokens,
+    updated_at = NOW();
@@ -0,0 +1,26 @@
+-- Migration: Message Token Counts
+-- Each message stores its estimated token count (utils/tokens.py) at insert
+-- time, so memory_service can pack context against a token budget without
+-- re-tokenizing history.
+-- Run this SQL file against your PostgreSQL database (after 007)
+
+-- ============================================================================
+-- 1. messages.token_count
+-- ============================================================================
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS token_count INTEGER;
+
+-- ============================================================================
+-- 2. BACKFILL
+-- ============================================================================
+-- Rough (~4 characters per token) for existing rows; new rows get the local
+-- estimator's count. Readers fall back to the same formula for NULLs.
+UPDATE messages
+SET token_count = CEIL(LENGTH(message_text) / 4.0)::INT
+WHERE token_count IS NULL;
+
+-- ============================================================================
+-- 3. INDEXES
+-- ============================================================================
+-- Newest-first scan of one conversation when packing context
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_created
+    ON messages(conversation_id, created_at DESC);
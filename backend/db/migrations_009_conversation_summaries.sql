@@ -0,0 +1,17 @@
+-- Migration: Conversation Summaries
+-- Rolling summary per conversation. Messages up to summarized_through_id are
+-- folded into the summary; context is the summary plus the messages after it.
+-- Updated in the background after each assistant reply (memory_service).
+-- Run this SQL file against your PostgreSQL database (after 008)
+
+-- ============================================================================
+-- 1. conversation_summaries
+-- ============================================================================
+CREATE TABLE IF NOT EXISTS conversation_summaries (
+    conversation_id INTEGER PRIMARY KEY REFERENCES conversations(id) ON DELETE CASCADE,
+    summary TEXT NOT NULL,
+    token_count INTEGER NOT NULL DEFAULT 0,
+    summarized_through_id INTEGER NOT NULL,  -- last messages.id folded in
+    created_at TIMESTAMP DEFAULT NOW(),
+    updated_at TIMESTAMP DEFAULT NOW()
+);
@@ -0,0 +1,9 @@
+-- Migration: Truncated Messages
+-- Assistant replies cut short because the client disconnected mid-stream are
+-- stored with what was generated so far and truncated = TRUE.
+-- Run this SQL file against your PostgreSQL database (after 009)
+
+-- ============================================================================
+-- 1. messages.truncated
+-- ============================================================================
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS truncated BOOLEAN NOT NULL DEFAULT FALSE;
@@ -1,8 +1,9 @@
 # backend/app/db/queries.py
 
 from db.database import get_db_pool
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from datetime import datetime, timedelta, timezone
+from utils.tokens import estimate_tokens
 
 def normalize_datetime_for_comparison(dt: Optional[datetime]) -> Optional[datetime]:
     """
@@ -86,28 +87,62 @@ async def create_conversation(user_id: str, title: Optional[str] = None) -> int:
         return row["id"]
 
 
-async def add_message(conversation_id: int, role: str, text: str):
-    """Add message to conversation"""
+async def add_message(
+    conversation_id: int,
+    role: str,
+    text: str,
+    token_count: Optional[int] = None,
+    notify: Optional[Tuple[str, List[str]]] = None,
+    truncated: bool = False
+) -> Optional[Dict[str, Any]]:
+    """
+    Add message to conversation.
+    One statement inserts the message (with its token count, estimated here
+    unless given), touches the conversation's updated_at and (for user
+    messages) bumps the owner's user_messages_daily rollup. notify is an
+    optional (channel, payloads) sent with pg_notify in the same statement.
+    truncated marks a reply cut short by a client disconnect.
+    Returns {id, user_id} of the new message.
+    """
+    if token_count is None:
+        token_count = estimate_tokens(text)
     pool = await get_db_pool()
     
     async with pool.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO messages (conversation_id, role, message_text, created_at)
-            VALUES ($1, $2, $3, NOW())
-            """,
-            conversation_id, role, text
-        )
-        
-        # Update conversation's updated_at
-        await conn.execute(
+        row = await conn.fetchrow(
             """
-            UPDATE conversations 
-            SET updated_at = NOW() 
-            WHERE id = $1
+            WITH inserted AS (
+                INSERT INTO messages (conversation_id, role, message_text, token_count, truncated, created_at)
+                VALUES ($1, $2, $3, $4, $7, NOW())
+                RETURNING id
+            ), touched AS (
+                UPDATE conversations 
+                SET updated_at = NOW() 
+                WHERE id = $1
+                RETURNING user_id
+            ), counted AS (
+                INSERT INTO user_messages_daily (user_id, date, message_count)
+                SELECT user_id, CURRENT_DATE, 1
+                FROM touched
+                WHERE $2 = 'user'
+                ON CONFLICT (user_id, date) DO UPDATE SET
+                    message_count = user_messages_daily.message_count + 1,
+                    updated_at = NOW()
+            ), notified AS (
+                SELECT pg_notify($5, payload)
+                FROM inserted, unnest($6::TEXT[]) payload
+                WHERE $5::TEXT IS NOT NULL
+            )
+            SELECT inserted.id, touched.user_id, (SELECT COUNT(*) FROM notified) AS notified
+            FROM inserted
+            LEFT JOIN touched ON TRUE
             """,
-            conversation_id
+            conversation_id, role, text, token_count,
+            notify[0] if notify else None,
+            notify[1] if notify else [],
+            truncated
         )
+        return dict(row) if row else None
 
 
 async def get_conversation_messages(conversation_id: int, user_id: str):
@@ -126,7 +161,7 @@ async def get_conversation_messages(conversation_id: int, user_id: str):
         
         rows = await conn.fetch(
             """
-            SELECT id, role, message_text, created_at
+            SELECT id, role, message_text, truncated, created_at
             FROM messages
             WHERE conversation_id = $1
             ORDER BY created_at ASC
@@ -178,59 +213,247 @@ async def delete_conversation(conversation_id: int, user_id: str) -> bool:
         return "1" in result
 
 
-async def update_conversation_title(conversation_id: int, user_id: str, new_title: str):
-    """Update conversation title (with user verification)"""
+async def update_conversation_title(
+    conversation_id: int,
+    user_id: str,
+    new_title: str,
+    expected_title: Optional[str] = None
+) -> bool:
+    """
+    Update conversation title (with user verification).
+    With expected_title, only replace that title (so a generated title never
+    overwrites one the user has set in the meantime).
+    Returns True if a row was updated.
+    """
     pool = await get_db_pool()
     
     async with pool.acquire() as conn:
-        await conn.execute(
+        result = await conn.execute(
             """
             UPDATE conversations
             SET title = $1, updated_at = NOW()
             WHERE id = $2 AND user_id = $3
+            AND ($4::TEXT IS NULL OR title = $4)
+            """,
+            new_title, conversation_id, user_id, expected_title
+        )
+        return result != "UPDATE 0"
+
+
+### LONG-TERM MEMORY (vector index)
+
+async def get_user_messages_for_index(user_id: str, limit: int) -> list:
+    """A user's newest messages across conversations, newest first"""
+    pool = await get_db_pool()
+    
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT m.id, m.conversation_id, m.message_text
+            FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE c.user_id = $1
+            ORDER BY m.id DESC
+            LIMIT $2
+            """,
+            user_id, limit
+        )
+        return [dict(r) for r in rows]
+
+
+async def get_user_messages_by_ids(user_id: str, message_ids: list) -> list:
+    """Messages by id, restricted to the user's own conversations"""
+    pool = await get_db_pool()
+    
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT m.id, m.conversation_id, m.role, m.message_text
+            FROM messages m
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE m.id = ANY($2::INT[]) AND c.user_id = $1
+            """,
+            user_id, message_ids
+        )
+        return [dict(r) for r in rows]
+
+
+### CONVERSATION SUMMARIES
+
+async def get_unsummarized_messages(conversation_id: int, keep_recent: int) -> Optional[Dict[str, Any]]:
+    """
+    Summary state for a conversation: owner, current summary and the
+    messages not yet folded into it, minus the newest keep_recent (those stay
+    verbatim in the context). None if the conversation doesn't exist.
+    """
+    pool = await get_db_pool()
+    
+    async with pool.acquire() as conn:
+        state = await conn.fetchrow(
+            """
+            SELECT c.user_id, s.summary, COALESCE(s.summarized_through_id, 0) AS summarized_through_id
+            FROM conversations c
+            LEFT JOIN conversation_summaries s ON s.conversation_id = c.id
+            WHERE c.id = $1
+            """,
+            conversation_id
+        )
+        if not state:
+            return None
+        rows = await conn.fetch(
+            """
+            SELECT id, role, message_text,
+                   COALESCE(token_count, CEIL(LENGTH(message_text) / 4.0)::INT) AS token_count
+            FROM (
+                SELECT id, role, message_text, token_count,
+                       ROW_NUMBER() OVER (ORDER BY id DESC) AS newest_rank
+                FROM messages
+                WHERE conversation_id = $1 AND id > $2
+            ) pending
+            WHERE newest_rank > $3
+            ORDER BY id
             """,
-            new_title, conversation_id, user_id
+            conversation_id, state["summarized_through_id"], keep_recent
+        )
+    return {**dict(state), "messages": [dict(r) for r in rows]}
+
+
+async def upsert_conversation_summary(
+    conversation_id: int,
+    summary: str,
+    token_count: int,
+    summarized_through_id: int
+) -> None:
+    """Store a conversation's rolling summary (never moves backwards)"""
+    pool = await get_db_pool()
+    
+    async with pool.acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO conversation_summaries
+                (conversation_id, summary, token_count, summarized_through_id)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (conversation_id) DO UPDATE SET
+                summary = EXCLUDED.summary,
+                token_count = EXCLUDED.token_count,
+                summarized_through_id = EXCLUDED.summarized_through_id,
+                updated_at = NOW()
+            WHERE conversation_summaries.summarized_through_id < EXCLUDED.summarized_through_id
+            """,
+            conversation_id, summary, token_count, summarized_through_id
         )
 
 
 ### USAGE TRACKING (for rate limiting premium vs free users)
 
 async def get_user_message_count_today(user_id: str) -> int:
-    """Count messages sent by user today"""
+    """Count messages sent by user today (user_messages_daily rollup)"""
     pool = await get_db_pool()
     
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
             """
-            SELECT COUNT(*) as count
-            FROM messages m
-            JOIN conversations c ON c.id = m.conversation_id
-            WHERE c.user_id = $1 
-            AND m.role = 'user'
-            AND m.created_at >= CURRENT_DATE
+            SELECT message_count
+            FROM user_messages_daily
+            WHERE user_id = $1 
+            AND date = CURRENT_DATE
             """,
             user_id
         )
-        return row["count"] if row else 0
+        return row["message_count"] if row else 0
 
 
 async def log_api_usage(user_id: str, conversation_id: int, 
                         input_tokens: int, output_tokens: int, cost: float):
-    """Track API usage and costs"""
+    """Track API usage and costs (also updates the user_monthly_costs rollup)"""
     pool = await get_db_pool()
     
     async with pool.acquire() as conn:
         await conn.execute(
             """
-            INSERT INTO api_usage_logs 
-            (user_id, conversation_id, input_tokens, output_tokens, 
-             estimated_cost, created_at)
-            VALUES ($1, $2, $3, $4, $5, NOW())
+            WITH logged AS (
+                INSERT INTO api_usage_logs 
+                (user_id, conversation_id, input_tokens, output_tokens, 
+                 estimated_cost, created_at)
+                VALUES ($1, $2, $3, $4, $5, NOW())
+                RETURNING user_id, input_tokens, output_tokens, estimated_cost
+            )
+            INSERT INTO user_monthly_costs
+            (user_id, year, month, total_cost, input_tokens, output_tokens)
+            SELECT user_id,
+                   EXTRACT(YEAR FROM CURRENT_DATE)::INT,
+                   EXTRACT(MONTH FROM CURRENT_DATE)::INT,
+                   estimated_cost, input_tokens, output_tokens
+            FROM logged
+            ON CONFLICT (user_id, year, month) DO UPDATE SET
+                total_cost = user_monthly_costs.total_cost + EXCLUDED.total_cost,
+                input_tokens = user_monthly_costs.input_tokens + EXCLUDED.input_tokens,
+                output_tokens = user_monthly_costs.output_tokens + EXCLUDED.output_tokens,
+                updated_at = NOW()
             """,
             user_id, conversation_id, input_tokens, output_tokens, cost
         )
 
 
+async def write_api_usage_batch(
+    records: List[Tuple[str, Optional[int], int, int, float, datetime]],
+    notify: Optional[Tuple[str, List[str]]] = None
+) -> int:
+    """
+    Bulk version of log_api_usage: one statement inserts the
+    (user_id, conversation_id, input_tokens, output_tokens, cost, created_at)
+    records, adds them to the user_monthly_costs rollup of the month they
+    happened in and sends notify's (channel, payloads) with pg_notify.
+    Usage of since-deleted conversations is kept without the conversation;
+    usage of deleted users is dropped. Returns the number of rows written.
+    """
+    if not records:
+        return 0
+    user_ids, conversation_ids, inputs, outputs, costs, created = (list(c) for c in zip(*records))
+    channel, payloads = notify or (None, [])
+    pool = await get_db_pool()
+
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            WITH batch AS (
+                SELECT *
+                FROM unnest($1::UUID[], $2::INT[], $3::INT[], $4::INT[], $5::NUMERIC[], $6::TIMESTAMP[])
+                    AS b(user_id, conversation_id, input_tokens, output_tokens, estimated_cost, created_at)
+            ), logged AS (
+                INSERT INTO api_usage_logs
+                (user_id, conversation_id, input_tokens, output_tokens,
+                 estimated_cost, created_at)
+                SELECT b.user_id, c.id, b.input_tokens, b.output_tokens, b.estimated_cost, b.created_at
+                FROM batch b
+                JOIN auth_users u ON u.id = b.user_id
+                LEFT JOIN conversations c ON c.id = b.conversation_id
+                RETURNING user_id, input_tokens, output_tokens, estimated_cost, created_at
+            ), rolled AS (
+                INSERT INTO user_monthly_costs
+                (user_id, year, month, total_cost, input_tokens, output_tokens)
+                SELECT user_id,
+                       EXTRACT(YEAR FROM created_at)::INT,
+                       EXTRACT(MONTH FROM created_at)::INT,
+                       SUM(estimated_cost), SUM(input_tokens), SUM(output_tokens)
+                FROM logged
+                GROUP BY 1, 2, 3
+                ON CONFLICT (user_id, year, month) DO UPDATE SET
+                    total_cost = user_monthly_costs.total_cost + EXCLUDED.total_cost,
+                    input_tokens = user_monthly_costs.input_tokens + EXCLUDED.input_tokens,
+                    output_tokens = user_monthly_costs.output_tokens + EXCLUDED.output_tokens,
+                    updated_at = NOW()
+            ), notified AS (
+                SELECT pg_notify($7, payload) FROM unnest($8::TEXT[]) payload WHERE $7::TEXT IS NOT NULL
+            )
+            SELECT (SELECT COUNT(*) FROM logged) AS written,
+                   (SELECT COUNT(*) FROM notified) AS notified
+            """,
+            user_ids, conversation_ids, inputs, outputs, costs, created, channel, payloads
+        )
+        return row["written"]
+
+
 async def get_user_subscription_tier(user_id: str) -> Optional[str]:
     """Get user's subscription tier from subscriptions table (only active, non-expired subscriptions)"""
     import logging
@@ -280,31 +503,94 @@ async def get_user_subscription_tier(user_id: str) -> Optional[str]:
         return None
 
 
+def active_plan(plan: Optional[str], status: Optional[str], expired_at: Optional[datetime]) -> Optional[str]:
+    """Return plan if the subscription is active and not expired, else None"""
+    if status != "active":
+        return None
+    if expired_at is None:
+        return plan
+    # Normalize both datetimes to timezone-aware UTC for safe comparison
+    return plan if normalize_datetime_for_comparison(expired_at) > datetime.now(timezone.utc) else None
+
+
+async def get_user_quota_snapshot(user_id: str) -> Dict[str, Any]:
+    """
+    Everything a quota check needs in one round trip: latest subscription
+    (plan/status/expiry), the is_premium flag, today's message count and
+    this month's cost (from the usage rollups).
+    'active_plan' is the plan if the subscription is active and not expired.
+    """
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            WITH sub AS (
+                SELECT plan, status, expired_at
+                FROM subscriptions
+                WHERE user_id = $1
+                ORDER BY created_at DESC
+                LIMIT 1
+            )
+            SELECT
+                (SELECT plan FROM sub) AS plan,
+                (SELECT status FROM sub) AS status,
+                (SELECT expired_at FROM sub) AS expired_at,
+                (SELECT is_premium FROM auth_users WHERE id = $1) AS is_premium,
+                COALESCE((
+                    SELECT message_count
+                    FROM user_messages_daily
+                    WHERE user_id = $1 AND date = CURRENT_DATE
+                ), 0) AS messages_today,
+                COALESCE((
+                    SELECT total_cost
+                    FROM user_monthly_costs
+                    WHERE user_id = $1
+                    AND year = EXTRACT(YEAR FROM CURRENT_DATE)::INT
+                    AND month = EXTRACT(MONTH FROM CURRENT_DATE)::INT
+                ), 0) AS monthly_cost
+            """,
+            user_id
+        )
+    snapshot = dict(row)
+    snapshot["is_premium"] = bool(snapshot["is_premium"])
+    snapshot["messages_today"] = int(snapshot["messages_today"])
+    snapshot["monthly_cost"] = float(snapshot["monthly_cost"])
+    snapshot["active_plan"] = active_plan(snapshot["plan"], snapshot["status"], snapshot["expired_at"])
+    return snapshot
+
+
 async def increment_user_message_count_today(user_id: str):
-    """Increment today's message count in user_messages_daily"""
+    """
+    Increment today's message count in user_messages_daily.
+    add_message already does this for user messages; only use it for
+    messages stored some other way.
+    """
     pool = await get_db_pool()
     async with pool.acquire() as conn:
         await conn.execute(
             """
-            UPDATE user_messages_daily 
-            SET count = count + 1 
-            WHERE user_id = $1 AND date = CURRENT_DATE
+            INSERT INTO user_messages_daily (user_id, date, message_count)
+            VALUES ($1, CURRENT_DATE, 1)
+            ON CONFLICT (user_id, date) DO UPDATE SET
+                message_count = user_messages_daily.message_count + 1,
+                updated_at = NOW()
             """,
             user_id
         )
 
 
 async def get_user_monthly_cost(user_id: str) -> float:
-    """Get user's total API cost this month"""
+    """Get user's total API cost this month (user_monthly_costs rollup)"""
     pool = await get_db_pool()
     
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
             """
-            SELECT COALESCE(SUM(estimated_cost), 0) as total_cost
-            FROM api_usage_logs
+            SELECT total_cost
+            FROM user_monthly_costs
             WHERE user_id = $1 
-            AND created_at >= DATE_TRUNC('month', CURRENT_DATE)
+            AND year = EXTRACT(YEAR FROM CURRENT_DATE)::INT
+            AND month = EXTRACT(MONTH FROM CURRENT_DATE)::INT
             """,
             user_id
         )
@@ -633,41 +919,27 @@ async def get_usage_statistics(user_id: str) -> Dict[str, Any]:
             user_id
         )
         
-        # Count messages used today
-        messages_today = await conn.fetchval(
-            """
-            SELECT COUNT(*)
-            FROM messages m
-            JOIN conversations c ON c.id = m.conversation_id
-            WHERE c.user_id = $1 
-            AND m.role = 'user'
-            AND DATE(m.created_at) = CURRENT_DATE
-            """,
-            user_id
-        )
-        
-        # Count messages used this month
+        # Count messages used this month (daily rollup rows)
         messages_month = await conn.fetchval(
             """
-            SELECT COUNT(*)
-            FROM messages m
-            JOIN conversations c ON c.id = m.conversation_id
-            WHERE c.user_id = $1 
-            AND m.role = 'user'
-            AND m.created_at >= DATE_TRUNC('month', CURRENT_DATE)
+            SELECT COALESCE(SUM(message_count), 0)
+            FROM user_messages_daily
+            WHERE user_id = $1 
+            AND date >= DATE_TRUNC('month', CURRENT_DATE)
             """,
             user_id
         )
         
-        # Get token usage this month
+        # Get token usage this month (monthly rollup row)
         token_usage = await conn.fetchrow(
             """
             SELECT 
                 COALESCE(SUM(input_tokens), 0) as input_tokens,
                 COALESCE(SUM(output_tokens), 0) as output_tokens
-            FROM api_usage_logs
+            FROM user_monthly_costs
             WHERE user_id = $1
-            AND created_at >= DATE_TRUNC('month', CURRENT_DATE)
+            AND year = EXTRACT(YEAR FROM CURRENT_DATE)::INT
+            AND month = EXTRACT(MONTH FROM CURRENT_DATE)::INT
             """,
             user_id
         )
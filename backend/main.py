@@ -1,5 +1,6 @@
 # backend/app/main.py
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
@@ -9,15 +10,37 @@ from fastapi.exceptions import RequestValidationError
 
 from routes.chat import router as chat_router
 from routes.dashboard import router as dashboard_router
+from routes.health import router as health_router
 from routes.help import router as help_router
 from routes.rate_limit import router as rate_limit_router
 from routes.upgrade import router as upgrade_router
+from middleware.rate_limit import rate_limiter
+from services.gemini_service import warm_up_models
+from services.invalidation_service import invalidation_listener
+from services.usage_log_writer import usage_log_writer
+from utils.background import drain
 
 load_dotenv()
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup
+    await warm_up_models()
+    invalidation_listener.start()
+    usage_log_writer.start()  # also replays usage spilled by a previous run
+    yield
+    # Shutdown
+    await invalidation_listener.stop()
+    await rate_limiter.backend.close()
+    await drain()  # let background work (titles, invalidations) finish
+    await usage_log_writer.stop()  # after drain: summaries log usage too
+
+
 app = FastAPI(
     title="AI Chatbot Backend",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS
@@ -33,6 +56,7 @@ app.add_middleware(
 app.include_router(chat_router, prefix="/chat", tags=["Chat"])
 app.include_router(dashboard_router, prefix="/dashboard", tags=["Dashboard"])
 app.include_router(help_router, prefix="", tags=["Help"])
+app.include_router(health_router, prefix="", tags=["Health"])
 app.include_router(rate_limit_router, prefix="/rate-limit", tags=["Rate Limit"])
 app.include_router(upgrade_router, prefix="/upgrade", tags=["Upgrade"])
 app.add_exception_handler(RequestValidationError, validation_exception_handler)
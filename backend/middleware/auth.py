@@ -1,16 +1,77 @@
 # backend/app/middleware/auth.py - Email-based Auth (Compatible with existing code)
 
-from fastapi import HTTPException, Header, Depends
-from typing import Optional
+from fastapi import HTTPException, Header, Depends, Request
+from typing import Any, Dict, Optional
+import hashlib
+import time
 import jwt
 import re
 from core.config import settings
 from db.queries import get_user_by_id, get_user_by_email
+from services.invalidation_service import register_invalidation_handler
+from services.user_context_service import UserContext, resolve_user_context
+from utils.cache import TTLCache
 
-async def verify_supabase_token(authorization: Optional[str] = Header(None)) -> str:
+# Verified token -> active user row. Entries never outlive the token's exp.
+_token_cache = TTLCache(settings.AUTH_CACHE_MAX_ENTRIES, settings.AUTH_CACHE_TTL_SECONDS)
+# ("email", email) / ("sub", user_id) that matched no active user
+_negative_cache = TTLCache(settings.AUTH_NEGATIVE_CACHE_MAX_ENTRIES, settings.AUTH_NEGATIVE_CACHE_TTL_SECONDS)
+
+
+def _token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def invalidate_user_cache(user_id: str, email: Optional[str] = None) -> int:
+    """
+    Drop this worker's cached auth entries for a user. Writers should use
+    publish_invalidation("user", user_id) so every worker does this.
+    Returns the number of entries removed.
+    """
+    user_id = str(user_id)
+    removed = _token_cache.discard_where(lambda k, user: str(user.get("id")) == user_id)
+    removed += 1 if _negative_cache.pop(("sub", user_id)) else 0
+    if email:
+        removed += 1 if _negative_cache.pop(("email", email)) else 0
+    return removed
+
+
+def _on_user_invalidated(user_id: Optional[str]) -> None:
+    if user_id is None:
+        _token_cache.clear()
+        _negative_cache.clear()
+    else:
+        invalidate_user_cache(user_id)
+
+
+def _on_user_email_invalidated(email: Optional[str]) -> None:
+    if email is None:
+        _negative_cache.clear()
+    else:
+        _negative_cache.pop(("email", email))
+
+
+# Signups/upgrades/cancellations/deactivations in any worker (or the DB triggers)
+register_invalidation_handler("user", _on_user_invalidated)
+# A user was created (or changed address): an earlier "not found" for it is wrong now
+register_invalidation_handler("user_email", _on_user_email_invalidated)
+
+
+def auth_cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters for sizing the auth caches"""
+    return {
+        "tokens": _token_cache.stats(),
+        "negative": _negative_cache.stats(),
+    }
+
+
+async def verify_supabase_token(request: Request, authorization: Optional[str] = Header(None)) -> str:
     """
     Verify Supabase JWT token OR accept email directly and return user_id
     Token format: Bearer <jwt_token> OR Bearer <email>
+    The verified user row is kept on request.state.user for later dependencies.
+    Verified tokens are cached (capped at the JWT's exp) so repeat calls skip
+    the decode and the auth_users lookup.
     """
     if not authorization:
         raise HTTPException(
@@ -25,21 +86,32 @@ async def verify_supabase_token(authorization: Optional[str] = Header(None)) ->
         if not token:
             raise HTTPException(status_code=401, detail="Empty token")
         
+        cache_key = _token_key(token)
+        cached = _token_cache.get(cache_key)
+        if cached is not None:
+            request.state.user = cached
+            return cached["id"]
+        
         # Check if it's an email (contains @ and . with valid email pattern)
         email_pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
         
         if re.match(email_pattern, token):
             # Treat as email
+            if _negative_cache.get(("email", token)):
+                raise HTTPException(status_code=401, detail="User not found")
             print(f"🔍 Auth attempt with email: {token}")
             user = await get_user_by_email(token)
             if not user:
                 print(f"❌ User not found for email: {token}")
+                _negative_cache.set(("email", token), True)
                 raise HTTPException(status_code=401, detail="User not found")
             
             if not user.get("active"):
                 raise HTTPException(status_code=403, detail="Account inactive")
             
             print(f"✅ Auth verified for email: {token}, user_id: {user['id']}")
+            _token_cache.set(cache_key, user)
+            request.state.user = user
             return user["id"]  # Return user_id from database
         
         # Otherwise, try to decode as JWT
@@ -56,15 +128,23 @@ async def verify_supabase_token(authorization: Optional[str] = Header(None)) ->
         if not user_id:
             raise HTTPException(status_code=401, detail="Invalid token payload")
         
+        if _negative_cache.get(("sub", user_id)):
+            raise HTTPException(status_code=401, detail="User not found")
+        
         # Verify user exists and is active
         user = await get_user_by_id(user_id)
         if not user:
+            _negative_cache.set(("sub", user_id), True)
             raise HTTPException(status_code=401, detail="User not found")
         
         if not user.get("active"):
             raise HTTPException(status_code=403, detail="Account inactive")
         
         print(f"✅ Auth verified for JWT user_id: {user_id}")
+        exp = payload.get("exp")
+        user = {**user, "id": user_id}
+        _token_cache.set(cache_key, user, ttl=(exp - time.time()) if exp else None)
+        request.state.user = user
         return user_id
         
     except jwt.ExpiredSignatureError:
@@ -81,6 +161,21 @@ async def verify_supabase_token(authorization: Optional[str] = Header(None)) ->
         raise HTTPException(status_code=401, detail="Unauthorized")
 
 
+async def get_user_context(
+    request: Request,
+    user_id: str = Depends(verify_supabase_token)
+) -> UserContext:
+    """
+    Resolve the caller's UserContext (user row, tier, model) once per request.
+    Auth, the rate limiter and the chat routes all depend on this.
+    """
+    ctx = getattr(request.state, "user_context", None)
+    if ctx is None or ctx.user_id != user_id:
+        ctx = await resolve_user_context(user_id, getattr(request.state, "user", None))
+        request.state.user_context = ctx
+    return ctx
+
+
 async def verify_premium_user(user_id: str = Depends(verify_supabase_token)) -> str:
     """Verify user has premium access"""
     from db.queries import verify_user_is_premium
@@ -95,9 +190,9 @@ async def verify_premium_user(user_id: str = Depends(verify_supabase_token)) ->
     return user_id
 
 
-async def get_current_user(user_id: str = Depends(verify_supabase_token)):
+async def get_current_user(request: Request, user_id: str = Depends(verify_supabase_token)):
     """Get full user info from database"""
-    user = await get_user_by_id(user_id)
+    user = getattr(request.state, "user", None) or await get_user_by_id(user_id)
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     return user
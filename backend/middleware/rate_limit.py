@@ -7,14 +7,13 @@ from fastapi import HTTPException, Depends, status
 from datetime import datetime, timedelta
 from typing import Dict, Optional
 import logging
+import math
+import uuid
 
-from middleware.auth import verify_supabase_token
-from db.queries import (
-    verify_user_is_premium,
-    get_user_message_count_today,
-    get_user_monthly_cost,
-    get_user_subscription_tier
-)
+from middleware.auth import get_user_context
+from services.rate_limit_backend import get_rate_limit_backend
+from services.usage_counters import QuotaReservation, usage_counters, next_daily_reset, next_monthly_reset
+from services.user_context_service import UserContext, TIER_ALIASES, resolve_user_context
 from core.config import settings
 
 logger = logging.getLogger(__name__)
@@ -63,6 +62,9 @@ class RateLimiter:
     - free: 5 messages/day, $10/month cost limit
     - pro: 10 messages/day, $50/month cost limit
     - elite: 20 messages/day, $200/month cost limit
+
+    Plus request-rate limits per tier (messages per minute, concurrent
+    streams) kept in a shared backend (see services/rate_limit_backend.py)
     """
 
     def __init__(self):
@@ -71,16 +73,22 @@ class RateLimiter:
             "free": {
                 "daily_message_limit": settings.FREE_TIER_DAILY_LIMIT,
                 "monthly_cost_limit": settings.FREE_TIER_MONTHLY_COST_LIMIT,
+                "messages_per_minute": settings.FREE_TIER_MESSAGES_PER_MINUTE,
+                "max_concurrent_streams": settings.FREE_TIER_MAX_CONCURRENT_STREAMS,
                 "tier_name": "free"
             },
             "pro": {
                 "daily_message_limit": settings.PRO_TIER_DAILY_LIMIT,
                 "monthly_cost_limit": settings.PRO_TIER_MONTHLY_COST_LIMIT,
+                "messages_per_minute": settings.PRO_TIER_MESSAGES_PER_MINUTE,
+                "max_concurrent_streams": settings.PRO_TIER_MAX_CONCURRENT_STREAMS,
                 "tier_name": "pro"
             },
             "elite": {
                 "daily_message_limit": settings.ELITE_TIER_DAILY_LIMIT,
                 "monthly_cost_limit": settings.ELITE_TIER_MONTHLY_COST_LIMIT,
+                "messages_per_minute": settings.ELITE_TIER_MESSAGES_PER_MINUTE,
+                "max_concurrent_streams": settings.ELITE_TIER_MAX_CONCURRENT_STREAMS,
                 "tier_name": "elite"
             },
             # "premuim": {  # Handle typo variant
@@ -91,69 +99,130 @@ class RateLimiter:
             "tier1": {  # Legacy plan naming
                 "daily_message_limit": settings.PRO_TIER_DAILY_LIMIT,
                 "monthly_cost_limit": settings.PRO_TIER_MONTHLY_COST_LIMIT,
+                "messages_per_minute": settings.PRO_TIER_MESSAGES_PER_MINUTE,
+                "max_concurrent_streams": settings.PRO_TIER_MAX_CONCURRENT_STREAMS,
                 "tier_name": "pro"
             },
             "tier2": {  # Legacy plan naming
                 "daily_message_limit": settings.ELITE_TIER_DAILY_LIMIT,
                 "monthly_cost_limit": settings.ELITE_TIER_MONTHLY_COST_LIMIT,
+                "messages_per_minute": settings.ELITE_TIER_MESSAGES_PER_MINUTE,
+                "max_concurrent_streams": settings.ELITE_TIER_MAX_CONCURRENT_STREAMS,
                 "tier_name": "elite"
             }
         }
-        self.tier_aliases = {
-            "premium": "elite",  # Map premium to elite tier
-            "premuim": "elite",  # Handle typo variant
-            "tier1": "pro",
-            "tier_1": "pro",
-            "tier2": "elite",
-            "tier_2": "elite"
-        }
+        self.tier_aliases = TIER_ALIASES
+        self.backend = get_rate_limit_backend()
 
-    async def get_tier_for_user(self, user_id: str) -> str:
-        """Get subscription tier for user"""
+    def _config_for(self, ctx: UserContext) -> Dict:
+        return self.tier_config.get(ctx.tier) or self.tier_config["free"]
+
+    async def check_request_rate(
+        self,
+        ctx: UserContext = Depends(get_user_context)
+    ) -> None:
+        """
+        Token bucket per user: at most messages_per_minute, refilled
+        continuously. Use as a dependency on endpoints that send a message.
+
+        Raises:
+            HTTPException (429): If the user is sending too fast
+        """
+        config = self._config_for(ctx)
+        per_minute = config["messages_per_minute"]
         try:
-            # Try to get from subscription table first
-            tier = await get_user_subscription_tier(user_id)
-            logger.info(f"get_tier_for_user: Raw tier from DB for {user_id}: {tier}")
-            if tier:
-                tier_lower = tier.lower()
-                tier_lower = self.tier_aliases.get(tier_lower, tier_lower)
-                logger.info(f"get_tier_for_user: Normalized tier for {user_id}: {tier_lower} (from {tier})")
-                return tier_lower
-            
-            # Fallback to premium check
-            is_premium = await verify_user_is_premium(user_id)
-            logger.info(f"get_tier_for_user: No subscription found for {user_id}, is_premium: {is_premium}")
-            return "elite" if is_premium else "free"
+            allowed, retry_after = await self.backend.take_token(
+                f"msg:{ctx.user_id}", per_minute, per_minute / 60.0
+            )
+        except Exception as e:
+            # Fail open: daily/monthly limits still apply
+            logger.error(f"Rate limit backend error for user {ctx.user_id}: {e}")
+            return
+
+        if not allowed:
+            retry_after = max(1, math.ceil(retry_after))
+            logger.warning(f"Message rate limit exceeded for user {ctx.user_id}")
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail={
+                    "error": "Too many messages, slow down",
+                    "limit_per_minute": per_minute,
+                    "tier": config["tier_name"],
+                    "retry_after": retry_after
+                },
+                headers={"Retry-After": str(retry_after)}
+            )
+
+    async def acquire_stream_slot(self, ctx: UserContext) -> Optional[str]:
+        """
+        Claim one of the tier's concurrent stream slots. Returns the slot id
+        to pass to release_stream_slot when the stream ends (None if the
+        backend is unavailable and the stream was let through).
+
+        Raises:
+            HTTPException (429): If the user already has max_concurrent_streams open
+        """
+        config = self._config_for(ctx)
+        limit = config["max_concurrent_streams"]
+        slot_id = uuid.uuid4().hex
+        try:
+            acquired = await self.backend.acquire_slot(
+                f"streams:{ctx.user_id}", limit, slot_id, settings.STREAM_SLOT_LEASE_SECONDS
+            )
         except Exception as e:
-            logger.warning(f"Error getting user tier for {user_id}: {e}", exc_info=True)
-            return "free"
+            logger.error(f"Rate limit backend error for user {ctx.user_id}: {e}")
+            return None
+
+        if not acquired:
+            logger.warning(f"Concurrent stream limit exceeded for user {ctx.user_id}")
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail={
+                    "error": "Too many concurrent streams",
+                    "limit": limit,
+                    "tier": config["tier_name"]
+                },
+                headers={"Retry-After": "1"}
+            )
+        return slot_id
+
+    async def release_stream_slot(self, user_id: str, slot_id: Optional[str]) -> None:
+        if slot_id is None:
+            return
+        try:
+            await self.backend.release_slot(f"streams:{user_id}", slot_id)
+        except Exception as e:
+            # The lease expires on its own
+            logger.error(f"Could not release stream slot for user {user_id}: {e}")
+
+    async def get_tier_for_user(self, user_id: str) -> str:
+        """
+        Get subscription tier for user.
+        Request handlers should use the UserContext from get_user_context
+        instead; this resolves a fresh one for callers outside a request.
+        """
+        ctx = await resolve_user_context(user_id)
+        logger.info(f"get_tier_for_user: Normalized tier for {user_id}: {ctx.tier} (from {ctx.plan})")
+        return ctx.tier
 
     async def get_reset_time(self, tier: str, limit_type: str = "daily") -> datetime:
         """Get when limits reset"""
         if limit_type == "daily":
             # Reset at midnight UTC tomorrow
-            now = datetime.utcnow()
-            reset = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-        else:  # monthly
-            # Reset on the 1st of next month
-            now = datetime.utcnow()
-            if now.month == 12:
-                reset = now.replace(year=now.year + 1, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-            else:
-                reset = now.replace(month=now.month + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        return reset
+            return next_daily_reset()
+        # monthly: reset on the 1st of next month
+        return next_monthly_reset()
 
     async def check_rate_limit(
         self, 
-        user_id: str = Depends(verify_supabase_token)
+        ctx: UserContext = Depends(get_user_context)
     ) -> Dict:
         """
         Check if user has exceeded rate limits.
         Returns rate limit info without raising exceptions.
         
         Args:
-            user_id: User ID from auth token
+            ctx: Request's UserContext (tier already resolved by auth)
             
         Returns:
             Dict with tier, messages, cost, and reset times
@@ -161,9 +230,10 @@ class RateLimiter:
         Raises:
             HTTPException: If rate limit is exceeded
         """
+        user_id = ctx.user_id
         try:
-            # Get user's subscription tier
-            tier = await self.get_tier_for_user(user_id)
+            # Tier was resolved once for this request
+            tier = ctx.tier
             
             if tier not in self.tier_config:
                 logger.warning(f"Unknown tier '{tier}' for user {user_id}, defaulting to 'free'")
@@ -171,13 +241,12 @@ class RateLimiter:
 
             config = self.tier_config[tier]
 
-            # Get daily message count
-            message_count = await get_user_message_count_today(user_id)
+            # In-memory counters; the DB is only read when they are cold
+            message_count, monthly_cost = await usage_counters.get(user_id)
             message_limit = config["daily_message_limit"]
             daily_reset = await self.get_reset_time(tier, "daily")
 
             # Get monthly cost
-            monthly_cost = await get_user_monthly_cost(user_id)
             cost_limit = config["monthly_cost_limit"]
             monthly_reset = await self.get_reset_time(tier, "monthly")
 
@@ -206,14 +275,14 @@ class RateLimiter:
 
     async def check_and_enforce_rate_limit(
         self, 
-        user_id: str = Depends(verify_supabase_token)
+        ctx: UserContext = Depends(get_user_context)
     ) -> Dict:
         """
         Check rate limits and raise exceptions if exceeded.
         Use this in endpoints that consume quota.
         
         Args:
-            user_id: User ID from auth token
+            ctx: Request's UserContext (tier already resolved by auth)
             
         Returns:
             Dict with rate limit info
@@ -222,9 +291,10 @@ class RateLimiter:
             HTTPException (429): If daily message limit exceeded
             HTTPException (429): If monthly cost limit exceeded
         """
+        user_id = ctx.user_id
         try:
-            # Get user's subscription tier
-            tier = await self.get_tier_for_user(user_id)
+            # Tier was resolved once for this request
+            tier = ctx.tier
             
             if tier not in self.tier_config:
                 logger.warning(f"Unknown tier '{tier}' for user {user_id}, defaulting to 'free'")
@@ -232,44 +302,25 @@ class RateLimiter:
 
             config = self.tier_config[tier]
 
-            # Check daily message limit
-            message_count = await get_user_message_count_today(user_id)
+            # Burst limit first: no point counting a request we will reject
+            await self.check_request_rate(ctx)
+
+            # Check daily message limit (in-memory counters, seeded once per window)
+            message_count, monthly_cost = await usage_counters.get(user_id)
             message_limit = config["daily_message_limit"]
             daily_reset = await self.get_reset_time(tier, "daily")
 
             if message_count >= message_limit:
                 logger.warning(f"Daily message limit exceeded for user {user_id}")
-                raise HTTPException(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                    detail={
-                        "error": "Daily message limit reached",
-                        "limit": message_limit,
-                        "used": message_count,
-                        "remaining": 0,
-                        "tier": tier,
-                        "reset_at": daily_reset.isoformat(),
-                        "upgrade_message": "Upgrade your plan for higher limits" if tier == "free" else None
-                    }
-                )
+                raise self._daily_limit_error(tier, message_limit, message_count, daily_reset)
 
             # Check monthly cost limit
-            monthly_cost = await get_user_monthly_cost(user_id)
             cost_limit = config["monthly_cost_limit"]
             monthly_reset = await self.get_reset_time(tier, "monthly")
 
             if monthly_cost >= cost_limit:
                 logger.warning(f"Monthly cost limit exceeded for user {user_id}")
-                raise HTTPException(
-                    status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                    detail={
-                        "error": "Monthly cost limit reached",
-                        "cost_limit": cost_limit,
-                        "cost_used": round(monthly_cost, 4),
-                        "tier": tier,
-                        "reset_at": monthly_reset.isoformat(),
-                        "upgrade_message": "Upgrade your plan for higher limits" if tier == "free" else None
-                    }
-                )
+                raise self._cost_limit_error(tier, cost_limit, monthly_cost, monthly_reset)
 
             # Return success info
             return {
@@ -296,10 +347,75 @@ class RateLimiter:
                 detail="Could not verify rate limits"
             )
 
+    def _daily_limit_error(self, tier: str, limit: int, used: int, reset_at: datetime) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail={
+                "error": "Daily message limit reached",
+                "limit": limit,
+                "used": used,
+                "remaining": 0,
+                "tier": tier,
+                "reset_at": reset_at.isoformat(),
+                "upgrade_message": "Upgrade your plan for higher limits" if tier == "free" else None
+            }
+        )
+
+    def _cost_limit_error(self, tier: str, limit: float, used: float, reset_at: datetime) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail={
+                "error": "Monthly cost limit reached",
+                "cost_limit": limit,
+                "cost_used": round(used, 4),
+                "tier": tier,
+                "reset_at": reset_at.isoformat(),
+                "upgrade_message": "Upgrade your plan for higher limits" if tier == "free" else None
+            }
+        )
+
+    async def reserve(self, ctx: UserContext, estimated_cost: float) -> QuotaReservation:
+        """
+        Hold one message and the estimated cost of a generation before calling
+        Gemini, counting other in-flight generations for the user, so parallel
+        requests can't all pass the same check.
+        Settle it with the real cost afterwards (the Gemini service does this
+        when passed the reservation) and release it in a finally: release is
+        a no-op once settled.
+
+        Raises:
+            HTTPException (429): If the message or cost would exceed the tier's limits
+        """
+        user_id = ctx.user_id
+        tier = ctx.tier if ctx.tier in self.tier_config else "free"
+        config = self.tier_config[tier]
+        message_limit = config["daily_message_limit"]
+        cost_limit = config["monthly_cost_limit"]
+        try:
+            reservation, messages_in_use, cost_in_use = await usage_counters.reserve(
+                user_id, message_limit, cost_limit, estimated_cost,
+                ttl=settings.QUOTA_RESERVATION_TTL_SECONDS
+            )
+        except Exception as e:
+            logger.error(f"Error reserving quota for user {user_id}: {e}", exc_info=True)
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Could not verify rate limits"
+            )
+
+        if reservation is None:
+            if messages_in_use >= message_limit:
+                logger.warning(f"Daily message limit exceeded for user {user_id}")
+                raise self._daily_limit_error(tier, message_limit, messages_in_use, next_daily_reset())
+            logger.warning(f"Monthly cost limit exceeded for user {user_id}")
+            raise self._cost_limit_error(tier, cost_limit, cost_in_use, next_monthly_reset())
+        return reservation
+
     async def increment_message_count(self, user_id: str) -> None:
         """
         Increment message count after successful message processing.
-        Call this after message is successfully processed.
+        add_message already maintains the daily rollup for user messages;
+        only call this for messages stored some other way.
         """
         try:
             # This assumes you have a method to increment message count
@@ -1,26 +1,36 @@
 # backend/app/routes/chat.py
 
-from fastapi import APIRouter, HTTPException, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, HTTPException, Depends, Header
 from pydantic import BaseModel
-import json
+from typing import Optional
+import asyncio
+from contextlib import aclosing
 
-from middleware.auth import verify_supabase_token
+from middleware.auth import verify_supabase_token, get_user_context
 from middleware.rate_limit import rate_limiter
 from services.chat_history_service import (
     create_conversation,
+    start_conversation,
     send_message_and_get_reply,
     get_messages,
     delete_conversation,
     add_message
 )
-from services.gemini_service import generate_ai_response_stream
-from services.memory_service import format_conversation_for_context
+from services.gemini_service import estimate_generation_cost, generate_ai_response_stream
+from services.generation_scheduler import SchedulerRejected, generation_scheduler
+from services.memory_service import context_token_budget, format_conversation_for_context
+from services.turn_streams import TurnStream, parse_event_id, turn_streams
+from services.user_context_service import UserContext
 from db.queries import get_user_conversations, update_conversation_title
+from utils.background import spawn
+from utils.sse import SSEResponse, StreamWriter
 from utils.validators import validate_message_length, sanitize_input
 
 router = APIRouter()
 
+# How long the end of a new-chat stream waits for a title still being generated
+TITLE_EVENT_WAIT_SECONDS = 2.0
+
 
 class NewChatRequest(BaseModel):
     first_message: str
@@ -38,24 +48,133 @@ class UpdateTitleRequest(BaseModel):
     title: str
 
 
-@router.post("/new")
+async def _claim_stream(ctx: UserContext, message: str):
+    """
+    Take a concurrent-stream slot, reserve quota for one generation and wait
+    for a generation scheduler slot, before the response starts so any of
+    them can still fail the request with 429/503.
+    All are given back in the stream's finally (see _release_stream).
+    """
+    slot_id = await rate_limiter.acquire_stream_slot(ctx)
+    try:
+        reservation = await rate_limiter.reserve(ctx, estimate_generation_cost(message))
+    except Exception:
+        await rate_limiter.release_stream_slot(ctx.user_id, slot_id)
+        raise
+    try:
+        admission = await generation_scheduler.acquire(ctx.user_id, ctx.tier)
+    except BaseException as e:
+        reservation.release()
+        spawn(rate_limiter.release_stream_slot(ctx.user_id, slot_id), name="release-stream-slot")
+        if isinstance(e, SchedulerRejected):
+            raise _busy_error(e) from e
+        raise
+    return slot_id, reservation, admission
+
+
+def _busy_error(rejected: SchedulerRejected) -> HTTPException:
+    """503 for a generation the scheduler had no room for"""
+    return HTTPException(
+        status_code=503,
+        detail={
+            "error": "The assistant is busy, try again shortly",
+            "tier": rejected.tier,
+            "retry_after": rejected.retry_after
+        },
+        headers={"Retry-After": str(rejected.retry_after)}
+    )
+
+
+def _title(task: asyncio.Task) -> Optional[str]:
+    """Result of a finished title task (None if it failed)"""
+    if not task.done() or task.cancelled() or task.exception() is not None:
+        return None
+    return task.result()
+
+
+def _release_stream(ctx: UserContext, slot_id, reservation, admission) -> None:
+    """
+    Runs in the turn's finally, which may be cancelled (nobody resumed),
+    so nothing here is awaited.
+    """
+    admission.release()
+    reservation.release()  # no-op once settled with the real cost
+    spawn(rate_limiter.release_stream_slot(ctx.user_id, slot_id), name="release-stream-slot")
+
+
+async def _save_reply(conv_id: int, writer: StreamWriter) -> None:
+    """Store the finished reply; the insert completes even if the turn is cancelled meanwhile"""
+    await asyncio.shield(spawn(add_message(conv_id, "assistant", writer.text()), name="save-reply"))
+
+
+def _save_partial_reply(conv_id: Optional[int], writer: Optional[StreamWriter]) -> None:
+    """The client left mid-reply and didn't come back: keep what was generated, marked truncated"""
+    if conv_id is None or writer is None:
+        return
+    text = writer.text()
+    if text:
+        spawn(add_message(conv_id, "assistant", text, truncated=True), name="save-partial-reply")
+
+
+async def _check_send_limits(ctx: UserContext) -> dict:
+    """
+    Per-minute rate and daily/monthly limits for a new turn, checked in the
+    stream routes after Last-Event-ID so a resume spends no quota.
+    """
+    await rate_limiter.check_request_rate(ctx)
+    return await rate_limiter.check_rate_limit(ctx)
+
+
+def _require(req):
+    if req is None:
+        raise HTTPException(status_code=422, detail="Request body required")
+    return req
+
+
+def _resume_stream(user_id: str, last_event_id: str) -> SSEResponse:
+    """Replay a turn after its Last-Event-ID, then follow it live"""
+    parsed = parse_event_id(last_event_id)
+    if parsed is None:
+        raise HTTPException(status_code=400, detail="Invalid Last-Event-ID")
+    conv_id, turn_id, seq = parsed
+    turn = turn_streams.get(conv_id, turn_id)
+    if turn is None:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    if turn.user_id != user_id:
+        raise HTTPException(status_code=403, detail="Unauthorized access to conversation")
+    turn_streams.resumed += 1
+    return SSEResponse(turn.subscribe(seq))
+
+
+@router.post("/new", dependencies=[Depends(rate_limiter.check_request_rate)])
 async def start_new_chat(
     req: NewChatRequest,
     user_id: str = Depends(verify_supabase_token),
+    ctx: UserContext = Depends(get_user_context),
     rate_limit_status: dict = Depends(rate_limiter.check_rate_limit)
 ):
     """Start a new conversation"""
     validate_message_length(req.first_message)
     clean_message = sanitize_input(req.first_message)
+    reservation = await rate_limiter.reserve(ctx, estimate_generation_cost(clean_message))
     
-    conv_id = await create_conversation(user_id, clean_message)
-    
-    # Get AI response for first message
-    response = await send_message_and_get_reply(
-        user_id,
-        conv_id,
-        clean_message
-    )
+    try:
+        conv_id = await create_conversation(user_id, clean_message)
+        
+        # Get AI response for first message
+        response = await send_message_and_get_reply(
+            user_id,
+            conv_id,
+            clean_message,
+            model_name=ctx.model_name,
+            reservation=reservation,
+            context_budget=context_token_budget(ctx.tier),
+            tier=ctx.tier
+        )
+    except SchedulerRejected as e:
+        raise _busy_error(e) from e
+    finally:
+        reservation.release()  # no-op once settled
     
     return {
         "conversation_id": conv_id,
@@ -67,24 +186,39 @@ async def start_new_chat(
 
 @router.post("/new/stream")
 async def start_new_chat_stream(
-    req: NewChatRequest,
+    req: Optional[NewChatRequest] = None,
     user_id: str = Depends(verify_supabase_token),
-    rate_limit_status: dict = Depends(rate_limiter.check_rate_limit)
+    ctx: UserContext = Depends(get_user_context),
+    last_event_id: Optional[str] = Header(None)
 ):
-    """Start a new conversation with streaming response"""
+    """
+    Start a new conversation with streaming response.
+    With a Last-Event-ID header, resumes that stream instead: no rate limit
+    or quota applies and the body may be left out.
+    """
+    if last_event_id:
+        return _resume_stream(user_id, last_event_id)
+    req = _require(req)
+    rate_limit_status = await _check_send_limits(ctx)
     validate_message_length(req.first_message)
     clean_message = sanitize_input(req.first_message)
+    slot_id, reservation, admission = await _claim_stream(ctx, clean_message)
     
-    async def generate():
+    async def produce(turn: TurnStream):
+        conv_id = writer = None
         try:
-            # Create conversation
-            conv_id = await create_conversation(user_id, clean_message)
+            # Create conversation (title is generated in the background)
+            conv_id, title_task = await start_conversation(user_id, clean_message)
             
-            # Save user message
-            await add_message(conv_id, "user", clean_message)
+            # Save user message; its id names the turn for resuming
+            message_id = await add_message(conv_id, "user", clean_message, user_id, reservation)
+            if message_id is not None:
+                turn.bind(conv_id, message_id)
             
             # Get context (will be empty for first message)
-            context = await format_conversation_for_context(conv_id)
+            context = await format_conversation_for_context(
+                conv_id, context_token_budget(ctx.tier), user_id, clean_message
+            )
             
             # If images provided and user is premium, include image context
             message_for_model = clean_message
@@ -92,55 +226,86 @@ async def start_new_chat_stream(
                 img_count = len(req.images)
                 message_for_model = f"{clean_message}\n\n[User attached {img_count} image(s). Describe and analyze images if requested.]"
 
-            # Stream AI response
-            full_response = ""
-            async for chunk in generate_ai_response_stream(
+            # Stream AI response (chunks coalesced into fewer frames).
+            # Leaving this block early closes the Gemini stream.
+            writer = StreamWriter()
+            async with aclosing(writer.coalesce(generate_ai_response_stream(
                 message_for_model,
                 context,
                 user_id,
-                conv_id
-            ):
-                full_response += chunk
-                yield f"data: {json.dumps({'chunk': chunk, 'done': False})}\n\n"
+                conv_id,
+                model_name=ctx.model_name,
+                reservation=reservation,
+                tier=ctx.tier,
+                admission=admission
+            ))) as texts:
+                async for text in texts:
+                    turn.publish({'chunk': text, 'done': False})
+                    if title_task is not None and title_task.done():
+                        title = _title(title_task)
+                        title_task = None
+                        if title:
+                            turn.publish({'title': title, 'done': False})
             
             # Save complete response
-            await add_message(conv_id, "assistant", full_response)
+            complete, writer = writer, None
+            await _save_reply(conv_id, complete)
+            
+            # Title still pending: give it a moment (it is stored either way)
+            if title_task is not None:
+                await asyncio.wait({title_task}, timeout=TITLE_EVENT_WAIT_SECONDS)
+                title = _title(title_task)
+                if title:
+                    turn.publish({'title': title, 'done': False})
             
             # Send completion event with conversation_id
-            yield f"data: {json.dumps({'done': True, 'conversation_id': conv_id, 'rate_limit': rate_limit_status})}\n\n"
+            turn.publish({'done': True, 'conversation_id': conv_id, 'rate_limit': rate_limit_status})
         
         except Exception as e:
-            error_data = json.dumps({'error': str(e), 'done': True})
-            yield f"data: {error_data}\n\n"
+            turn.publish({'error': str(e), 'done': True})
+        except asyncio.CancelledError:
+            # Client gone and not back within the grace period
+            _save_partial_reply(conv_id, writer)
+            raise
+        finally:
+            _release_stream(ctx, slot_id, reservation, admission)
     
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        }
-    )
+    turn = turn_streams.start(user_id, produce)
+    return SSEResponse(turn.subscribe())
 
 
 @router.post("/send/stream")
 async def send_message_stream(
-    req: SendMessageRequest,
+    req: Optional[SendMessageRequest] = None,
     user_id: str = Depends(verify_supabase_token),
-    rate_limit_status: dict = Depends(rate_limiter.check_rate_limit)
+    ctx: UserContext = Depends(get_user_context),
+    last_event_id: Optional[str] = Header(None)
 ):
-    """Stream AI response in real-time"""
+    """
+    Stream AI response in real-time.
+    With a Last-Event-ID header, resumes that stream instead: no rate limit
+    or quota applies and the body may be left out.
+    """
+    if last_event_id:
+        return _resume_stream(user_id, last_event_id)
+    req = _require(req)
+    rate_limit_status = await _check_send_limits(ctx)
     validate_message_length(req.message)
     clean_message = sanitize_input(req.message)
+    slot_id, reservation, admission = await _claim_stream(ctx, clean_message)
     
-    async def generate():
+    async def produce(turn: TurnStream):
+        writer = None
         try:
-            # Save user message
-            await add_message(req.conversation_id, "user", clean_message)
+            # Save user message; its id names the turn for resuming
+            message_id = await add_message(req.conversation_id, "user", clean_message, user_id, reservation)
+            if message_id is not None:
+                turn.bind(req.conversation_id, message_id)
             
             # Get context
-            context = await format_conversation_for_context(req.conversation_id)
+            context = await format_conversation_for_context(
+                req.conversation_id, context_token_budget(ctx.tier), user_id, clean_message
+            )
             
             # If images provided and user is premium, append image context
             message_for_model = clean_message
@@ -148,36 +313,56 @@ async def send_message_stream(
                 img_count = len(req.images)
                 message_for_model = f"{clean_message}\n\n[User attached {img_count} image(s). Describe and analyze images if requested.]"
 
-            # Stream AI response
-            full_response = ""
-            async for chunk in generate_ai_response_stream(
+            # Stream AI response (chunks coalesced into fewer frames).
+            # Leaving this block early closes the Gemini stream.
+            writer = StreamWriter()
+            async with aclosing(writer.coalesce(generate_ai_response_stream(
                 message_for_model,
                 context,
                 user_id,
-                req.conversation_id
-            ):
-                full_response += chunk
-                yield f"data: {json.dumps({'chunk': chunk, 'done': False})}\n\n"
+                req.conversation_id,
+                model_name=ctx.model_name,
+                reservation=reservation,
+                tier=ctx.tier,
+                admission=admission
+            ))) as texts:
+                async for text in texts:
+                    turn.publish({'chunk': text, 'done': False})
             
             # Save complete response
-            await add_message(req.conversation_id, "assistant", full_response)
+            complete, writer = writer, None
+            await _save_reply(req.conversation_id, complete)
             
             # Send completion event
-            yield f"data: {json.dumps({'done': True, 'conversation_id': req.conversation_id, 'rate_limit': rate_limit_status})}\n\n"
+            turn.publish({'done': True, 'conversation_id': req.conversation_id, 'rate_limit': rate_limit_status})
         
         except Exception as e:
-            error_data = json.dumps({'error': str(e), 'done': True})
-            yield f"data: {error_data}\n\n"
+            turn.publish({'error': str(e), 'done': True})
+        except asyncio.CancelledError:
+            # Client gone and not back within the grace period
+            _save_partial_reply(req.conversation_id, writer)
+            raise
+        finally:
+            _release_stream(ctx, slot_id, reservation, admission)
     
-    return StreamingResponse(
-        generate(),
-        media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no",
-        }
-    )
+    turn = turn_streams.start(user_id, produce)
+    return SSEResponse(turn.subscribe())
+
+
+@router.get("/stream/resume")
+async def resume_stream(
+    user_id: str = Depends(verify_supabase_token),
+    last_event_id: Optional[str] = Header(None),
+    event_id: Optional[str] = None
+):
+    """
+    Reconnect to a chat stream: replays the frames after Last-Event-ID (header,
+    or ?event_id= for clients that can't set it) and continues live.
+    404 once the turn has expired; reload the history instead.
+    """
+    if not (last_event_id or event_id):
+        raise HTTPException(status_code=400, detail="Last-Event-ID required")
+    return _resume_stream(user_id, last_event_id or event_id)
 
 
 @router.get("/list")
@@ -250,7 +435,7 @@ async def get_chat_history(
             # Get all messages for this conversation
             messages = await conn.fetch(
                 """
-                SELECT id, role, message_text, created_at
+                SELECT id, role, message_text, truncated, created_at
                 FROM messages
                 WHERE conversation_id = $1
                 ORDER BY created_at ASC
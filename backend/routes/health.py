@@ -3,6 +3,19 @@
 from fastapi import APIRouter
 from db.database import get_db_pool
 from datetime import datetime
+from middleware.auth import auth_cache_stats
+from services.context_cache import context_cache
+from services.conversation_cache import conversation_cache
+from services.api_key_pool import api_key_pool
+from services.gemini_resilience import gemini_resilience
+from services.gemini_service import model_registry
+from services.generation_scheduler import generation_scheduler
+from services.response_cache import response_cache
+from services.title_batcher import title_batcher
+from services.turn_streams import turn_streams
+from services.usage_counters import usage_counters
+from services.usage_log_writer import usage_log_writer
+from services.vector_memory import vector_memory
 
 router = APIRouter()
 
@@ -24,4 +37,25 @@ async def health_check():
             "status": "unhealthy",
             "database": "disconnected",
             "error": str(e)
-        }
\ No newline at end of file
+        }
+
+
+@router.get("/health/caches")
+async def cache_stats():
+    """In-process cache sizes, hit/miss counters and queues for this worker"""
+    return {
+        "auth": auth_cache_stats(),
+        "models": {"stats": model_registry.stats(), "entries": model_registry.entries()},
+        "quota_counters": usage_counters.stats(),
+        "usage_log": usage_log_writer.stats(),
+        "conversation_tails": conversation_cache.stats(),
+        "turn_streams": turn_streams.stats(),
+        "generation_scheduler": generation_scheduler.stats(),
+        "title_batcher": title_batcher.stats(),
+        "gemini_resilience": gemini_resilience.stats(),
+        "api_keys": api_key_pool.stats(),
+        "response_cache": response_cache.stats(),
+        "context_cache": context_cache.stats(),
+        "vector_memory": vector_memory.stats(),
+        "timestamp": datetime.utcnow().isoformat()
+    }
@@ -1,22 +1,24 @@
 # backend/routes/rate_limit.py
 
 from fastapi import APIRouter, Depends
-from middleware.auth import verify_supabase_token
+from middleware.auth import get_user_context
 from middleware.rate_limit import rate_limiter
+from services.user_context_service import UserContext
 import logging
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
 @router.get("/check")
-async def check_rate_limit_endpoint(user_id: str = Depends(verify_supabase_token)):
+async def check_rate_limit_endpoint(ctx: UserContext = Depends(get_user_context)):
     """
     Check user's current rate limit status
     Returns rate limit info without enforcing limits
     """
+    user_id = ctx.user_id
     try:
-        # Get user's subscription tier
-        tier = await rate_limiter.get_tier_for_user(user_id)
+        # Tier was resolved once for this request
+        tier = ctx.tier
         logger.info(f"User {user_id} tier detected as: {tier}")
         
         if tier not in rate_limiter.tier_config:
@@ -26,14 +28,12 @@ async def check_rate_limit_endpoint(user_id: str = Depends(verify_supabase_token
         config = rate_limiter.tier_config[tier]
         logger.info(f"User {user_id} using tier config: {tier} with limit: {config['daily_message_limit']}")
 
-        # Get daily message count
-        from db.queries import get_user_message_count_today, get_user_monthly_cost
-        message_count = await get_user_message_count_today(user_id)
+        # Get daily message count and monthly cost (in-memory counters)
+        from services.usage_counters import usage_counters
+        message_count, monthly_cost = await usage_counters.get(user_id)
         message_limit = config["daily_message_limit"]
         daily_reset = await rate_limiter.get_reset_time(tier, "daily")
 
-        # Get monthly cost
-        monthly_cost = await get_user_monthly_cost(user_id)
         cost_limit = config["monthly_cost_limit"]
 
         # Create rate limit info
@@ -23,6 +23,7 @@ from pydantic import BaseModel
 from enum import Enum
 
 from middleware.auth import verify_supabase_token
+from services.invalidation_service import publish_invalidation
 from services.solana_service import verify_transaction_complete
 from db.helpers import fetch_one, execute_query
 from core.config import settings
@@ -236,6 +237,9 @@ async def upgrade_plan(
             user_id
         )
         
+        # Every worker's cached user row / tier is now stale
+        await publish_invalidation("user", user_id)
+        
         logger.info(f"✅ User {user_id} upgraded to {request.plan.value}")
         
         return {
@@ -279,6 +283,8 @@ async def cancel_subscription(user_id: str = Depends(verify_supabase_token)):
             user_id
         )
         
+        await publish_invalidation("user", user_id)
+        
         logger.info(f"✅ User {user_id} cancelled subscription")
         
         return {
@@ -0,0 +1,217 @@
+# backend/services/api_key_pool.py
+
+"""
+Pool of Google API keys for Gemini, each with its own SDK clients.
+
+Every call leases a key: the pool picks the one with the most budget left in
+the current minute (requests and tokens against GEMINI_KEY_RPM_LIMIT /
+GEMINI_KEY_TPM_LIMIT, counting calls still in flight), rotating between
+equally good keys. The lease is released with the call's real token usage,
+or with its error: a 429 (ResourceExhausted) cools the key down for
+GEMINI_KEY_COOLDOWN_SECONDS, doubling per throttle in a row up to
+GEMINI_KEY_MAX_COOLDOWN_SECONDS, and empties its budget for the window.
+If every key is cooling down the one that recovers first is used.
+
+Keys come from GOOGLE_API_KEY plus the comma-separated GOOGLE_API_KEYS.
+Each key's clients are built on first use (client_factory, swapped for a
+fake in tests) and attached to the models built for that key.
+"""
+
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from core.config import settings
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:
+    google_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+WINDOW_SECONDS = 60.0
+
+
+def _is_throttle(error: BaseException) -> bool:
+    if google_exceptions is not None and isinstance(error, google_exceptions.ResourceExhausted):
+        return True
+    return getattr(error, "code", None) == 429
+
+
+def sdk_client(api_key: str, name: str) -> Any:
+    """
+    One generativelanguage service client bound to an API key, by the SDK's
+    client name ("generative", "generative_async", "cache_async", ...).
+    genai.configure only holds one process-wide key, so each key gets its own
+    clients, built the way the SDK builds its defaults.
+    """
+    import google.generativeai as genai
+    from google.ai import generativelanguage as glm
+    from google.api_core import client_options, gapic_v1
+
+    service, _, mode = name.partition("_")
+    cls = getattr(glm, f"{service.title()}Service{'AsyncClient' if mode == 'async' else 'Client'}")
+    return cls(
+        client_options=client_options.ClientOptions(api_key=api_key),
+        client_info=gapic_v1.client_info.ClientInfo(user_agent=f"genai-py/{genai.__version__}"),
+    )
+
+
+def sdk_clients(api_key: str) -> Tuple[Any, Any]:
+    """(sync, async) generative clients bound to one API key"""
+    return sdk_client(api_key, "generative"), sdk_client(api_key, "generative_async")
+
+
+class ApiKey:
+    __slots__ = (
+        "index", "label", "secret", "window_start", "requests", "tokens", "in_flight",
+        "cooldown_until", "throttle_streak", "throttles", "calls", "_clients"
+    )
+
+    def __init__(self, index: int, secret: str):
+        self.index = index
+        self.label = f"key{index}"  # position in the configured list; no part of the secret
+        self.secret = secret
+        self.window_start = 0.0
+        self.requests = 0
+        self.tokens = 0
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.throttle_streak = 0
+        self.throttles = 0
+        self.calls = 0
+        self._clients: Optional[Tuple[Any, Any]] = None
+
+
+class ApiKeyPool:
+    def __init__(
+        self,
+        secrets: Sequence[str],
+        rpm_limit: int,
+        tpm_limit: int,
+        cooldown: float,
+        max_cooldown: float,
+        client_factory: Callable[[str], Tuple[Any, Any]] = sdk_clients,
+        clock=time.monotonic
+    ):
+        unique = list(dict.fromkeys(s.strip() for s in secrets if s and s.strip()))
+        if not unique:
+            raise ValueError("No Google API key configured")
+        self.keys = [ApiKey(i, secret) for i, secret in enumerate(unique)]
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._client_factory = client_factory
+        self._clock = clock
+        self._next = 0  # rotation start for ties
+
+    def _roll_window(self, key: ApiKey, now: float) -> None:
+        if now - key.window_start >= WINDOW_SECONDS:
+            key.window_start = now
+            key.requests = 0
+            key.tokens = 0
+
+    def _headroom(self, key: ApiKey) -> float:
+        """Fraction of the minute's budget left, the tighter of requests and tokens"""
+        requests = 1 - (key.requests + key.in_flight) / self.rpm_limit
+        tokens = 1 - key.tokens / self.tpm_limit
+        return min(requests, tokens)
+
+    def acquire(self, estimated_tokens: int = 0) -> ApiKey:
+        """Lease the key with the most budget left; release() it when the call ends"""
+        now = self._clock()
+        count = len(self.keys)
+        best: Optional[ApiKey] = None
+        best_score = None
+        for offset in range(count):
+            key = self.keys[(self._next + offset) % count]
+            self._roll_window(key, now)
+            if key.cooldown_until > now:
+                continue
+            score = self._headroom(key)
+            if best is None or score > best_score:
+                best, best_score = key, score
+        if best is None:
+            # Everything is throttled: take the key that recovers first
+            best = min(self.keys, key=lambda k: k.cooldown_until)
+        self._next = (best.index + 1) % count
+        best.in_flight += 1
+        best.requests += 1
+        best.tokens += estimated_tokens
+        best.calls += 1
+        return best
+
+    def release(
+        self,
+        key: ApiKey,
+        tokens: Optional[int] = None,
+        estimated_tokens: int = 0,
+        error: Optional[BaseException] = None
+    ) -> None:
+        """
+        End a lease. tokens is the call's real usage, replacing the estimate
+        counted at acquire(); a 429 error cools the key down.
+        """
+        key.in_flight = max(0, key.in_flight - 1)
+        if tokens is not None:
+            key.tokens = max(0, key.tokens + tokens - estimated_tokens)
+        if error is not None and _is_throttle(error):
+            self.throttled(key)
+        elif error is None:
+            key.throttle_streak = 0
+
+    def throttled(self, key: ApiKey) -> None:
+        key.throttles += 1
+        key.throttle_streak += 1
+        cooldown = min(self.max_cooldown, self.cooldown * 2 ** (key.throttle_streak - 1))
+        now = self._clock()
+        key.cooldown_until = now + cooldown
+        # Whatever the window said, this key has nothing left
+        key.window_start = now
+        key.requests = self.rpm_limit
+        key.tokens = self.tpm_limit
+        logger.warning(f"Gemini {key.label} throttled, cooling down for {cooldown:.0f}s")
+
+    def clients(self, key: ApiKey) -> Tuple[Any, Any]:
+        """(sync, async) SDK clients for a key"""
+        if key._clients is None:
+            key._clients = self._client_factory(key.secret)
+        return key._clients
+
+    def key_stats(self) -> List[Dict[str, Any]]:
+        """Per-key budgets and cooldowns (not exposed over HTTP)"""
+        now = self._clock()
+        return [
+            {
+                "key": key.label,
+                "calls": key.calls,
+                "in_flight": key.in_flight,
+                "requests_this_minute": key.requests,
+                "tokens_this_minute": key.tokens,
+                "throttles": key.throttles,
+                "cooldown_seconds": round(max(0.0, key.cooldown_until - now), 1),
+            }
+            for key in self.keys
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool-wide totals, safe for the unauthenticated /health/caches"""
+        now = self._clock()
+        return {
+            "keys": len(self.keys),
+            "cooling_down": sum(1 for key in self.keys if key.cooldown_until > now),
+            "calls": sum(key.calls for key in self.keys),
+            "in_flight": sum(key.in_flight for key in self.keys),
+            "throttles": sum(key.throttles for key in self.keys),
+        }
+
+
+api_key_pool = ApiKeyPool(
+    [settings.GOOGLE_API_KEY, *settings.GOOGLE_API_KEYS.split(",")],
+    rpm_limit=settings.GEMINI_KEY_RPM_LIMIT,
+    tpm_limit=settings.GEMINI_KEY_TPM_LIMIT,
+    cooldown=settings.GEMINI_KEY_COOLDOWN_SECONDS,
+    max_cooldown=settings.GEMINI_KEY_MAX_COOLDOWN_SECONDS
+)
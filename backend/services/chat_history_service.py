@@ -1,32 +1,128 @@
 # backend/app/services/chat_history_service.py - FIXED
 
+import asyncio
+import logging
+from typing import Optional, Tuple
 from db.queries import (
     create_conversation as db_create_conversation,
     add_message as db_add_message,
     get_conversation_messages,
-    delete_conversation as db_delete_conversation
+    delete_conversation as db_delete_conversation,
+    update_conversation_title
 )
-from services.gemini_service import (
-    generate_ai_response,
-    generate_conversation_title
-)
-from services.memory_service import format_conversation_for_context
+from services.conversation_cache import conversation_cache
+from services.gemini_service import generate_ai_response
+from services.invalidation_service import invalidation_notice
+from services.memory_service import format_conversation_for_context, schedule_summary_update
+from services.title_batcher import title_batcher
+from services.vector_memory import vector_memory
+from services.usage_counters import QuotaReservation, quota_notice, usage_counters
+from utils.background import spawn
+from utils.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# First messages this short are used as the title as-is (no LLM call)
+SHORT_TITLE_MAX_WORDS = 6
+SHORT_TITLE_MAX_CHARS = 50
+
+
+def heuristic_title(first_message: str) -> Optional[str]:
+    """Title for a short first message, or None if it needs the model"""
+    text = " ".join(first_message.split()).strip(" .,;:!?")
+    if not text:
+        return "New Chat"
+    if len(text.split()) <= SHORT_TITLE_MAX_WORDS and len(text) <= SHORT_TITLE_MAX_CHARS:
+        return text[0].upper() + text[1:]
+    return None
+
+
+def provisional_title(first_message: str) -> str:
+    """Shown until the generated title arrives"""
+    text = " ".join(first_message.split())
+    if not text:
+        return "New Chat"
+    return (text[:40] + "...") if len(text) > 40 else text
+
+
+async def _generate_and_store_title(conv_id: int, user_id: str, first_message: str, provisional: str) -> str:
+    # Batched with other new conversations' titles into one request
+    try:
+        title = await title_batcher.generate(first_message)
+    except Exception as e:
+        logger.warning(f"Title generation failed for conversation {conv_id}, keeping '{provisional}': {e}")
+        return provisional
+    if title and title != provisional:
+        await update_conversation_title(conv_id, user_id, title, expected_title=provisional)
+    return title
+
+
+async def start_conversation(user_id: str, first_message: str) -> Tuple[int, Optional[asyncio.Task]]:
+    """
+    Create a conversation right away and generate its title in the background.
+    Returns (conversation_id, task resolving to the generated title), where the
+    task is None when a short first message was used as the title directly.
+    """
+    title = heuristic_title(first_message)
+    if title is not None:
+        return await db_create_conversation(user_id, title), None
+
+    provisional = provisional_title(first_message)
+    conv_id = await db_create_conversation(user_id, provisional)
+    task = spawn(
+        _generate_and_store_title(conv_id, user_id, first_message, provisional),
+        name=f"conversation-title-{conv_id}"
+    )
+    return conv_id, task
 
 
 async def create_conversation(user_id: str, first_message: str) -> int:
-    """Create new conversation with AI-generated title"""
-    # Generate smart title using AI
-    title = await generate_conversation_title(first_message)
-    
-    # Create conversation in database
-    conv_id = await db_create_conversation(user_id, title)
-    
+    """Create new conversation; the AI-generated title is filled in afterwards"""
+    conv_id, _ = await start_conversation(user_id, first_message)
     return conv_id
 
 
-async def add_message(conversation_id: int, role: str, text: str):
-    """Add message to conversation"""
-    await db_add_message(conversation_id, role, text)
+async def add_message(
+    conversation_id: int,
+    role: str,
+    text: str,
+    user_id: Optional[str] = None,
+    reservation: Optional[QuotaReservation] = None,
+    truncated: bool = False
+) -> Optional[int]:
+    """
+    Add message to conversation; returns the new message's id. Pass user_id to keep quota counters current,
+    and the request's reservation so the stored message uses its held slot.
+    truncated marks a partial reply (the client disconnected mid-stream).
+    Saving an assistant reply kicks off a background summary update.
+    The message goes into this worker's conversation tail cache; the insert
+    itself tells other workers to drop their copy and, for a user message, to
+    count it against the user's quota.
+    """
+    tokens = estimate_tokens(text)
+    channel, payload = invalidation_notice("conversation", conversation_id)
+    payloads = [payload]
+    quota_user = reservation.user_id if reservation is not None else user_id
+    if role == "user" and quota_user:
+        messages = reservation.messages if reservation is not None else 1
+        payloads.append(quota_notice(quota_user, messages=messages)[1])
+    stored = await db_add_message(
+        conversation_id, role, text, tokens,
+        notify=(channel, payloads),
+        truncated=truncated
+    )
+    if stored:
+        conversation_cache.append(conversation_id, stored["id"], role, text, tokens)
+    if stored and stored.get("user_id"):
+        vector_memory.index_message(str(stored["user_id"]), conversation_id, stored["id"], text)
+    if role == "user":
+        if reservation is not None:
+            reservation.commit_message(notify=False)
+        elif user_id:
+            usage_counters.record_message(user_id, notify=False)
+    elif role == "assistant":
+        schedule_summary_update(conversation_id)
+    return stored["id"] if stored else None
 
 
 async def get_messages(conversation_id: int, user_id: str):
@@ -38,6 +134,7 @@ async def delete_conversation(conversation_id: int, user_id: str) -> bool:
     """Delete conversation - returns True if successful"""
     try:
         result = await db_delete_conversation(conversation_id, user_id)
+        conversation_cache.invalidate(conversation_id)
         print(f"✅ Delete service: conversation {conversation_id} deleted successfully")
         return True  # ← FIX: Return True on success
     except Exception as e:
@@ -48,24 +145,31 @@ async def delete_conversation(conversation_id: int, user_id: str) -> bool:
 async def send_message_and_get_reply(
     user_id: str, 
     conversation_id: int, 
-    user_message: str
+    user_message: str,
+    model_name: Optional[str] = None,
+    reservation: Optional[QuotaReservation] = None,
+    context_budget: Optional[int] = None,
+    tier: Optional[str] = None
 ) -> dict:
     """
     Send user message, get AI reply, and save both
     Returns full response with metadata
     """
     # Save user message
-    await add_message(conversation_id, "user", user_message)
+    await add_message(conversation_id, "user", user_message, user_id, reservation)
     
     # Get full conversation context with system prompt
-    context = await format_conversation_for_context(conversation_id)
+    context = await format_conversation_for_context(conversation_id, context_budget, user_id, user_message)
     
     # Generate AI response with cost tracking
     ai_response = await generate_ai_response(
         user_message, 
         context,
         user_id,
-        conversation_id
+        conversation_id,
+        model_name=model_name,
+        reservation=reservation,
+        tier=tier
     )
     
     # Save AI reply
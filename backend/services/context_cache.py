@@ -0,0 +1,247 @@
+# backend/services/context_cache.py
+
+"""
+Gemini context caching for long, stable prompt prefixes.
+
+A long conversation re-sends the same system instruction and older turns
+on every request. With CONTEXT_CACHE_ENABLED those are uploaded once as a
+Gemini cached content (per model and API key: caches belong to a key's
+project) and later requests send only what comes after the prefix. Cached
+input tokens are billed at a discount and don't have to be processed again,
+which also cuts time to first token.
+
+History only grows at the end (a summary update or a window that slides
+rewrites the start), so prefixes are matched by a hash chain over the
+entries: lookup() finds the longest live cached prefix of the history. When
+the part after it reaches CONTEXT_CACHE_MIN_TOKENS (the smallest prefix worth
+caching, and at least the model's own minimum), a longer prefix is created
+in the background; the request itself never waits for an upload. Caches
+expire upstream after CONTEXT_CACHE_TTL_SECONDS and are forgotten here a
+little earlier; past CONTEXT_CACHE_MAX_ENTRIES the oldest are deleted.
+
+The upload itself goes through a backend (create/delete), GeminiCachedContents
+in production and a local fake in tests.
+"""
+
+import datetime
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from core.config import settings
+from services.api_key_pool import ApiKey, sdk_client
+from utils.background import spawn
+from utils.tokens import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+EXPIRY_MARGIN_SECONDS = 30.0  # stop using a cache this long before it expires upstream
+
+
+def cache_client(api_key: str):
+    """Async cachedContents client bound to one API key"""
+    return sdk_client(api_key, "cache_async")
+
+
+class GeminiCachedContents:
+    """Backend on the Gemini API's cachedContents, one client per API key"""
+
+    def __init__(self, client_factory=cache_client):
+        self._client_factory = client_factory
+        self._clients: Dict[int, Any] = {}
+
+    def _client(self, key: ApiKey):
+        client = self._clients.get(key.index)
+        if client is None:
+            client = self._clients[key.index] = self._client_factory(key.secret)
+        return client
+
+    async def create(
+        self,
+        key: ApiKey,
+        model: str,
+        system_instruction: Optional[str],
+        history: List[dict],
+        ttl: float
+    ) -> str:
+        """Upload a prefix; returns the cached content's name"""
+        from google.generativeai import protos
+        from google.generativeai.types import content_types
+
+        cached = protos.CachedContent(
+            model=model if model.startswith("models/") else f"models/{model}",
+            contents=content_types.to_contents(history),
+            ttl=datetime.timedelta(seconds=ttl),
+        )
+        if system_instruction:
+            cached.system_instruction = content_types.to_content(system_instruction)
+        response = await self._client(key).create_cached_content(
+            protos.CreateCachedContentRequest(cached_content=cached)
+        )
+        return response.name
+
+    async def delete(self, key: ApiKey, name: str) -> None:
+        await self._client(key).delete_cached_content(name=name)
+
+
+class CachedPrefix:
+    __slots__ = ("name", "model", "key", "entries", "tokens", "expires_at", "uses", "models")
+
+    def __init__(self, name: str, model: str, key: ApiKey, entries: int, tokens: int, expires_at: float):
+        self.name = name
+        self.model = model
+        self.key = key
+        self.entries = entries  # history entries covered (the system instruction always is)
+        self.tokens = tokens
+        self.expires_at = expires_at
+        self.uses = 0
+        self.models: Dict[str, Any] = {}  # model objects bound to this cache, by generation config
+
+
+def _entry_text(entry: dict) -> str:
+    return "".join(str(p) for p in entry.get("parts", ()))
+
+
+class ContextCache:
+    def __init__(
+        self,
+        backend,
+        enabled: bool,
+        min_tokens: int,
+        ttl: float,
+        max_entries: int,
+        clock=time.monotonic
+    ):
+        self.backend = backend
+        self.enabled = enabled
+        self.min_tokens = min_tokens
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._prefixes: "OrderedDict[str, CachedPrefix]" = OrderedDict()
+        self._pending: set = set()
+        self._failed: Dict[str, float] = {}  # prefix hash -> don't retry before (oldest first)
+        self.hits = 0
+        self.misses = 0
+        self.created = 0
+        self.failures = 0
+        self.cached_tokens = 0
+
+    @staticmethod
+    def _chain(model: str, key: ApiKey, system_instruction: Optional[str], history: List[dict]) -> List[str]:
+        """Hash of every prefix: [instruction only, + history[0], + history[1], ...]"""
+        digest = hashlib.sha256(f"{model}\0{key.index}\0{system_instruction or ''}".encode("utf-8"))
+        hashes = [digest.hexdigest()]
+        for entry in history:
+            digest.update(f"\0{entry.get('role', '')}\0{_entry_text(entry)}".encode("utf-8"))
+            hashes.append(digest.hexdigest())
+        return hashes
+
+    def lookup(
+        self,
+        model: str,
+        key: ApiKey,
+        system_instruction: Optional[str],
+        history: Optional[List[dict]]
+    ) -> Tuple[Optional[CachedPrefix], Optional[List[dict]]]:
+        """
+        The longest live cached prefix for this call and the history left to
+        send after it, or (None, history). May start caching a longer prefix
+        for the next request.
+        """
+        if not self.enabled or history is None:
+            return None, history
+        now = self._clock()
+        hashes = self._chain(model, key, system_instruction, history)
+
+        found: Optional[CachedPrefix] = None
+        for entries in range(len(history), -1, -1):
+            prefix = self._prefixes.get(hashes[entries])
+            if prefix is None:
+                continue
+            if prefix.expires_at - EXPIRY_MARGIN_SECONDS > now:
+                found = prefix
+                break
+            del self._prefixes[hashes[entries]]
+
+        covered = found.entries if found else 0
+        uncovered = sum(estimate_tokens(_entry_text(e)) for e in history[covered:])
+        if found is None:
+            uncovered += estimate_tokens(system_instruction or "")
+        if uncovered >= self.min_tokens:
+            self._start_create(hashes[-1], model, key, system_instruction, list(history),
+                               (found.tokens if found else 0) + uncovered, now)
+
+        if found is None:
+            self.misses += 1
+            return None, history
+        self.hits += 1
+        found.uses += 1
+        self.cached_tokens += found.tokens
+        self._prefixes.move_to_end(hashes[found.entries])
+        return found, history[found.entries:]
+
+    def _start_create(self, prefix_hash: str, model: str, key: ApiKey, system_instruction: Optional[str],
+                      history: List[dict], tokens: int, now: float) -> None:
+        if prefix_hash in self._pending or self._failed.get(prefix_hash, 0) > now:
+            return
+        self._prune_failed(now)
+        self._pending.add(prefix_hash)
+        spawn(self._create(prefix_hash, model, key, system_instruction, history, tokens), name="context-cache")
+
+    def _prune_failed(self, now: float) -> None:
+        """Forget failures whose back-off is over; at most max_entries are kept"""
+        for prefix_hash in [h for h, retry_at in self._failed.items() if retry_at <= now]:
+            del self._failed[prefix_hash]
+        while len(self._failed) >= self.max_entries:
+            del self._failed[next(iter(self._failed))]  # the oldest failure
+
+    async def _create(self, prefix_hash: str, model: str, key: ApiKey, system_instruction: Optional[str],
+                      history: List[dict], tokens: int) -> None:
+        try:
+            name = await self.backend.create(key, model, system_instruction, history, self.ttl)
+        except Exception as e:
+            self.failures += 1
+            self._failed[prefix_hash] = self._clock() + self.ttl
+            logger.warning(f"Could not cache a {tokens}-token prefix for {model}: {e}")
+            return
+        finally:
+            self._pending.discard(prefix_hash)
+        self.created += 1
+        self._failed.pop(prefix_hash, None)
+        self._prefixes[prefix_hash] = CachedPrefix(name, model, key, len(history), tokens, self._clock() + self.ttl)
+        while len(self._prefixes) > self.max_entries:
+            _, evicted = self._prefixes.popitem(last=False)
+            spawn(self._delete(evicted), name="context-cache-delete")
+
+    async def _delete(self, prefix: CachedPrefix) -> None:
+        try:
+            await self.backend.delete(prefix.key, prefix.name)
+        except Exception as e:
+            logger.debug(f"Could not delete cached content {prefix.name} (it expires anyway): {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "prefixes": len(self._prefixes),
+            "creating": len(self._pending),
+            "created": self.created,
+            "failures": self.failures,
+            "backing_off": len(self._failed),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "cached_tokens_served": self.cached_tokens,
+        }
+
+
+context_cache = ContextCache(
+    GeminiCachedContents(),
+    enabled=settings.CONTEXT_CACHE_ENABLED,
+    min_tokens=settings.CONTEXT_CACHE_MIN_TOKENS,
+    ttl=settings.CONTEXT_CACHE_TTL_SECONDS,
+    max_entries=settings.CONTEXT_CACHE_MAX_ENTRIES
+)
@@ -0,0 +1,239 @@
+# backend/services/conversation_cache.py
+
+"""
+Recent conversation tails kept in this worker.
+
+A tail is the conversation's rolling summary plus the messages after it,
+oldest first. It is loaded from the DB on a miss and then kept current by
+add_message, so the next turn's context is packed from memory instead of
+re-reading rows this worker just wrote. The cache is an LRU bounded by an
+approximate byte budget.
+
+When another worker writes to a conversation (or a summary moves forward)
+an invalidation on the "conversation" entity drops the tail everywhere, and
+the next turn reloads it from the DB.
+"""
+
+import sys
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from core.config import settings
+from services.invalidation_service import register_invalidation_handler
+
+# Rough per-object overhead on top of the text itself
+_MESSAGE_OVERHEAD = 96
+_TAIL_OVERHEAD = 256
+
+
+class CachedMessage:
+    __slots__ = ("id", "role", "text", "tokens", "nbytes")
+
+    def __init__(self, message_id: int, role: str, text: str, tokens: int):
+        self.id = message_id
+        self.role = role
+        self.text = text
+        self.tokens = tokens
+        self.nbytes = sys.getsizeof(text) + _MESSAGE_OVERHEAD
+
+
+class ConversationTail:
+    """
+    Summary plus the newest messages after it. `complete` is True when the
+    messages reach back to the summary (or the start of the conversation);
+    otherwise older messages exist that only the DB has.
+    """
+
+    __slots__ = ("conversation_id", "summary", "summary_tokens", "messages", "complete", "nbytes")
+
+    def __init__(
+        self,
+        conversation_id: int,
+        summary: Optional[str],
+        summary_tokens: int,
+        messages: List[CachedMessage],
+        complete: bool
+    ):
+        self.conversation_id = conversation_id
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        self.messages = messages
+        self.complete = complete
+        self.nbytes = (
+            _TAIL_OVERHEAD
+            + (sys.getsizeof(summary) if summary else 0)
+            + sum(m.nbytes for m in messages)
+        )
+
+    def append(self, message: CachedMessage, max_messages: int, max_tokens: int) -> int:
+        """Add the newest message, trimming the oldest past the bounds. Returns the byte delta."""
+        self.messages.append(message)
+        delta = message.nbytes
+        tokens = sum(m.tokens for m in self.messages)
+        drop = 0
+        while len(self.messages) - drop > 1 and (
+            len(self.messages) - drop > max_messages or tokens > max_tokens
+        ):
+            tokens -= self.messages[drop].tokens
+            delta -= self.messages[drop].nbytes
+            drop += 1
+        if drop:
+            del self.messages[:drop]
+            self.complete = False
+        self.nbytes += delta
+        return delta
+
+    def pack(self, token_budget: int, max_messages: int) -> Optional[List[dict]]:
+        """
+        Context entries for a budget, packed like the DB query (summary first,
+        then the newest messages that fit, newest always included).
+        None if the answer would need messages this tail doesn't hold.
+        """
+        remaining = token_budget - self.summary_tokens
+        picked = []
+        for message in reversed(self.messages):
+            if len(picked) >= max_messages:
+                break
+            if picked and message.tokens > remaining:
+                break
+            picked.append(message)
+            remaining -= message.tokens
+        else:
+            if not self.complete and len(picked) < max_messages and remaining >= 0:
+                return None
+
+        context = []
+        if self.summary:
+            context.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{self.summary}",
+                "tokens": self.summary_tokens
+            })
+        for message in reversed(picked):
+            context.append({"role": message.role, "content": message.text, "tokens": message.tokens})
+        return context
+
+
+class ConversationCache:
+    """LRU of conversation tails for this worker, bounded by total bytes"""
+
+    def __init__(self, max_bytes: int, max_messages: int, max_tokens: int):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self._tails: "OrderedDict[int, ConversationTail]" = OrderedDict()
+        # Loads in flight per conversation: [count, written during the load]
+        self._loads: Dict[int, list] = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, conversation_id: int) -> Optional[ConversationTail]:
+        tail = self._tails.get(conversation_id)
+        if tail is not None:
+            self._tails.move_to_end(conversation_id)
+        return tail
+
+    def context(self, conversation_id: int, token_budget: int, max_messages: int) -> Optional[List[dict]]:
+        """Packed context from the cached tail, or None on a miss"""
+        tail = self.get(conversation_id)
+        context = tail.pack(token_budget, max_messages) if tail is not None else None
+        if context is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return context
+
+    def begin_load(self, conversation_id: int) -> None:
+        """Call before reading a tail from the DB, then put() or end_load()"""
+        load = self._loads.setdefault(conversation_id, [0, False])
+        load[0] += 1
+
+    def end_load(self, conversation_id: int) -> bool:
+        """Finish a load; False if the conversation was written meanwhile"""
+        load = self._loads.get(conversation_id)
+        if load is None:
+            return False
+        load[0] -= 1
+        if load[0] <= 0:
+            del self._loads[conversation_id]
+        return not load[1]
+
+    def put(self, tail: ConversationTail) -> None:
+        """Install a tail read from the DB, unless a write raced the read"""
+        if not self.end_load(tail.conversation_id):
+            return
+        self._discard(tail.conversation_id)
+        if tail.nbytes > self.max_bytes:
+            return
+        self._tails[tail.conversation_id] = tail
+        self.nbytes += tail.nbytes
+        self._evict()
+
+    def append(self, conversation_id: int, message_id: int, role: str, text: str, tokens: int) -> None:
+        """A message was stored by this worker (no-op for conversations not cached)"""
+        load = self._loads.get(conversation_id)
+        if load is not None:
+            load[1] = True
+        tail = self._tails.get(conversation_id)
+        if tail is None:
+            return
+        if tail.messages and message_id <= tail.messages[-1].id:
+            # Out of order (concurrent writers): let the DB sort it out
+            self.invalidate(conversation_id)
+            return
+        self.nbytes += tail.append(CachedMessage(message_id, role, text, tokens), self.max_messages, self.max_tokens)
+        self._tails.move_to_end(conversation_id)
+        self._evict()
+
+    def invalidate(self, conversation_id: Optional[int] = None) -> None:
+        if conversation_id is None:
+            self._tails.clear()
+            self.nbytes = 0
+            for load in self._loads.values():
+                load[1] = True
+            return
+        load = self._loads.get(conversation_id)
+        if load is not None:
+            load[1] = True
+        self._discard(conversation_id)
+
+    def _discard(self, conversation_id: int) -> None:
+        tail = self._tails.pop(conversation_id, None)
+        if tail is not None:
+            self.nbytes -= tail.nbytes
+
+    def _evict(self) -> None:
+        while self.nbytes > self.max_bytes and self._tails:
+            _, tail = self._tails.popitem(last=False)
+            self.nbytes -= tail.nbytes
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "conversations": len(self._tails),
+            "messages": sum(len(t.messages) for t in self._tails.values()),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+conversation_cache = ConversationCache(
+    max_bytes=settings.CONVERSATION_CACHE_MAX_BYTES,
+    max_messages=settings.MAX_CONTEXT_MESSAGES,
+    # Enough history for the largest tier budget
+    max_tokens=max(
+        settings.FREE_TIER_CONTEXT_TOKEN_BUDGET,
+        settings.PRO_TIER_CONTEXT_TOKEN_BUDGET,
+        settings.ELITE_TIER_CONTEXT_TOKEN_BUDGET
+    )
+)
+
+
+def _on_conversation_invalidated(key: Optional[str]) -> None:
+    conversation_cache.invalidate(int(key) if key is not None else None)
+
+
+# Another worker wrote to the conversation or its summary moved: reload from the DB
+register_invalidation_handler("conversation", _on_conversation_invalidated)
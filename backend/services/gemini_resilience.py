@@ -0,0 +1,294 @@
+# backend/services/gemini_resilience.py
+
+"""
+Retries, circuit breakers, hedging and model fallback for Gemini calls.
+
+ResilientCaller.call(models, attempt) runs attempt(model) for the first
+model whose circuit is closed:
+
+- Retryable errors (429/5xx from the API, timeouts, connection errors) are
+  retried with full-jitter exponential backoff, up to GEMINI_RETRY_ATTEMPTS
+  more times per model; anything else (bad request, safety block) is raised
+  at once.
+- Each model has a circuit breaker: GEMINI_BREAKER_FAILURES retryable
+  failures in a row open it for GEMINI_BREAKER_COOLDOWN_SECONDS, then a
+  single probe decides whether it closes again. An open model is skipped.
+- When a model is out of attempts (or open) the call degrades to the next
+  model in the list, e.g. gemini-2.5-flash -> gemini-2.0-flash.
+- With GEMINI_HEDGE_ENABLED, an attempt still running after the model's
+  recent p95 latency gets a second, identical attempt; the first to succeed
+  wins and the other is cancelled (or discarded if it finished too). A hedge
+  can double upstream spend for the slowest ~5% of calls.
+
+Latency is tracked per (model, kind) since a stream's time to first chunk
+and a full reply aren't comparable. The attempt is any coroutine function,
+so tests drive this with a fake upstream.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Sequence, Tuple, TypeVar
+
+from core.config import settings
+from utils.background import spawn
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:  # SDK without api_core: fall back to status codes / builtins
+    google_exceptions = None
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class UpstreamUnavailable(Exception):
+    """Every model's circuit is open"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    if google_exceptions is not None and isinstance(error, (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.InternalServerError,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.Aborted,
+    )):
+        return True
+    code = getattr(error, "code", None)
+    return isinstance(code, int) and code in RETRYABLE_STATUS
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open (cooldown) -> half-open (one probe)"""
+
+    __slots__ = ("failure_threshold", "cooldown", "failures", "opened_at", "probing", "trips", "_clock")
+
+    def __init__(self, failure_threshold: int, cooldown: float, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.trips = 0
+        self._clock = clock
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self._clock() - self.opened_at < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.probing:
+                self.trips += 1
+            self.opened_at = self._clock()
+        self.probing = False
+
+
+class LatencyTracker:
+    """Recent latencies; quantiles over the last window samples"""
+
+    __slots__ = ("samples",)
+
+    def __init__(self, window: int = 200):
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ResilientCaller:
+    def __init__(
+        self,
+        retries: int,
+        base_delay: float,
+        max_delay: float,
+        breaker_failures: int,
+        breaker_cooldown: float,
+        hedge: bool,
+        hedge_min_delay: float,
+        hedge_min_samples: int,
+        sleep=asyncio.sleep
+    ):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_min_samples = hedge_min_samples
+        self._sleep = sleep
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latency: Dict[Tuple[str, str], LatencyTracker] = {}
+        self.retried = 0
+        self.fallbacks = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(self.breaker_failures, self.breaker_cooldown)
+        return breaker
+
+    def _tracker(self, model: str, kind: str) -> LatencyTracker:
+        tracker = self._latency.get((model, kind))
+        if tracker is None:
+            tracker = self._latency[(model, kind)] = LatencyTracker()
+        return tracker
+
+    def hedge_delay(self, model: str, kind: str) -> Optional[float]:
+        """Seconds before hedging an attempt, None when hedging is off or there's too little data"""
+        if not self.hedge:
+            return None
+        tracker = self._tracker(model, kind)
+        if len(tracker.samples) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, tracker.quantile(0.95))
+
+    def backoff(self, retry: int) -> float:
+        """Full jitter: uniform over [0, min(max_delay, base_delay * 2^retry)]"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** retry)))
+
+    async def call(
+        self,
+        models: Sequence[str],
+        attempt: Callable[[str], Awaitable[T]],
+        kind: str = "call",
+        discard: Optional[Callable[[T], Awaitable[None]]] = None
+    ) -> Tuple[T, str]:
+        """
+        Result of attempt(model) for the first model that succeeds, and that
+        model. discard(result) cleans up a hedge that lost but still finished.
+        Raises the last error, or UpstreamUnavailable if every circuit is open.
+        """
+        last_error: Optional[BaseException] = None
+        for index, model in enumerate(models):
+            breaker = self.breaker(model)
+            for retry in range(self.retries + 1):
+                if not breaker.allow():
+                    break
+                if index and not retry:
+                    self.fallbacks += 1
+                    logger.warning(f"Falling back to {model}")
+                try:
+                    result = await self._attempt(model, attempt, kind, discard)
+                except asyncio.CancelledError:
+                    # Neither a success nor a failure, but a half-open probe
+                    # must not stay claimed or the model is never tried again
+                    breaker.probing = False
+                    raise
+                except Exception as e:
+                    if not is_retryable(e):
+                        breaker.success()  # the model answered; the request was bad
+                        raise
+                    breaker.failure()
+                    last_error = e
+                    logger.warning(f"Gemini {model} attempt {retry + 1} failed: {e}")
+                    if retry < self.retries and breaker.state == "closed":
+                        self.retried += 1
+                        await self._sleep(self.backoff(retry))
+                    continue
+                breaker.success()
+                return result, model
+        if last_error is None:
+            raise UpstreamUnavailable(f"No Gemini model available (circuits open: {', '.join(models)})")
+        raise last_error
+
+    async def _attempt(self, model: str, attempt, kind: str, discard) -> T:
+        tracker = self._tracker(model, kind)
+        delay = self.hedge_delay(model, kind)
+        started = time.monotonic()
+        if delay is None:
+            result = await attempt(model)
+            tracker.add(time.monotonic() - started)
+            return result
+
+        first = asyncio.ensure_future(attempt(model))
+        tasks = [first]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedges += 1
+                tasks.append(asyncio.ensure_future(attempt(model)))
+            pending = list(tasks)
+            while winner is None:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((t for t in done if t.exception() is None), None)
+                pending = [t for t in pending if t not in done]
+                if winner is None and not pending:
+                    raise first.exception()  # every attempt failed
+            tracker.add(time.monotonic() - started)
+            if winner is not first:
+                self.hedge_wins += 1
+            return winner.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif task is not winner and discard is not None \
+                        and not task.cancelled() and task.exception() is None:
+                    # The loser finished too: let the caller close it
+                    spawn(discard(task.result()), name="discard-hedge")
+
+    def stats(self) -> dict:
+        return {
+            "retried": self.retried,
+            "fallbacks": self.fallbacks,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "breakers": {
+                model: {"state": b.state, "failures": b.failures, "trips": b.trips}
+                for model, b in self._breakers.items()
+            },
+            "p95_ms": {
+                f"{model}:{kind}": round(t.quantile(0.95) * 1000, 1)
+                for (model, kind), t in self._latency.items() if t.samples
+            },
+        }
+
+
+gemini_resilience = ResilientCaller(
+    retries=settings.GEMINI_RETRY_ATTEMPTS,
+    base_delay=settings.GEMINI_RETRY_BASE_DELAY_SECONDS,
+    max_delay=settings.GEMINI_RETRY_MAX_DELAY_SECONDS,
+    breaker_failures=settings.GEMINI_BREAKER_FAILURES,
+    breaker_cooldown=settings.GEMINI_BREAKER_COOLDOWN_SECONDS,
+    hedge=settings.GEMINI_HEDGE_ENABLED,
+    hedge_min_delay=settings.GEMINI_HEDGE_MIN_DELAY_MS / 1000,
+    hedge_min_samples=settings.GEMINI_HEDGE_MIN_SAMPLES
+)
@@ -1,14 +1,31 @@
 # backend/services/gemini_service.py
 
 import os
-from typing import AsyncGenerator, List, Optional, Any
+import asyncio
+import functools
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from typing import AsyncGenerator, AsyncIterator, Iterable, List, Optional, Tuple, Any
 import google.generativeai as genai
+from google.generativeai.types import content_types, generation_types
 from core.config import settings
-from db.queries import log_api_usage
+from services.api_key_pool import ApiKey, api_key_pool
+from services.context_cache import CachedPrefix, context_cache
+from services.gemini_resilience import gemini_resilience
+from services.generation_scheduler import Admission, generation_scheduler
+from services.model_registry import ModelRegistry
+from services.response_cache import replay_chunks, response_cache
+from services.usage_counters import QuotaReservation, usage_counters
+from services.usage_log_writer import usage_log_writer
+from services.user_context_service import DEFAULT_MODEL, MODEL_BY_TIER, fallback_chain, resolve_user_context
+from utils.tokens import estimate_tokens
 
 # Gemini 2.0 Flash pricing (Nov 2024)
 GEMINI_FLASH_INPUT_COST = 0.000075 / 1000   # $ per token
 GEMINI_FLASH_OUTPUT_COST = 0.0003 / 1000    # $ per token
+GEMINI_FLASH_CACHED_INPUT_COST = GEMINI_FLASH_INPUT_COST / 4  # tokens served from a context cache
 
 # Configure the API key explicitly
 if settings.GOOGLE_API_KEY:
@@ -22,12 +39,17 @@ else:
 # others only expose top-level generate_content. Provide a minimal shim that
 # gives the same interface used in this module.
 class _ChatShim:
-    def __init__(self, model_name: str, history: List[dict]):
+    def __init__(self, model_name: str, history: List[dict],
+                 generation_config: Optional[dict] = None, system_instruction: Optional[str] = None):
         self.model_name = model_name
         self.history = history or []
+        self.generation_config = generation_config
+        self.system_instruction = system_instruction
 
     def _build_prompt(self, prompt: str) -> str:
         parts: List[str] = []
+        if self.system_instruction:
+            parts.append(f"System: {self.system_instruction}")
         for msg in self.history:
             role = msg.get("role", "user")
             for p in msg.get("parts", []):
@@ -37,6 +59,7 @@ class _ChatShim:
 
     def send_message(self, prompt: str, generation_config: Optional[dict] = None, stream: bool = False):
         full_prompt = self._build_prompt(prompt)
+        generation_config = generation_config or self.generation_config
         try:
             # Try the modern call signature
             return genai.generate_content(prompt=full_prompt, model=self.model_name,
@@ -47,13 +70,19 @@ class _ChatShim:
 
 
 class _ModelShim:
-    def __init__(self, model_name: str):
+    def __init__(self, model_name: str, generation_config: Optional[dict] = None,
+                 system_instruction: Optional[str] = None):
         self.model_name = model_name
+        self.generation_config = generation_config
+        self.system_instruction = system_instruction
 
     def start_chat(self, history: Optional[List[dict]] = None):
-        return _ChatShim(self.model_name, history or [])
+        return _ChatShim(self.model_name, history or [], self.generation_config, self.system_instruction)
 
     def generate_content(self, prompt: str, generation_config: Optional[dict] = None, stream: bool = False):
+        generation_config = generation_config or self.generation_config
+        if self.system_instruction:
+            prompt = f"{self.system_instruction}\n\n{prompt}"
         try:
             return genai.generate_content(prompt=prompt, model=self.model_name,
                                           generation_config=generation_config, stream=stream)
@@ -61,97 +90,528 @@ class _ModelShim:
             return genai.generate_content(self.model_name, prompt, generation_config=generation_config, stream=stream)
 
 
-def _get_model(name: str):
+class _KeyedChat:
+    """One chat turn on a _KeyedModel: the history plus the new message"""
+
+    def __init__(self, model: "_KeyedModel", history: Optional[List[dict]] = None):
+        self.model = model
+        self.history = history or []
+
+    def _contents(self, prompt: str) -> List[dict]:
+        return [*self.history, {"role": "user", "parts": [prompt]}]
+
+    def send_message(self, prompt: str, generation_config: Optional[dict] = None, stream: bool = False):
+        return self.model.generate_content(self._contents(prompt), generation_config=generation_config, stream=stream)
+
+    async def send_message_async(self, prompt: str, generation_config: Optional[dict] = None, stream: bool = False):
+        return await self.model.generate_content_async(
+            self._contents(prompt), generation_config=generation_config, stream=stream
+        )
+
+
+class _KeyedModel:
+    """
+    GenerativeModel's generate_content surface on one API key's clients.
+    GenerativeModel only talks to the process-wide default clients (one key),
+    so requests are built with the SDK's public types and sent on the key's
+    own generativelanguage clients instead.
+    """
+
+    def __init__(self, model_name: str, clients: Tuple[Any, Any], generation_config: Optional[dict] = None,
+                 system_instruction: Optional[str] = None, cached_content: Optional[str] = None):
+        self.model_name = model_name if "/" in model_name else f"models/{model_name}"
+        self.client, self.async_client = clients
+        self.generation_config = generation_types.to_generation_config_dict(generation_config or {})
+        self.system_instruction = content_types.to_content(system_instruction) if system_instruction else None
+        self.cached_content = cached_content
+
+    def start_chat(self, history: Optional[List[dict]] = None) -> _KeyedChat:
+        return _KeyedChat(self, history)
+
+    def _request(self, contents, generation_config: Optional[dict]):
+        contents = content_types.to_contents(contents)
+        if contents and not contents[-1].role:
+            contents[-1].role = "user"
+        return genai.protos.GenerateContentRequest(
+            model=self.model_name,
+            contents=contents,
+            generation_config={**self.generation_config, **generation_types.to_generation_config_dict(generation_config or {})},
+            system_instruction=self.system_instruction,
+            cached_content=self.cached_content,
+        )
+
+    def generate_content(self, contents, generation_config: Optional[dict] = None, stream: bool = False):
+        request = self._request(contents, generation_config)
+        if stream:
+            with generation_types.rewrite_stream_error():
+                iterator = self.client.stream_generate_content(request)
+            return generation_types.GenerateContentResponse.from_iterator(iterator)
+        return generation_types.GenerateContentResponse.from_response(self.client.generate_content(request))
+
+    async def generate_content_async(self, contents, generation_config: Optional[dict] = None, stream: bool = False):
+        request = self._request(contents, generation_config)
+        if stream:
+            with generation_types.rewrite_stream_error():
+                iterator = await self.async_client.stream_generate_content(request)
+            return await generation_types.AsyncGenerateContentResponse.from_aiterator(iterator)
+        response = await self.async_client.generate_content(request)
+        return generation_types.AsyncGenerateContentResponse.from_response(response)
+
+
+def _build_model(name: str, generation_config: Optional[dict] = None,
+                 system_instruction: Optional[str] = None, key_index: int = 0,
+                 cached_content: Optional[str] = None):
     """
-    Return either the SDK's GenerativeModel (if present) or the shim.
+    Construct a model on one API key's SDK clients, or the shim when the SDK
+    is too old for them. Generation config, system instruction, API key and
+    context cache are baked into the model (the shim only knows the globally
+    configured key and no caches).
     """
-    Model = getattr(genai, "GenerativeModel", None)
-    if Model:
+    if getattr(genai, "GenerativeModel", None):
         try:
-            return Model(name)
+            return _KeyedModel(name, api_key_pool.clients(api_key_pool.keys[key_index]),
+                               generation_config, system_instruction, cached_content)
         except Exception:
-            # fallback to shim if constructing SDK model fails
-            return _ModelShim(name)
-    return _ModelShim(name)
+            # fallback to shim if constructing the model fails
+            pass
+    return _ModelShim(name, generation_config, system_instruction)
+
+
+# Generation settings shared by every request; built once, never per call.
+DEFAULT_GENERATION_CONFIG = {
+    "temperature": 0.7,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+}
+TITLE_GENERATION_CONFIG = {"temperature": 0.3, "max_output_tokens": 20}
+TITLE_BATCH_GENERATION_CONFIG = {
+    "temperature": 0.3,
+    "max_output_tokens": 32 * settings.TITLE_BATCH_MAX_SIZE,
+    "response_mime_type": "application/json",
+}
+TITLE_MODEL = "gemini-2.5-flash"
+SUMMARY_GENERATION_CONFIG = {"temperature": 0.2, "max_output_tokens": settings.SUMMARY_MAX_TOKENS}
+SUMMARY_MODEL = "gemini-2.5-flash"
+
+# Models handed out by the tier -> model routing in user_context_service.
+ROUTED_MODELS = tuple(sorted({DEFAULT_MODEL, *MODEL_BY_TIER.values()}))
+
+model_registry = ModelRegistry(_build_model, settings.GEMINI_MODEL_REGISTRY_MAX_ENTRIES)
+
+
+def _get_model(name: str, generation_config: Optional[dict] = None,
+               system_instruction: Optional[str] = None, key: Optional[ApiKey] = None):
+    """
+    Return the shared model object for these settings (and API key, default
+    the first) from the registry.
+    """
+    return model_registry.get(name, generation_config, system_instruction, key.index if key else 0)
+
+
+async def warm_up_models() -> None:
+    """
+    Pre-build the routed models, and each API key's SDK clients with them.
+    Call from the app's startup so the first chat turn skips the setup cost;
+    the async clients bind to the running event loop. Chat models carry the
+    system prompt as their system instruction.
+    """
+    from services.memory_service import build_system_prompt  # memory_service imports this module
+    system_prompt = await build_system_prompt()
+    try:
+        for key in api_key_pool.keys:
+            model_registry.warm_up(ROUTED_MODELS, DEFAULT_GENERATION_CONFIG, system_prompt, key_index=key.index)
+            model_registry.warm_up([TITLE_MODEL], TITLE_GENERATION_CONFIG, key_index=key.index)
+    except Exception as e:
+        # Older SDKs without the client manager just build clients lazily
+        print(f"[Gemini warm-up] {e}")
+
+
+# --- Async dispatch --------------------------------------------------------
+# The SDK's GenerativeModel / ChatSession expose *_async variants backed by the
+# grpc.aio client. The shims (and any older SDK) only have blocking calls, so
+# those run on a bounded thread pool and never on the event loop itself.
+_executor = ThreadPoolExecutor(
+    max_workers=settings.GEMINI_MAX_WORKERS,
+    thread_name_prefix="gemini"
+)
+
+_STREAM_DONE = object()
+# Chunks read ahead of the consumer; past this the worker thread waits
+_STREAM_BUFFER = 8
+
+
+async def _run_blocking(fn, *args, **kwargs):
+    """Run a blocking SDK call on the Gemini thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def _iterate_blocking(iterable: Iterable) -> AsyncIterator[Any]:
+    """
+    Drain a blocking iterator on the thread pool, handing items back to the
+    event loop through a bounded asyncio.Queue: a slow consumer holds the
+    worker thread back instead of buffering the whole reply. Closing the async
+    iterator stops the worker after its current item and closes the upstream
+    iterator, which releases the SDK stream and the pool thread.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=_STREAM_BUFFER)
+    stop = threading.Event()
+
+    def _put(entry) -> None:
+        asyncio.run_coroutine_threadsafe(queue.put(entry), loop).result()
+
+    def _produce():
+        try:
+            for item in iterable:
+                _put((item, None))
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            if not stop.is_set():
+                _put((_STREAM_DONE, e))
+            return
+        finally:
+            # Generators can only be closed from the thread running them
+            close = getattr(iterable, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    print(f"[Stream close error] {e}")
+        if not stop.is_set():
+            _put((_STREAM_DONE, None))
+
+    producer = loop.run_in_executor(_executor, _produce)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is _STREAM_DONE:
+                if error is not None:
+                    raise error
+                break
+            yield item
+    finally:
+        stop.set()
+        # gRPC response iterators can be cancelled from any thread, which also
+        # wakes a worker blocked on the next read
+        cancel = getattr(iterable, "cancel", None)
+        if callable(cancel) and not producer.done():
+            try:
+                cancel()
+            except Exception as e:
+                print(f"[Stream cancel error] {e}")
+        # Free the buffer so a worker blocked on a full queue sees `stop`
+        while not queue.empty():
+            queue.get_nowait()
+        if producer.done():
+            producer.exception()  # already forwarded through the queue
+
+
+async def _send(model, prompt: str, history: Optional[List[dict]],
+                generation_config: Optional[dict] = None, stream: bool = False):
+    """
+    Issue a generation request without blocking the event loop.
+    Uses the SDK's async API when the model object has one, otherwise the
+    blocking call runs on the thread pool.
+    """
+    if history is not None:
+        target = model.start_chat(history=history)
+        method = "send_message"
+    else:
+        target = model
+        method = "generate_content"
+
+    async_fn = getattr(target, f"{method}_async", None)
+    if async_fn is not None:
+        return await async_fn(prompt, generation_config=generation_config, stream=stream)
+    return await _run_blocking(getattr(target, method), prompt,
+                               generation_config=generation_config, stream=stream)
+
+
+async def _iter_chunks(response) -> AsyncIterator[Any]:
+    """Iterate a streaming response, whether the SDK returned an async or sync iterator."""
+    if hasattr(response, "__aiter__"):
+        async for chunk in response:
+            yield chunk
+    else:
+        # Close the worker right away rather than whenever the generator is collected
+        async with aclosing(_iterate_blocking(response)) as chunks:
+            async for chunk in chunks:
+                yield chunk
 
 
 # --- Core functions --------------------------------------------------------
 
+async def _route(user_id: Optional[str], model_name: Optional[str], tier: Optional[str]) -> Tuple[str, str]:
+    """
+    Model and tier for this call. Routes already resolved both through
+    UserContext; other callers get a one-off resolution from the user's tier.
+    """
+    if model_name and tier:
+        return model_name, tier
+    if not user_id:
+        return model_name or DEFAULT_MODEL, tier or "free"
+    ctx = await resolve_user_context(user_id)
+    return model_name or ctx.model_name, tier or ctx.tier
+
+
+def _split_context(context: Optional[List[dict]]) -> Tuple[Optional[str], Optional[List[dict]]]:
+    """
+    System instruction and SDK chat history from context entries (all but the
+    current message). The leading system prompt becomes the model's
+    system_instruction; later system entries (summary, recalled memories)
+    stay in the history as before.
+    """
+    if not context:
+        return None, None
+    entries = context[:-1]
+    system_instruction = None
+    if entries and entries[0].get("role") == "system":
+        system_instruction = entries[0].get("content") or None
+        entries = entries[1:]
+    return system_instruction, [
+        {"role": "user" if msg.get("role") == "user" else "model", "parts": [msg.get("content", "")]}
+        for msg in entries
+    ]
+
+
+def _cached_model(prefix: CachedPrefix, generation_config: Optional[dict]):
+    """
+    Model object reading its system instruction and older history from a
+    context cache; None if only the shim is available (it can't use one).
+    """
+    config_key = json.dumps(generation_config or {}, sort_keys=True)
+    model = prefix.models.get(config_key)
+    if model is None:
+        model = _build_model(prefix.model, generation_config, None, prefix.key.index, cached_content=prefix.name)
+        if isinstance(model, _ModelShim):
+            return None
+        prefix.models[config_key] = model
+    return model
+
+
+def _model_for(name: str, generation_config: Optional[dict], system_instruction: Optional[str],
+               history: Optional[List[dict]], key: ApiKey) -> Tuple[Any, Optional[List[dict]]]:
+    """
+    Model for one request on a leased key, and the history still to send:
+    with a cached prefix only what comes after it.
+    """
+    prefix, rest = context_cache.lookup(name, key, system_instruction, history)
+    if prefix is not None:
+        model = _cached_model(prefix, generation_config)
+        if model is not None:
+            return model, rest
+    return _get_model(name, generation_config, system_instruction, key=key), history
+
+
+def _input_cost(input_tokens: int, usage) -> float:
+    """Cost of a request's input tokens; those read from a context cache are cheaper"""
+    cached = min(input_tokens, int(getattr(usage, "cached_content_token_count", 0) or 0))
+    return (input_tokens - cached) * GEMINI_FLASH_INPUT_COST + cached * GEMINI_FLASH_CACHED_INPUT_COST
+
+
+def _usage_tokens(response) -> Optional[int]:
+    """Total tokens from a response's usage metadata, None if it has none"""
+    try:
+        total = getattr(getattr(response, "usage_metadata", None), "total_token_count", None)
+    except Exception:
+        return None
+    return int(total) if total else None
+
+
+async def _generate(model_name: str, generation_config: dict, prompt: str,
+                    history: Optional[List[dict]] = None, estimated_tokens: int = 0,
+                    system_instruction: Optional[str] = None):
+    """One non-streaming request on a key leased from the API key pool"""
+    estimated_tokens = estimated_tokens or estimate_tokens(prompt)
+    key = api_key_pool.acquire(estimated_tokens)
+    try:
+        model, history = _model_for(model_name, generation_config, system_instruction, history, key)
+        response = await _send(model, prompt, history)
+    except BaseException as e:
+        api_key_pool.release(key, estimated_tokens=estimated_tokens, error=e)
+        raise
+    api_key_pool.release(key, tokens=_usage_tokens(response), estimated_tokens=estimated_tokens)
+    return response
+
+
+_NOTHING = object()
+
+
+class _LeasedStream:
+    """
+    A streaming response's chunks on a leased API key. prefetch() waits for
+    the first chunk; the lease ends (with the real token usage, or the error)
+    when the chunks run out, fail or the stream is closed.
+    """
+
+    __slots__ = ("key", "estimated_tokens", "response", "_chunks", "_first", "_error", "_closed")
+
+    def __init__(self, key: ApiKey, estimated_tokens: int, response):
+        self.key = key
+        self.estimated_tokens = estimated_tokens
+        self.response = response
+        # response is an async iterator for the SDK's async API and a
+        # blocking iterator for the shims; _iter_chunks keeps both off the loop.
+        self._chunks = _iter_chunks(response)
+        self._first = _NOTHING
+        self._error: Optional[BaseException] = None
+        self._closed = False
+
+    async def prefetch(self) -> None:
+        try:
+            self._first = await self._next()
+        except StopAsyncIteration:
+            pass
+
+    async def _next(self):
+        try:
+            return await self._chunks.__anext__()
+        except StopAsyncIteration:
+            await self.aclose()
+            raise
+        except BaseException as e:
+            self._error = e
+            await self.aclose()
+            raise
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first is not _NOTHING:
+            chunk, self._first = self._first, _NOTHING
+            return chunk
+        if self._closed:
+            raise StopAsyncIteration
+        return await self._next()
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            await self._chunks.aclose()
+        finally:
+            api_key_pool.release(
+                self.key, tokens=_usage_tokens(self.response),
+                estimated_tokens=self.estimated_tokens, error=self._error
+            )
+
+
+async def _open_stream(model_name: str, prompt: str, history: Optional[List[dict]], estimated_tokens: int,
+                       system_instruction: Optional[str] = None):
+    """(response, chunks, model) for a stream that has produced its first chunk"""
+    async def attempt(name: str) -> _LeasedStream:
+        key = api_key_pool.acquire(estimated_tokens)
+        try:
+            model, rest = _model_for(name, DEFAULT_GENERATION_CONFIG, system_instruction, history, key)
+            response = await _send(model, prompt, rest, stream=True)
+        except BaseException as e:
+            api_key_pool.release(key, estimated_tokens=estimated_tokens, error=e)
+            raise
+        stream = _LeasedStream(key, estimated_tokens, response)
+        await stream.prefetch()
+        return stream
+
+    async def discard(stream: _LeasedStream):
+        await stream.aclose()
+
+    stream, model_name = await gemini_resilience.call(
+        fallback_chain(model_name), attempt, kind="stream", discard=discard
+    )
+    return stream.response, stream, model_name
+
+
+def estimate_generation_cost(prompt: str, context: Optional[List[dict]] = None) -> float:
+    """
+    Upper-bound cost of one generation, reserved against the monthly limit
+    before calling Gemini: the prompt and context, plus a full-length reply.
+    """
+    input_tokens = estimate_tokens(prompt) + _context_tokens(context)
+    output_tokens = DEFAULT_GENERATION_CONFIG["max_output_tokens"]
+    return input_tokens * GEMINI_FLASH_INPUT_COST + output_tokens * GEMINI_FLASH_OUTPUT_COST
+
+
+def _context_tokens(context: Optional[List[dict]]) -> int:
+    """Tokens in context entries, using the counts stored with each message"""
+    return sum(
+        m.get("tokens") or estimate_tokens(str(m.get("content", "")))
+        for m in context or ()
+    )
+
+
+def _log_usage(
+    user_id: str,
+    conversation_id: Optional[int],
+    input_tokens: int,
+    output_tokens: int,
+    cost: float,
+    reservation: Optional[QuotaReservation]
+) -> None:
+    """
+    Queue the usage row and count the cost in this worker right away:
+    settle the request's reservation with the real cost, or just count it.
+    Other workers hear about it once the batched row is written.
+    """
+    usage_log_writer.record(user_id, conversation_id, input_tokens, output_tokens, cost)
+    # A reservation released first (stream cancelled) no longer counts anything
+    if reservation is None or not reservation.settle(cost, notify=False):
+        usage_counters.record_cost(user_id, cost, notify=False)
+
+
 async def generate_ai_response(
     prompt: str,
     context: Optional[List[dict]] = None,
     user_id: Optional[str] = None,
-    conversation_id: Optional[int] = None
+    conversation_id: Optional[int] = None,
+    model_name: Optional[str] = None,
+    reservation: Optional[QuotaReservation] = None,
+    tier: Optional[str] = None,
+    admission: Optional[Admission] = None
 ) -> dict:
     """
     Non-streaming generation helper.
+    Pass model_name and tier from the request's UserContext; when omitted they
+    are resolved from the user here. A quota reservation taken by the caller
+    is settled with the real cost from usage_metadata. The call waits for a
+    slot in the generation scheduler unless the caller already holds one.
+    A reply from the response cache costs nothing: no slot, no usage row,
+    and the reservation is released.
     Returns dict: { text, input_tokens, output_tokens, total_tokens, cost, model }
     """
-    # Choose model based on user's plan: 'pro' -> gemini-2.5-flash (text-only)
-    # 'premuim' -> gemini-2.5-flash-lite (text + tts / multimodal)
-    model_name = "gemini-2.0-flash"
-    plan = None
-    # Prefer subscription stored in DB; avoids circular imports
-    if user_id:
-        try:
-            from db.database import get_db_pool
-            pool = await get_db_pool()
-            async with pool.acquire() as conn:
-                row = await conn.fetchrow(
-                    "SELECT plan, status FROM subscriptions WHERE user_id = $1 LIMIT 1",
-                    user_id
-                )
-                if row and row.get("status") == "active":
-                    plan = row.get("plan")
-        except Exception:
-            plan = None
-
-    # If user has plan info, pick corresponding model
-    normalized_plan = plan.lower() if isinstance(plan, str) else None
-    premium_plan_names = {"premuim", "premium", "tier2", "tier_2"}
-    pro_plan_names = {"pro", "tier1", "tier_1"}
-    if normalized_plan in premium_plan_names:
-        model_name = "gemini-2.5-flash-lite"
-    elif normalized_plan in pro_plan_names:
-        model_name = "gemini-2.5-flash"
-    else:
-        # Fallback: if DB indicates premium via is_premium flag, prefer tts
-        try:
-            from db.queries import get_user_by_id
-            if user_id:
-                u = None
-                try:
-                    u = await get_user_by_id(user_id)
-                except Exception:
-                    u = None
-                if u and u.get("is_premium"):
-                    model_name = "gemini-2.5-flash-lite"
-                else:
-                    model_name = "gemini-2.5-flash"
-        except Exception:
-            # Keep default if anything goes wrong
-            model_name = model_name
+    model_name, tier = await _route(user_id, model_name, tier)
+    cache_key = response_cache.key(model_name, prompt, context, DEFAULT_GENERATION_CONFIG)
+    cached = response_cache.get(cache_key, tier)
+    if cached is not None:
+        if reservation is not None:
+            reservation.release()
+        return {
+            "text": cached.text,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "total_tokens": 0,
+            "cost": 0.0,
+            "model": cached.model
+        }
+
+    owns_admission = admission is None
+    if owns_admission:
+        admission = await generation_scheduler.acquire(user_id, tier)
+
+    # Some model shims use generate_content (history None); shim handles it.
+    system_instruction, history = _split_context(context)
 
-    model = _get_model(model_name)
-    generation_config = {
-        "temperature": 0.7,
-        "top_p": 0.95,
-        "top_k": 40,
-        "max_output_tokens": 8192,
-    }
+    estimated_tokens = estimate_tokens(prompt) + _context_tokens(context)
+
+    async def attempt(name: str):
+        return await _generate(name, DEFAULT_GENERATION_CONFIG, prompt, history, estimated_tokens, system_instruction)
 
     try:
-        if context:
-            history = [
-                {"role": "user" if msg.get("role") == "user" else "model",
-                 "parts": [msg.get("content", "")]}
-                for msg in context[:-1]
-            ]
-            chat = model.start_chat(history=history)
-            response = chat.send_message(prompt, generation_config=generation_config, stream=False)
-        else:
-            # Some model shims use generate_content; shim handles it.
-            response = model.generate_content(prompt, generation_config=generation_config)  # type: ignore
+        # Retried / hedged / degraded along the model's fallback chain
+        response, model_name = await gemini_resilience.call(fallback_chain(model_name), attempt)
 
         # Safe extraction of text and usage metadata
         text = getattr(response, "text", None)
@@ -166,15 +626,12 @@ async def generate_ai_response(
         input_tokens = int(getattr(usage, "prompt_token_count", 0) or 0)
         output_tokens = int(getattr(usage, "candidates_token_count", 0) or 0)
         total_tokens = int(getattr(usage, "total_token_count", input_tokens + output_tokens) or (input_tokens + output_tokens))
-        total_cost = input_tokens * GEMINI_FLASH_INPUT_COST + output_tokens * GEMINI_FLASH_OUTPUT_COST
+        total_cost = _input_cost(input_tokens, usage) + output_tokens * GEMINI_FLASH_OUTPUT_COST
+        response_cache.put(cache_key, text, input_tokens, output_tokens, total_cost, model_name)
 
         # Log usage if available
         if user_id and conversation_id:
-            try:
-                await log_api_usage(user_id, conversation_id, input_tokens, output_tokens, total_cost)
-            except Exception as e:
-                # don't fail the request just because logging broke
-                print(f"[log_api_usage error] {e}")
+            _log_usage(user_id, conversation_id, input_tokens, output_tokens, total_cost, reservation)
 
         return {
             "text": text,
@@ -188,6 +645,35 @@ async def generate_ai_response(
     except Exception as e:
         print(f"[Gemini API Error] {e}")
         raise Exception(f"AI generation failed: {e}")
+    finally:
+        if owns_admission:
+            admission.release()
+
+
+def _title_prompt(first_message: str) -> str:
+    return (
+        f'Generate a short, concise title (max 6 words) for a conversation that starts with:\n'
+        f'"{first_message[:100]}"\n\nReturn ONLY the title, nothing else.'
+    )
+
+
+def _title_cache_key(first_message: str) -> Optional[str]:
+    return response_cache.key(TITLE_MODEL, _title_prompt(first_message), generation_config=TITLE_GENERATION_CONFIG)
+
+
+def _cache_title(first_message: str, title: str, response, share: int = 1) -> None:
+    """Keep a generated title; a batch's usage is split evenly over its titles"""
+    usage = getattr(response, "usage_metadata", None)
+    input_tokens = int(getattr(usage, "prompt_token_count", 0) or 0) // share
+    output_tokens = int(getattr(usage, "candidates_token_count", 0) or 0) // share
+    cost = input_tokens * GEMINI_FLASH_INPUT_COST + output_tokens * GEMINI_FLASH_OUTPUT_COST
+    response_cache.put(_title_cache_key(first_message), title, input_tokens, output_tokens, cost, TITLE_MODEL)
+
+
+def cached_title(first_message: str) -> Optional[str]:
+    """Title from the response cache, None on a miss (or with the cache off)"""
+    cached = response_cache.get(_title_cache_key(first_message), "titles")
+    return cached.text if cached is not None else None
 
 
 async def generate_conversation_title(first_message: str) -> str:
@@ -195,138 +681,190 @@ async def generate_conversation_title(first_message: str) -> str:
     Generate a concise title for a conversation (fallbacks to truncation on error).
     """
     # Use text-only flash model for title generation
-    model = _get_model("gemini-2.5-flash")
-    prompt = (
-        f'Generate a short, concise title (max 6 words) for a conversation that starts with:\n'
-        f'"{first_message[:100]}"\n\nReturn ONLY the title, nothing else.'
-    )
+    prompt = _title_prompt(first_message)
 
     try:
-        response = model.generate_content(prompt, generation_config={"temperature": 0.3, "max_output_tokens": 20})  # type: ignore
+        response = await _generate(TITLE_MODEL, TITLE_GENERATION_CONFIG, prompt)
         title = getattr(response, "text", None)
         if title is None:
             title = str(response)
-        title = title.strip().strip('"').strip("'")
-        return title[:50]
+        title = _clean_title(title)
+        _cache_title(first_message, title, response)
+        return title
     except Exception as e:
         print(f"[Title generation error] {e}")
-        return (first_message[:40] + "...") if len(first_message) > 40 else first_message
+        return _fallback_title(first_message)
+
+
+def _clean_title(title: str) -> str:
+    return title.strip().strip('"').strip("'")[:50]
+
+
+def _fallback_title(first_message: str) -> str:
+    return (first_message[:40] + "...") if len(first_message) > 40 else first_message
+
+
+async def generate_conversation_titles(first_messages: List[str]) -> List[str]:
+    """
+    Titles for several conversations in one request (see TitleBatcher).
+    Raises if the reply isn't a JSON array with one title per message, so
+    the caller can fall back to generate_conversation_title.
+    """
+    numbered = "\n".join(f"{i + 1}. {json.dumps(m[:100])}" for i, m in enumerate(first_messages))
+    prompt = (
+        f'Generate a short, concise title (max 6 words) for each of these {len(first_messages)} '
+        f'conversations, given the message each one starts with:\n{numbered}\n\n'
+        f'Return ONLY a JSON array of {len(first_messages)} strings, in the same order.'
+    )
+
+    response = await _generate(TITLE_MODEL, TITLE_BATCH_GENERATION_CONFIG, prompt)
+    text = getattr(response, "text", None)
+    if text is None:
+        text = str(response)
+    titles = json.loads(text)
+    if not isinstance(titles, list) or len(titles) != len(first_messages):
+        raise ValueError(f"expected {len(first_messages)} titles, got {text[:200]!r}")
+    results = []
+    for t, m in zip(titles, first_messages):
+        if isinstance(t, str) and t.strip():
+            t = _clean_title(t)
+            _cache_title(m, t, response, share=len(first_messages))
+        else:
+            t = _fallback_title(m)
+        results.append(t)
+    return results
+
+
+async def generate_conversation_summary(
+    previous_summary: Optional[str],
+    messages: List[dict],
+    user_id: Optional[str] = None,
+    conversation_id: Optional[int] = None
+) -> str:
+    """
+    Fold messages ({role, content}) into a conversation's rolling summary.
+    Usage is logged like any other call. Raises on failure; the previous
+    summary stays in place.
+    """
+    transcript = "\n".join(
+        f"{'User' if m.get('role') == 'user' else 'Assistant'}: {m.get('content', '')}"
+        for m in messages
+    )
+    prompt = (
+        "You maintain a running summary of a conversation between a user and an AI assistant.\n"
+        f"Current summary:\n{previous_summary or '(none yet)'}\n\n"
+        f"New messages:\n{transcript}\n\n"
+        "Rewrite the summary to include the new messages. Keep facts, names, numbers, "
+        "decisions, the user's goals and preferences, and open questions. "
+        "Be concise. Return ONLY the summary."
+    )
+
+    response = await _generate(SUMMARY_MODEL, SUMMARY_GENERATION_CONFIG, prompt)
+    summary = getattr(response, "text", None)
+    if summary is None:
+        summary = str(response)
+
+    if user_id and conversation_id:
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            input_tokens = int(getattr(usage, "prompt_token_count", 0) or 0)
+            output_tokens = int(getattr(usage, "candidates_token_count", 0) or 0)
+        else:
+            input_tokens = estimate_tokens(prompt)
+            output_tokens = estimate_tokens(summary)
+        total_cost = input_tokens * GEMINI_FLASH_INPUT_COST + output_tokens * GEMINI_FLASH_OUTPUT_COST
+        _log_usage(user_id, conversation_id, input_tokens, output_tokens, total_cost, None)
+
+    return summary.strip()
 
 
 async def generate_ai_response_stream(
     prompt: str,
     context: Optional[List[dict]] = None,
     user_id: Optional[str] = None,
-    conversation_id: Optional[int] = None
+    conversation_id: Optional[int] = None,
+    model_name: Optional[str] = None,
+    reservation: Optional[QuotaReservation] = None,
+    tier: Optional[str] = None,
+    admission: Optional[Admission] = None
 ) -> AsyncGenerator[str, None]:
     """
     Stream AI response chunks as they arrive.
     Yields text chunks (strings). On error yields an error string chunk.
+    A quota reservation is settled once usage is known; if the stream fails
+    the caller releases it. Closing or cancelling the generator stops the
+    upstream request and logs (estimated) usage for what was generated, once
+    the stream was open.
+    Routes take the scheduler slot up front (so a full queue is still an HTTP
+    error) and pass it as admission; otherwise it is taken here.
+    A reply from the response cache is replayed in chunks without calling
+    Gemini; the reservation is released and no usage is logged.
     """
-    # Choose model similarly to non-streaming path
-    model_name = "gemini-2.0-flash"
-    plan = None
-    if user_id:
-        try:
-            from db.database import get_db_pool
-            pool = await get_db_pool()
-            async with pool.acquire() as conn:
-                row = await conn.fetchrow(
-                    "SELECT plan, status FROM subscriptions WHERE user_id = $1 LIMIT 1",
-                    user_id
-                )
-                if row and row.get("status") == "active":
-                    plan = row.get("plan")
-        except Exception:
-            plan = None
-
-    normalized_plan = plan.lower() if isinstance(plan, str) else None
-    if normalized_plan in {"premium", "premuim", "elite", "tier2", "tier_2"}:
-        model_name = "gemini-2.5-flash-lite"
-    elif normalized_plan in {"pro", "tier1", "tier_1"}:
-        model_name = "gemini-2.5-flash"
-    else:
-        try:
-            from db.queries import get_user_by_id
-            if user_id:
-                u = None
-                try:
-                    u = await get_user_by_id(user_id)
-                except Exception:
-                    u = None
-                if u and u.get("is_premium"):
-                    model_name = "gemini-2.5-flash-lite"
-                else:
-                    model_name = "gemini-2.5-flash"
-        except Exception:
-            model_name = model_name
-
-    model = _get_model(model_name)
-    generation_config = {
-        "temperature": 0.7,
-        "top_p": 0.95,
-        "top_k": 40,
-        "max_output_tokens": 8192,
-    }
-
-    full_response = ""
+    model_name, tier = await _route(user_id, model_name, tier)
+    cache_key = response_cache.key(model_name, prompt, context, DEFAULT_GENERATION_CONFIG)
+    cached = response_cache.get(cache_key, tier)
+    if cached is not None:
+        if reservation is not None:
+            reservation.release()
+        for piece in replay_chunks(cached.text):
+            yield piece
+        return
+
+    owns_admission = admission is None
+    if owns_admission:
+        admission = await generation_scheduler.acquire(user_id, tier)
+
+    parts: List[str] = []
     input_tokens = 0
     output_tokens = 0
+    logged = failed = opened = False
+    system_instruction, history = _split_context(context)
 
     try:
-        if context:
-            history = [
-                {"role": "user" if msg.get("role") == "user" else "model", "parts": [msg.get("content", "")]}
-                for msg in context[:-1]
-            ]
-            chat = model.start_chat(history=history)
-            response_stream = chat.send_message(prompt, generation_config=generation_config, stream=True)
-        else:
-            response_stream = model.generate_content(prompt, generation_config=generation_config, stream=True)
-
-        # response_stream may be an iterator/generator or an async iterator depending on SDK.
-        # Try to iterate synchronously first; if that fails, attempt async iteration.
-        try:
-            iterator = iter(response_stream)
-        except TypeError:
-            # Maybe an async iterator
-            iterator = None
-
-        if iterator is not None:
-            for chunk in iterator:
+        # Only opening the stream (up to its first chunk) is retried, hedged
+        # or degraded: once text has gone out a retry would repeat it.
+        response_stream, chunks, model_name = await _open_stream(
+            model_name, prompt, history, estimate_tokens(prompt) + _context_tokens(context), system_instruction
+        )
+        opened = True
+
+        async with aclosing(chunks):
+            async for chunk in chunks:
                 text = getattr(chunk, "text", None)
                 if text is None:
                     text = str(chunk)
-                full_response += text
-                yield text
-        else:
-            # async iteration
-            async for chunk in response_stream:  # type: ignore
-                text = getattr(chunk, "text", None)
-                if text is None:
-                    text = str(chunk)
-                full_response += text
+                parts.append(text)
                 yield text
 
         # After streaming, try to extract usage metadata and log it
         usage_metadata = getattr(response_stream, "usage_metadata", None)
-        if user_id and conversation_id:
-            if usage_metadata:
-                input_tokens = int(getattr(usage_metadata, "prompt_token_count", 0) or 0)
-                output_tokens = int(getattr(usage_metadata, "candidates_token_count", 0) or 0)
-                total_cost = input_tokens * GEMINI_FLASH_INPUT_COST + output_tokens * GEMINI_FLASH_OUTPUT_COST
-            else:
-                # Best-effort estimate when metadata isn't provided
-                input_tokens = int(len(prompt.split()) * 1.3)
-                output_tokens = int(len(full_response.split()) * 1.3)
-                total_cost = input_tokens * GEMINI_FLASH_INPUT_COST + output_tokens * GEMINI_FLASH_OUTPUT_COST
+        if usage_metadata:
+            input_tokens = int(getattr(usage_metadata, "prompt_token_count", 0) or 0)
+            output_tokens = int(getattr(usage_metadata, "candidates_token_count", 0) or 0)
+        else:
+            # Best-effort estimate when metadata isn't provided
+            input_tokens = estimate_tokens(prompt) + _context_tokens(context[:-1] if context else None)
+            output_tokens = estimate_tokens("".join(parts))
+        total_cost = _input_cost(input_tokens, usage_metadata) + output_tokens * GEMINI_FLASH_OUTPUT_COST
+        response_cache.put(cache_key, "".join(parts), input_tokens, output_tokens, total_cost, model_name)
 
-            try:
-                await log_api_usage(user_id, conversation_id, input_tokens, output_tokens, total_cost)
-            except Exception as e:
-                print(f"[log_api_usage error] {e}")
+        if user_id and conversation_id:
+            _log_usage(user_id, conversation_id, input_tokens, output_tokens, total_cost, reservation)
+            logged = True
 
     except Exception as e:
+        failed = True
         err = f"\n\n[Error: {e}]"
         print(f"[Streaming error] {e}")
-        yield err
\ No newline at end of file
+        yield err
+
+    finally:
+        if owns_admission:
+            admission.release()
+        if opened and not logged and not failed and user_id and conversation_id:
+            # Stopped early (client gone): bill the prompt and what was generated.
+            # Cancelled before the stream opened, nothing reached Gemini to bill
+            input_tokens = estimate_tokens(prompt) + _context_tokens(context[:-1] if context else None)
+            output_tokens = estimate_tokens("".join(parts))
+            total_cost = input_tokens * GEMINI_FLASH_INPUT_COST + output_tokens * GEMINI_FLASH_OUTPUT_COST
+            _log_usage(user_id, conversation_id, input_tokens, output_tokens, total_cost, reservation)
\ No newline at end of file
@@ -0,0 +1,195 @@
+# backend/services/generation_scheduler.py
+
+"""
+Admission control for upstream (Gemini) generations in this worker.
+
+At most GENERATION_MAX_CONCURRENT generations run at once. Past that,
+callers wait in one queue per tier; each freed slot goes to a tier by
+smooth weighted round robin on the tier's generation_weight (elite > pro >
+free), so paid traffic keeps moving during a free-tier spike without
+starving free users outright. How many streams one user may run is the
+rate limiter's concurrent-stream slot, taken before this.
+
+Nothing piles up: a full queue, or a wait longer than
+GENERATION_QUEUE_TIMEOUT_SECONDS, raises SchedulerRejected at once (the
+routes answer 503). Queue depth and wait times are in stats() (/health/caches).
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Optional
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SchedulerRejected(Exception):
+    """No generation slot: the queue is full ("queue_full") or the wait timed out ("timeout")"""
+
+    def __init__(self, reason: str, tier: str, retry_after: int):
+        super().__init__(f"Generation rejected ({reason}) for tier {tier}")
+        self.reason = reason
+        self.tier = tier
+        self.retry_after = retry_after
+
+
+class Admission:
+    """A running generation's slot; release() is idempotent and never awaits"""
+
+    __slots__ = ("scheduler", "tier", "_released")
+
+    def __init__(self, scheduler: "GenerationScheduler", tier: str):
+        self.scheduler = scheduler
+        self.tier = tier
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.scheduler._release(self)
+
+    async def __aenter__(self) -> "Admission":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        self.release()
+
+
+class _TierQueue:
+    __slots__ = ("weight", "waiters", "current", "admitted", "wait_total", "wait_max")
+
+    def __init__(self, weight: int):
+        self.weight = max(1, weight)
+        self.waiters: Deque[asyncio.Future] = deque()
+        self.current = 0  # smooth weighted round robin state
+        self.admitted = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class GenerationScheduler:
+    def __init__(
+        self,
+        tier_config: Dict[str, dict],
+        max_concurrent: int,
+        max_queue: int,
+        queue_timeout: float
+    ):
+        self.tier_config = tier_config
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._queues: Dict[str, _TierQueue] = {}
+        for config in tier_config.values():
+            self._queues.setdefault(config["tier_name"], _TierQueue(config["generation_weight"]))
+        self.active = 0
+        self.queued = 0
+        self.rejected = {"queue_full": 0, "timeout": 0}
+
+    def _config_for(self, tier: Optional[str]) -> dict:
+        return self.tier_config.get(tier) or self.tier_config["free"]
+
+    async def acquire(self, user_id: Optional[str], tier: Optional[str]) -> Admission:
+        """
+        Wait for a generation slot.
+
+        Raises:
+            SchedulerRejected: If the queue is full or the wait times out
+        """
+        tier_name = self._config_for(tier)["tier_name"]
+        queue = self._queues[tier_name]
+        if self.active < self.max_concurrent and not self.queued:
+            return self._admit(queue, tier_name, 0.0)
+        if self.queued >= self.max_queue:
+            self.rejected["queue_full"] += 1
+            raise self._rejected("queue_full", tier_name)
+
+        waiter = asyncio.get_running_loop().create_future()
+        queue.waiters.append(waiter)
+        self.queued += 1
+        started = time.monotonic()
+        try:
+            await asyncio.wait({waiter}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            self._leave(queue, waiter)
+            raise
+
+        if not waiter.done():
+            self._leave(queue, waiter)
+            self.rejected["timeout"] += 1
+            logger.warning(f"Generation queue wait timed out for user {user_id} ({tier_name})")
+            raise self._rejected("timeout", tier_name)
+        # _dispatch already counted it as active
+        return self._admit(queue, tier_name, time.monotonic() - started, counted=True)
+
+    def _leave(self, queue: _TierQueue, waiter: asyncio.Future) -> None:
+        """A waiter gave up (timeout or cancelled)"""
+        if waiter.done():
+            # Granted just as it gave up: pass the slot on
+            self.active -= 1
+            self._dispatch()
+        else:
+            waiter.cancel()
+            queue.waiters.remove(waiter)
+            self.queued -= 1
+
+    def _admit(self, queue: _TierQueue, tier_name: str, waited: float, counted: bool = False) -> Admission:
+        if not counted:
+            self.active += 1
+        queue.admitted += 1
+        queue.wait_total += waited
+        queue.wait_max = max(queue.wait_max, waited)
+        return Admission(self, tier_name)
+
+    def _rejected(self, reason: str, tier_name: str) -> SchedulerRejected:
+        return SchedulerRejected(reason, tier_name, retry_after=max(1, round(self.queue_timeout)))
+
+    def _release(self, admission: Admission) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Hand free slots to waiters, picking tiers by smooth weighted round robin"""
+        while self.active < self.max_concurrent and self.queued:
+            waiting = [q for q in self._queues.values() if q.waiters]
+            total = sum(q.weight for q in waiting)
+            for q in waiting:
+                q.current += q.weight
+            queue = max(waiting, key=lambda q: q.current)
+            queue.current -= total
+            waiter = queue.waiters.popleft()
+            self.queued -= 1
+            self.active += 1
+            waiter.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "max_concurrent": self.max_concurrent,
+            "queued": self.queued,
+            "rejected": dict(self.rejected),
+            "tiers": {
+                name: {
+                    "queued": len(q.waiters),
+                    "admitted": q.admitted,
+                    "avg_wait_ms": round(q.wait_total / q.admitted * 1000, 1) if q.admitted else 0.0,
+                    "max_wait_ms": round(q.wait_max * 1000, 1),
+                }
+                for name, q in self._queues.items()
+            },
+        }
+
+
+generation_scheduler = GenerationScheduler(
+    {
+        "free": {"tier_name": "free", "generation_weight": settings.FREE_TIER_GENERATION_WEIGHT},
+        "pro": {"tier_name": "pro", "generation_weight": settings.PRO_TIER_GENERATION_WEIGHT},
+        "elite": {"tier_name": "elite", "generation_weight": settings.ELITE_TIER_GENERATION_WEIGHT},
+    },
+    max_concurrent=settings.GENERATION_MAX_CONCURRENT,
+    max_queue=settings.GENERATION_MAX_QUEUE,
+    queue_timeout=settings.GENERATION_QUEUE_TIMEOUT_SECONDS
+)
@@ -0,0 +1,200 @@
+# backend/services/invalidation_service.py
+
+"""
+Cross-worker cache invalidation over Postgres LISTEN/NOTIFY.
+
+Writers call publish_invalidation(entity, key). Handlers registered for the
+entity run immediately in the publishing worker, and a NOTIFY on
+CHANNEL reaches every other worker's listener connection, which runs the
+same handlers there. A handler receives the key, or None meaning "drop
+everything for this entity" (sent after the listener reconnects, since
+notifications may have been missed while it was down).
+
+A notification can also carry data for handlers registered with
+register_update_handler (e.g. a counter delta), so other workers update
+their copy in place instead of dropping it. Entities without an update
+handler, and the reconnect reset, still go through the invalidation handlers.
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from db.database import get_db_pool
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "cache_invalidation"
+RECONNECT_DELAY_SECONDS = 5
+
+# Identifies this worker so it can skip its own notifications
+WORKER_ID = uuid.uuid4().hex
+
+_handlers: Dict[str, List[Callable[[Optional[str]], None]]] = defaultdict(list)
+_updaters: Dict[str, List[Callable[[str, dict], None]]] = defaultdict(list)
+
+
+def register_invalidation_handler(entity: str, handler: Callable[[Optional[str]], None]) -> None:
+    """Run handler(key) whenever `entity` is invalidated in any worker"""
+    if handler not in _handlers[entity]:
+        _handlers[entity].append(handler)
+
+
+def register_update_handler(entity: str, handler: Callable[[str, dict], None]) -> None:
+    """Run handler(key, data) for notifications about `entity` that carry data"""
+    if handler not in _updaters[entity]:
+        _updaters[entity].append(handler)
+
+
+def invalidate_local(entity: str, key: Optional[str]) -> None:
+    """Apply an invalidation to this worker's caches only"""
+    for handler in _handlers.get(entity, ()):
+        try:
+            handler(key)
+        except Exception as e:
+            logger.error(f"Invalidation handler for {entity} failed: {e}", exc_info=True)
+
+
+def update_local(entity: str, key: str, data: dict) -> None:
+    """Apply an update to this worker's caches; evicts if nobody handles updates"""
+    handlers = _updaters.get(entity)
+    if not handlers:
+        invalidate_local(entity, key)
+        return
+    for handler in handlers:
+        try:
+            handler(key, data)
+        except Exception as e:
+            logger.error(f"Update handler for {entity} failed: {e}", exc_info=True)
+
+
+def _invalidate_all() -> None:
+    for entity in list(_handlers):
+        invalidate_local(entity, None)
+
+
+def invalidation_notice(entity: str, key: str, data: Optional[dict] = None) -> Tuple[str, str]:
+    """
+    (channel, payload) for other workers, for writers that send the NOTIFY
+    themselves as part of their own statement (delivered on commit).
+    With data, other workers apply it as an update instead of evicting.
+    """
+    message = {"e": entity, "k": str(key), "o": WORKER_ID}
+    if data is not None:
+        message["d"] = data
+    return CHANNEL, json.dumps(message)
+
+
+async def publish_invalidation(entity: str, key: str, local: bool = True) -> None:
+    """
+    Evict (entity, key) here and notify every other worker.
+    local=False skips this worker (it already updated its own copy).
+    A failed NOTIFY is logged, not raised: the write that triggered it has
+    already happened and other workers' entries still expire by TTL.
+    """
+    key = str(key)
+    if local:
+        invalidate_local(entity, key)
+    await _notify(entity, key, None)
+
+
+async def publish_update(entity: str, key: str, data: dict) -> None:
+    """
+    Send an update for (entity, key) to every other worker; the caller has
+    already applied it here. Failures are logged like publish_invalidation's.
+    """
+    await _notify(entity, str(key), data)
+
+
+async def _notify(entity: str, key: str, data: Optional[dict]) -> None:
+    channel, payload = invalidation_notice(entity, key, data)
+    try:
+        pool = await get_db_pool()
+        async with pool.acquire() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", channel, payload)
+    except Exception as e:
+        logger.warning(f"Could not publish invalidation {entity}:{key}: {e}")
+
+
+def _on_notification(connection, pid, channel, payload) -> None:
+    try:
+        message = json.loads(payload)
+    except (TypeError, ValueError):
+        logger.warning(f"Ignoring malformed invalidation payload: {payload!r}")
+        return
+    if message.get("o") == WORKER_ID:
+        return  # already applied when we published it
+    data = message.get("d")
+    if isinstance(data, dict) and message.get("k") is not None:
+        update_local(message.get("e", ""), message["k"], data)
+    else:
+        invalidate_local(message.get("e", ""), message.get("k"))
+
+
+class InvalidationListener:
+    """Holds one pooled connection LISTENing on CHANNEL, reconnecting on loss"""
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = asyncio.Event()
+        self.connected = False
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._stopping.clear()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._stopping.set()
+        if self._task is not None:
+            # Released pool connections are reset (UNLISTEN *) by asyncpg
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        first = True
+        while not self._stopping.is_set():
+            lost = asyncio.Event()
+            try:
+                pool = await get_db_pool()
+                async with pool.acquire() as conn:
+                    conn.add_termination_listener(lambda c: lost.set())
+                    await conn.add_listener(CHANNEL, _on_notification)
+                    self.connected = True
+                    if not first:
+                        # Anything published while we were away was missed
+                        _invalidate_all()
+                    first = False
+                    logger.info(f"Listening for cache invalidations on '{CHANNEL}'")
+                    await _wait_first(self._stopping, lost)
+                    self.connected = False
+                    if not conn.is_closed():
+                        await conn.remove_listener(CHANNEL, _on_notification)
+            except Exception as e:
+                self.connected = False
+                first = False
+                logger.warning(f"Invalidation listener error: {e}")
+            if not self._stopping.is_set():
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), RECONNECT_DELAY_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+
+
+async def _wait_first(*events: asyncio.Event) -> None:
+    waiters = [asyncio.create_task(e.wait()) for e in events]
+    try:
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for w in waiters:
+            w.cancel()
+
+
+invalidation_listener = InvalidationListener()
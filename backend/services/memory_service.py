@@ -1,43 +1,228 @@
 # backend/app/services/memory_service.py
 
-from db.queries import get_conversation_messages
+import asyncio
+import logging
+from typing import Optional, Set
+from core.config import settings
+from db.queries import (
+    get_unsummarized_messages,
+    get_user_messages_by_ids,
+    upsert_conversation_summary
+)
+from services.conversation_cache import CachedMessage, ConversationTail, conversation_cache
+from services.gemini_service import generate_conversation_summary
+from services.invalidation_service import invalidation_listener, publish_invalidation
+from services.vector_memory import vector_memory
+from utils.background import spawn
+from utils.tokens import estimate_tokens
 
+logger = logging.getLogger(__name__)
 
-async def get_conversation_context(conversation_id: int, max_messages: int = 20):
-    """
-    Get recent messages for AI context
-    Gemini 2.0 Flash has 1M token context window, so we can be generous
-    """
+# Retrieved past messages are cut to this many characters
+MEMORY_SNIPPET_CHARS = 400
+
+# Conversations with a summary update in flight (this worker)
+_summarizing: Set[int] = set()
+
+# Tokens of history (system prompt included) sent with each turn, per tier
+CONTEXT_TOKEN_BUDGETS = {
+    "free": settings.FREE_TIER_CONTEXT_TOKEN_BUDGET,
+    "pro": settings.PRO_TIER_CONTEXT_TOKEN_BUDGET,
+    "elite": settings.ELITE_TIER_CONTEXT_TOKEN_BUDGET,
+}
+
+
+def context_token_budget(tier: Optional[str]) -> int:
+    """Context budget for a tier (free tier's if unknown)"""
+    return CONTEXT_TOKEN_BUDGETS.get(tier or "free", CONTEXT_TOKEN_BUDGETS["free"])
+
+
+async def _fetch_context_rows(
+    conversation_id: int,
+    token_budget: int,
+    max_messages: int,
+    include_summary: bool
+):
     from db.database import get_db_pool
-    
+
     pool = await get_db_pool()
     async with pool.acquire() as conn:
-        rows = await conn.fetch(
+        return await conn.fetch(
             """
-            SELECT role, message_text, created_at
-            FROM messages
-            WHERE conversation_id = $1
-            ORDER BY created_at DESC
-            LIMIT $2
+            WITH summary AS (
+                SELECT summary, token_count, summarized_through_id
+                FROM conversation_summaries
+                WHERE conversation_id = $1 AND $4
+            ), recent AS (
+                SELECT id, role, message_text, created_at,
+                       COALESCE(token_count, CEIL(LENGTH(message_text) / 4.0)::INT) AS token_count
+                FROM messages
+                WHERE conversation_id = $1
+                AND id > COALESCE((SELECT summarized_through_id FROM summary), 0)
+                ORDER BY created_at DESC, id DESC
+                LIMIT $3
+            ), packed AS (
+                SELECT id, role, message_text, created_at, token_count,
+                       SUM(token_count) OVER newest_first AS running_tokens,
+                       ROW_NUMBER() OVER newest_first AS position
+                FROM recent
+                WINDOW newest_first AS (ORDER BY created_at DESC, id DESC)
+            )
+            SELECT is_summary, id, role, message_text, token_count,
+                   (SELECT COUNT(*) FROM recent) AS recent_count
+            FROM (
+                SELECT TRUE AS is_summary, 'system' AS role, summary AS message_text, token_count,
+                       NULL::TIMESTAMP AS created_at, 0 AS id
+                FROM summary
+                UNION ALL
+                SELECT FALSE, role, message_text, token_count, created_at, id
+                FROM packed
+                WHERE running_tokens <= $2 - COALESCE((SELECT token_count FROM summary), 0)
+                OR position = 1
+            ) context
+            ORDER BY is_summary DESC, created_at, id
             """,
             conversation_id,
-            max_messages
+            token_budget,
+            max_messages,
+            include_summary
         )
+
+
+def _tail_from_rows(conversation_id: int, rows, max_messages: int) -> ConversationTail:
+    summary, summary_tokens, messages = None, 0, []
+    for row in rows:
+        if row["is_summary"]:
+            summary, summary_tokens = row["message_text"], row["token_count"]
+        else:
+            messages.append(CachedMessage(row["id"], row["role"], row["message_text"], row["token_count"]))
+    recent_count = rows[0]["recent_count"] if rows else 0
+    # Every message after the summary came back
+    complete = len(messages) == recent_count < max_messages
+    return ConversationTail(conversation_id, summary, summary_tokens, messages, complete)
+
+
+async def get_conversation_context(
+    conversation_id: int,
+    token_budget: Optional[int] = None,
+    max_messages: Optional[int] = None,
+    include_summary: bool = True
+):
+    """
+    Get AI context: the conversation's rolling summary (if any) followed by
+    the newest messages after it whose stored token counts fit in what is
+    left of token_budget. The newest message is always included.
+    Entries carry their token count so callers never re-tokenize history.
+
+    Served from this worker's conversation tail cache when it holds enough
+    history; otherwise one query reads the tail (sized for the largest
+    budget, so later turns hit) and caches it.
+    """
+    token_budget = context_token_budget(None) if token_budget is None else token_budget
+    max_messages = max_messages or settings.MAX_CONTEXT_MESSAGES
+    # Only safe while we hear about other workers' writes
+    use_cache = (
+        settings.CONVERSATION_CACHE_ENABLED
+        and include_summary
+        and max_messages == conversation_cache.max_messages
+        and invalidation_listener.connected
+    )
+
+    if use_cache:
+        context = conversation_cache.context(conversation_id, token_budget, max_messages)
+        if context is not None:
+            return context
+
+        conversation_cache.begin_load(conversation_id)
+        try:
+            rows = await _fetch_context_rows(
+                conversation_id,
+                max(token_budget, conversation_cache.max_tokens),
+                max_messages,
+                True
+            )
+        except BaseException:
+            conversation_cache.end_load(conversation_id)
+            raise
+        tail = _tail_from_rows(conversation_id, rows, max_messages)
+        conversation_cache.put(tail)
+        context = tail.pack(token_budget, max_messages)
+        if context is not None:
+            return context
+
+    rows = await _fetch_context_rows(conversation_id, token_budget, max_messages, include_summary)
     
-    # Reverse to get chronological order
-    messages = [dict(r) for r in reversed(rows)]
-    
-    # Format for Gemini API
+    # Format for Gemini API (rows are already in chronological order)
     context = []
-    for msg in messages:
+    for msg in rows:
+        content = msg["message_text"]
+        if msg["is_summary"]:
+            content = f"Summary of the earlier conversation:\n{content}"
         context.append({
             "role": msg["role"],
-            "content": msg["message_text"]
+            "content": content,
+            "tokens": msg["token_count"]
         })
     
     return context
 
 
+def _summary_batch(messages: list) -> list:
+    """Oldest pending messages, capped so a backlog is folded in over several runs"""
+    cap = settings.SUMMARY_TRIGGER_TOKENS * 2
+    batch, tokens = [], 0
+    for m in messages:
+        if batch and tokens + m["token_count"] > cap:
+            break
+        batch.append(m)
+        tokens += m["token_count"]
+    return batch
+
+
+async def update_conversation_summary(conversation_id: int) -> bool:
+    """
+    Fold older messages into the conversation's rolling summary once enough
+    of them (SUMMARY_TRIGGER_TOKENS) have piled up beyond the newest
+    SUMMARY_KEEP_RECENT_MESSAGES. Returns True if the summary was updated.
+    """
+    state = await get_unsummarized_messages(conversation_id, settings.SUMMARY_KEEP_RECENT_MESSAGES)
+    if not state or not state["messages"]:
+        return False
+    if sum(m["token_count"] for m in state["messages"]) < settings.SUMMARY_TRIGGER_TOKENS:
+        return False
+
+    batch = _summary_batch(state["messages"])
+    summary = await generate_conversation_summary(
+        state["summary"],
+        [{"role": m["role"], "content": m["message_text"]} for m in batch],
+        str(state["user_id"]),
+        conversation_id
+    )
+    if not summary:
+        return False
+    await upsert_conversation_summary(conversation_id, summary, estimate_tokens(summary), batch[-1]["id"])
+    # Cached tails (every worker) still hold the summarized messages
+    await publish_invalidation("conversation", conversation_id)
+    return True
+
+
+async def _run_summary_update(conversation_id: int) -> None:
+    try:
+        await update_conversation_summary(conversation_id)
+    except Exception as e:
+        logger.warning(f"Summary update failed for conversation {conversation_id}: {e}")
+    finally:
+        _summarizing.discard(conversation_id)
+
+
+def schedule_summary_update(conversation_id: int) -> None:
+    """Update the summary in the background (at most one run per conversation at a time)"""
+    if conversation_id in _summarizing:
+        return
+    _summarizing.add(conversation_id)
+    spawn(_run_summary_update(conversation_id), name=f"conversation-summary-{conversation_id}")
+
+
 async def build_system_prompt() -> str:
     """
     Build system prompt for consistent AI behavior
@@ -52,16 +237,87 @@ Guidelines:
 - Ask clarifying questions when needed"""
 
 
-async def format_conversation_for_context(conversation_id: int) -> list:
+async def recall_memories(
+    user_id: str,
+    query: str,
+    conversation_id: Optional[int],
+    token_budget: int
+) -> Optional[dict]:
+    """
+    Context entry with the user's past messages (from other conversations)
+    most similar to query, within token_budget. None if nothing relevant.
+    """
+    hits = await vector_memory.search(
+        user_id,
+        query,
+        settings.VECTOR_MEMORY_TOP_K,
+        exclude_conversation_id=conversation_id,
+        min_score=settings.VECTOR_MEMORY_MIN_SCORE
+    )
+    if not hits:
+        return None
+    rows = {r["id"]: r for r in await get_user_messages_by_ids(user_id, [h[0] for h in hits])}
+
+    header = "Possibly relevant excerpts from the user's earlier conversations:"
+    lines, tokens = [], estimate_tokens(header)
+    for message_id, _, _ in hits:
+        row = rows.get(message_id)
+        if not row:
+            continue  # deleted since it was indexed
+        text = " ".join(row["message_text"].split())
+        if len(text) > MEMORY_SNIPPET_CHARS:
+            text = text[:MEMORY_SNIPPET_CHARS] + "..."
+        line = f"- ({'User' if row['role'] == 'user' else 'Assistant'}) {text}"
+        line_tokens = estimate_tokens(line)
+        if tokens + line_tokens > token_budget:
+            break
+        lines.append(line)
+        tokens += line_tokens
+    if not lines:
+        return None
+    return {"role": "system", "content": "\n".join([header] + lines), "tokens": tokens}
+
+
+async def format_conversation_for_context(
+    conversation_id: int,
+    token_budget: Optional[int] = None,
+    user_id: Optional[str] = None,
+    query: Optional[str] = None
+) -> list:
     """
-    Format conversation with system prompt for better context
+    Format conversation with system prompt for better context.
+    token_budget (see context_token_budget) covers the system prompt too.
+    With user_id and query (the new message), relevant snippets from the
+    user's other conversations are recalled alongside the history.
     """
     system_prompt = await build_system_prompt()
-    conversation_history = await get_conversation_context(conversation_id)
+    system_tokens = estimate_tokens(system_prompt)
+    token_budget = context_token_budget(None) if token_budget is None else token_budget
+
+    memory_budget = 0
+    if settings.VECTOR_MEMORY_ENABLED and user_id and query:
+        memory_budget = min(settings.VECTOR_MEMORY_MAX_TOKENS, token_budget // 4)
+
+    history_task = get_conversation_context(
+        conversation_id,
+        max(0, token_budget - system_tokens - memory_budget)
+    )
+    if memory_budget:
+        conversation_history, memories = await asyncio.gather(
+            history_task,
+            recall_memories(user_id, query, conversation_id, memory_budget)
+        )
+    else:
+        conversation_history, memories = await history_task, None
     
-    # Add system prompt at the beginning
+    # Add system prompt at the beginning. Recalled memories change every turn,
+    # so they go just before the new message: everything ahead of them stays
+    # a stable prefix (see context_cache).
     full_context = [
-        {"role": "system", "content": system_prompt}
-    ] + conversation_history
+        {"role": "system", "content": system_prompt, "tokens": system_tokens}
+    ]
+    full_context += conversation_history
+    if memories:
+        full_context.insert(max(1, len(full_context) - 1), memories)
     
     return full_context
\ No newline at end of file
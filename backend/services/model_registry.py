@@ -0,0 +1,118 @@
+# backend/services/model_registry.py
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+RegistryKey = Tuple[str, tuple, Optional[str], int]
+
+
+def _freeze(value: Any) -> Any:
+    """Turn a (possibly nested) generation config dict into a hashable tuple."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+class _Entry:
+    __slots__ = ("model", "created_at", "hits")
+
+    def __init__(self, model: Any):
+        self.model = model
+        self.created_at = time.time()
+        self.hits = 0
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of pre-built model objects.
+
+    Entries are keyed by (model name, generation config, system instruction,
+    API key index) so every chat turn with the same settings reuses one model
+    object instead of constructing a new one. The factory does the actual
+    construction. At most max_entries are kept; the least recently used go
+    first (the system instruction is part of the key, so edits add entries).
+    """
+
+    def __init__(self, factory: Callable[[str, Optional[dict], Optional[str], int], Any],
+                 max_entries: int = 64):
+        self._factory = factory
+        self._entries: "OrderedDict[RegistryKey, _Entry]" = OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model_name: str, generation_config: Optional[dict] = None,
+                 system_instruction: Optional[str] = None, key_index: int = 0) -> RegistryKey:
+        return (model_name, _freeze(generation_config or {}), system_instruction, key_index)
+
+    def get(self, model_name: str, generation_config: Optional[dict] = None,
+            system_instruction: Optional[str] = None, key_index: int = 0) -> Any:
+        """Return the shared model for these settings, building it on first use."""
+        key = self.make_key(model_name, generation_config, system_instruction, key_index)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            entry = self._add(key, _Entry(self._factory(model_name, generation_config, system_instruction, key_index)))
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        entry.hits += 1
+        return entry.model
+
+    def _add(self, key: RegistryKey, entry: _Entry) -> _Entry:
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return entry
+
+    def warm_up(self, model_names: Iterable[str], generation_config: Optional[dict] = None,
+                system_instruction: Optional[str] = None, key_index: int = 0) -> List[RegistryKey]:
+        """Pre-build models so the first request doesn't pay construction cost."""
+        keys = []
+        for name in model_names:
+            key = self.make_key(name, generation_config, system_instruction, key_index)
+            if key not in self._entries:
+                self._add(key, _Entry(self._factory(name, generation_config, system_instruction, key_index)))
+            keys.append(key)
+        return keys
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """Describe cached entries (for inspection/debug endpoints)."""
+        return [
+            {
+                "model": key[0],
+                "generation_config": dict(key[1]),
+                "system_instruction_chars": len(key[2]) if key[2] else 0,
+                "api_key": key[3],
+                "hits": entry.hits,
+                "age_seconds": round(time.time() - entry.created_at, 1),
+                "type": type(entry.model).__name__,
+            }
+            for key, entry in self._entries.items()
+        ]
+
+    def evict(self, model_name: Optional[str] = None) -> int:
+        """Drop entries for one model name (or all of them). Returns count removed."""
+        if model_name is None:
+            removed = len(self._entries)
+            self._entries.clear()
+            return removed
+        keys = [k for k in self._entries if k[0] == model_name]
+        for k in keys:
+            del self._entries[k]
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,207 @@
+# backend/services/rate_limit_backend.py
+
+"""
+Shared request-rate state for the rate limiter.
+
+Two primitives, both atomic per key:
+- take_token: token bucket (capacity = burst, refilled continuously), used
+  for messages per minute.
+- acquire_slot / release_slot: sliding window of expiring leases, used for
+  concurrent streams. A lease that is never released (worker crash, client
+  gone before the body started) drops out of the window when it expires.
+
+InMemoryRateLimitBackend keeps state in this worker only. RedisRateLimitBackend
+runs the same algorithms as Lua scripts on any Redis-protocol server, so limits
+hold across workers and nodes. Pick one with RATE_LIMIT_BACKEND ("memory" or
+"redis", with REDIS_URL).
+"""
+
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from core.config import settings
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "rx:rl:"
+
+
+class RateLimitBackend(ABC):
+    """Interface for rate limit state"""
+
+    name = "base"
+
+    @abstractmethod
+    async def take_token(self, key: str, capacity: float, refill_per_second: float, cost: float = 1) -> Tuple[bool, float]:
+        """Take `cost` tokens from the bucket; returns (allowed, retry_after_seconds)"""
+
+    @abstractmethod
+    async def acquire_slot(self, key: str, limit: int, slot_id: str, lease_seconds: float) -> bool:
+        """Hold one of `limit` slots until released or lease_seconds pass"""
+
+    @abstractmethod
+    async def release_slot(self, key: str, slot_id: str) -> None:
+        """Give a slot back before its lease expires"""
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemoryRateLimitBackend(RateLimitBackend):
+    """Per-worker state. Fine for a single worker; limits are per process otherwise."""
+
+    name = "memory"
+
+    def __init__(self, max_keys: int = 100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()  # key -> [tokens, updated_at]
+        self._slots: Dict[str, Dict[str, float]] = {}  # key -> {slot_id: expires_at}
+
+    async def take_token(self, key: str, capacity: float, refill_per_second: float, cost: float = 1) -> Tuple[bool, float]:
+        now = self._clock()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = [capacity, now]
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * refill_per_second)
+            bucket[1] = now
+
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return True, 0.0
+        return False, (cost - bucket[0]) / refill_per_second if refill_per_second > 0 else float("inf")
+
+    async def acquire_slot(self, key: str, limit: int, slot_id: str, lease_seconds: float) -> bool:
+        now = self._clock()
+        slots = self._slots.setdefault(key, {})
+        for expired in [s for s, expires_at in slots.items() if expires_at <= now]:
+            del slots[expired]
+        if len(slots) >= limit:
+            return False
+        slots[slot_id] = now + lease_seconds
+        return True
+
+    async def release_slot(self, key: str, slot_id: str) -> None:
+        slots = self._slots.get(key)
+        if slots is not None:
+            slots.pop(slot_id, None)
+            if not slots:
+                del self._slots[key]
+
+
+# KEYS[1] = bucket hash; ARGV = capacity, refill per second, cost.
+# Uses the server clock so every worker sees the same time.
+_TOKEN_BUCKET_LUA = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil then
+    tokens = capacity
+    ts = now
+end
+if now > ts then
+    tokens = math.min(capacity, tokens + (now - ts) * rate)
+    ts = now
+end
+
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+elseif rate > 0 then
+    retry_after = (cost - tokens) / rate
+else
+    retry_after = -1
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(ts))
+if rate > 0 then
+    redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+end
+return {allowed, tostring(retry_after)}
+"""
+
+# KEYS[1] = sorted set of slot_id -> lease expiry (ms); ARGV = limit, slot_id, lease ms
+_ACQUIRE_SLOT_LUA = """
+local limit = tonumber(ARGV[1])
+local lease = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= limit then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + lease, ARGV[2])
+local ttl = redis.call('PTTL', KEYS[1])
+if ttl < lease then
+    redis.call('PEXPIRE', KEYS[1], lease)
+end
+return 1
+"""
+
+
+class RedisRateLimitBackend(RateLimitBackend):
+    """Fleet-wide state on a Redis-protocol server (Redis, Valkey, fakeredis in tests)"""
+
+    name = "redis"
+
+    def __init__(self, url: Optional[str] = None, client=None):
+        if client is None:
+            try:
+                import redis.asyncio as redis_asyncio
+            except ImportError as e:
+                raise RuntimeError("RATE_LIMIT_BACKEND=redis requires the 'redis' package") from e
+            if not url:
+                raise RuntimeError("RATE_LIMIT_BACKEND=redis requires REDIS_URL")
+            client = redis_asyncio.from_url(url)
+        self._client = client
+        self._token_bucket = client.register_script(_TOKEN_BUCKET_LUA)
+        self._acquire_slot = client.register_script(_ACQUIRE_SLOT_LUA)
+
+    async def take_token(self, key: str, capacity: float, refill_per_second: float, cost: float = 1) -> Tuple[bool, float]:
+        allowed, retry_after = await self._token_bucket(
+            keys=[KEY_PREFIX + "tb:" + key],
+            args=[capacity, refill_per_second, cost]
+        )
+        retry_after = float(retry_after)
+        return bool(allowed), (float("inf") if retry_after < 0 else retry_after)
+
+    async def acquire_slot(self, key: str, limit: int, slot_id: str, lease_seconds: float) -> bool:
+        acquired = await self._acquire_slot(
+            keys=[KEY_PREFIX + "slots:" + key],
+            args=[limit, slot_id, int(lease_seconds * 1000)]
+        )
+        return bool(acquired)
+
+    async def release_slot(self, key: str, slot_id: str) -> None:
+        await self._client.zrem(KEY_PREFIX + "slots:" + key, slot_id)
+
+    async def close(self) -> None:
+        close = getattr(self._client, "aclose", None) or self._client.close
+        await close()
+
+
+def get_rate_limit_backend() -> RateLimitBackend:
+    """Backend selected by settings.RATE_LIMIT_BACKEND"""
+    kind = (settings.RATE_LIMIT_BACKEND or "memory").lower()
+    if kind == "redis":
+        return RedisRateLimitBackend(settings.REDIS_URL)
+    if kind != "memory":
+        logger.warning(f"Unknown RATE_LIMIT_BACKEND '{kind}', using in-memory limits")
+    return InMemoryRateLimitBackend()
@@ -0,0 +1,157 @@
+# backend/services/response_cache.py
+
+"""
+Exact-match cache of Gemini replies for turns with little or no history.
+
+A large share of traffic is the same first message ("hi", "what can you
+do?"), and each costs a full generation. With RESPONSE_CACHE_ENABLED a reply
+is kept for RESPONSE_CACHE_TTL_SECONDS under a hash of everything that shapes
+it: model, system entries (system prompt and any recalled memories), the
+conversation before the prompt, the prompt and the generation config. Text
+is compared with whitespace collapsed; nothing else is normalized.
+
+Only turns whose history before the prompt is at most
+RESPONSE_CACHE_MAX_CONTEXT_TOKENS are looked up or stored: deeper
+conversations rarely repeat. Entries are LRU-evicted past
+RESPONSE_CACHE_MAX_ENTRIES, and replies longer than
+RESPONSE_CACHE_MAX_REPLY_CHARS aren't kept. Per worker, like the other
+in-process caches; stats() reports hits and the tokens and cost they saved
+per tier.
+"""
+
+import hashlib
+import json
+from typing import Any, Dict, List, Optional
+
+from core.config import settings
+from utils.cache import TTLCache
+from utils.tokens import estimate_tokens
+
+REPLAY_CHUNK_CHARS = 64  # a cached reply is streamed back in pieces this size
+
+
+def _normalize(text: Any) -> str:
+    return " ".join(str(text or "").split())
+
+
+class CachedReply:
+    __slots__ = ("text", "input_tokens", "output_tokens", "cost", "model")
+
+    def __init__(self, text: str, input_tokens: int, output_tokens: int, cost: float, model: str):
+        self.text = text
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.cost = cost
+        self.model = model
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        enabled: bool,
+        maxsize: int,
+        ttl: float,
+        max_context_tokens: int,
+        max_reply_chars: int
+    ):
+        self.enabled = enabled
+        self.max_context_tokens = max_context_tokens
+        self.max_reply_chars = max_reply_chars
+        self._cache = TTLCache(maxsize, ttl)
+        self._tiers: Dict[str, Dict[str, float]] = {}
+        self.stored = 0
+
+    def key(
+        self,
+        model: str,
+        prompt: str,
+        context: Optional[List[dict]] = None,
+        generation_config: Optional[dict] = None
+    ) -> Optional[str]:
+        """
+        Cache key for a call, or None when it isn't cacheable (cache off, or
+        too much history). context is as passed to generate_ai_response: its
+        last entry is the current message.
+        """
+        if not self.enabled:
+            return None
+        system: List[str] = []
+        history: List[List[str]] = []
+        history_tokens = 0
+        for entry in (context or [])[:-1]:
+            if entry.get("role") == "system":
+                system.append(_normalize(entry.get("content")))
+                continue
+            history_tokens += entry.get("tokens") or estimate_tokens(str(entry.get("content", "")))
+            if history_tokens > self.max_context_tokens:
+                return None
+            history.append([entry.get("role", ""), _normalize(entry.get("content"))])
+        material = json.dumps(
+            [model, system, history, _normalize(prompt), generation_config or {}],
+            sort_keys=True, ensure_ascii=False
+        )
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def _tier(self, tier: str) -> Dict[str, float]:
+        counters = self._tiers.get(tier)
+        if counters is None:
+            counters = self._tiers[tier] = {"hits": 0, "misses": 0, "saved_tokens": 0, "saved_cost": 0.0}
+        return counters
+
+    def get(self, key: Optional[str], tier: str) -> Optional[CachedReply]:
+        """The cached reply for key (counted as a hit or miss for tier), None on a miss"""
+        if key is None:
+            return None
+        reply = self._cache.get(key)
+        counters = self._tier(tier or "free")
+        if reply is None:
+            counters["misses"] += 1
+            return None
+        counters["hits"] += 1
+        counters["saved_tokens"] += reply.input_tokens + reply.output_tokens
+        counters["saved_cost"] += reply.cost
+        return reply
+
+    def put(
+        self,
+        key: Optional[str],
+        text: str,
+        input_tokens: int,
+        output_tokens: int,
+        cost: float,
+        model: str
+    ) -> None:
+        if key is None or not text or not text.strip() or len(text) > self.max_reply_chars:
+            return
+        self._cache.set(key, CachedReply(text, input_tokens, output_tokens, cost, model))
+        self.stored += 1
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        tiers = {}
+        for tier, c in self._tiers.items():
+            lookups = c["hits"] + c["misses"]
+            tiers[tier] = {
+                "hits": c["hits"],
+                "misses": c["misses"],
+                "hit_rate": round(c["hits"] / lookups, 4) if lookups else 0.0,
+                "saved_tokens": c["saved_tokens"],
+                "saved_cost": round(c["saved_cost"], 6),
+            }
+        return {"enabled": self.enabled, "stored": self.stored, **self._cache.stats(), "tiers": tiers}
+
+
+def replay_chunks(text: str, size: int = REPLAY_CHUNK_CHARS) -> List[str]:
+    """A cached reply cut into stream chunks"""
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+response_cache = ResponseCache(
+    enabled=settings.RESPONSE_CACHE_ENABLED,
+    maxsize=settings.RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=settings.RESPONSE_CACHE_TTL_SECONDS,
+    max_context_tokens=settings.RESPONSE_CACHE_MAX_CONTEXT_TOKENS,
+    max_reply_chars=settings.RESPONSE_CACHE_MAX_REPLY_CHARS
+)
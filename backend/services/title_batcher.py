@@ -0,0 +1,91 @@
+# backend/services/title_batcher.py
+
+"""
+Micro-batching for conversation titles.
+
+Each title is a tiny request, so under load the upstream call count, not
+tokens, is the cost. TitleBatcher collects first messages for a short window
+(or until the batch is full), asks for all their titles in one JSON response
+and hands each caller its own. A batch that fails or comes back malformed
+falls back to one request per message (which itself falls back to
+truncation). Titles already in the response cache skip the batch.
+"""
+
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from core.config import settings
+from services.gemini_service import cached_title, generate_conversation_title, generate_conversation_titles
+from utils.background import spawn
+
+logger = logging.getLogger(__name__)
+
+
+class TitleBatcher:
+    def __init__(self, max_batch_size: int, window_seconds: float):
+        self.max_batch_size = max_batch_size
+        self.window_seconds = window_seconds
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.batches = 0
+        self.titles = 0
+        self.fallbacks = 0
+
+    async def generate(self, first_message: str) -> str:
+        """Title for one conversation, generated together with any others pending"""
+        title = cached_title(first_message)
+        if title is not None:
+            return title
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((first_message, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_seconds, self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            spawn(self._run(batch), name="title-batch")
+
+    async def _run(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        messages = [message for message, _ in batch]
+        self.batches += 1
+        self.titles += len(batch)
+        try:
+            titles = await self._titles_for(messages)
+        except BaseException as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+        for (_, future), title in zip(batch, titles):
+            if not future.done():  # caller may have gone away
+                future.set_result(title)
+
+    async def _titles_for(self, messages: List[str]) -> List[str]:
+        if len(messages) == 1:
+            return [await generate_conversation_title(messages[0])]
+        try:
+            return await generate_conversation_titles(messages)
+        except Exception as e:
+            self.fallbacks += 1
+            logger.warning(f"Batched title generation failed for {len(messages)} messages, falling back: {e}")
+            return list(await asyncio.gather(*(generate_conversation_title(m) for m in messages)))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self._pending),
+            "batches": self.batches,
+            "titles": self.titles,
+            "fallbacks": self.fallbacks,
+        }
+
+
+title_batcher = TitleBatcher(settings.TITLE_BATCH_MAX_SIZE, settings.TITLE_BATCH_WINDOW_MS / 1000)
@@ -0,0 +1,190 @@
+# backend/services/turn_streams.py
+
+"""
+Resumable chat streams.
+
+A streamed turn runs as a background producer that publishes SSE frames to
+a TurnStream instead of writing them to the connection. The HTTP response
+only subscribes to it. Frames carry event IDs "<conversation_id>:<turn>:<seq>"
+(turn = id of the user message), and are kept in a bounded buffer, so a
+client that reconnects with Last-Event-ID gets the frames it missed and then
+the rest live, without starting a second generation.
+
+When the last subscriber goes away the producer keeps going for
+STREAM_RESUME_GRACE_SECONDS; if nobody reconnects by then it is cancelled
+(the partial reply is saved and usage logged, as for any disconnect).
+Finished turns stay resumable for STREAM_RESUME_TTL_SECONDS.
+
+Turns live in the worker that runs them, so resuming needs the reconnect to
+reach the same worker (sticky sessions); elsewhere it gets a 404 and the
+client reloads the conversation, which has the reply once it is done.
+"""
+
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from core.config import settings
+from utils.background import spawn
+from utils.sse import sse_event
+
+logger = logging.getLogger(__name__)
+
+
+def parse_event_id(event_id: Optional[str]) -> Optional[Tuple[int, int, int]]:
+    """(conversation_id, turn, seq) from a Last-Event-ID, None if malformed"""
+    try:
+        conversation_id, turn, seq = (int(part) for part in (event_id or "").split(":"))
+    except ValueError:
+        return None
+    return conversation_id, turn, seq
+
+
+class TurnStream:
+    """Frames of one streamed turn, readable by any number of subscribers"""
+
+    __slots__ = (
+        "registry", "user_id", "key", "task", "subscribers",
+        "_frames", "_first_seq", "_done", "_changed", "_grace"
+    )
+
+    def __init__(self, registry: "TurnStreamRegistry", user_id: str):
+        self.registry = registry
+        self.user_id = user_id
+        self.key: Optional[Tuple[int, int]] = None
+        self.task: Optional[asyncio.Task] = None
+        self.subscribers = 0
+        self._frames: List[bytes] = []
+        self._first_seq = 1  # seq of _frames[0]
+        self._done = False
+        self._changed = asyncio.Event()
+        self._grace: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def next_seq(self) -> int:
+        return self._first_seq + len(self._frames)
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def bind(self, conversation_id: int, turn: int) -> None:
+        """Make the turn resumable; frames published from here on carry IDs"""
+        self.key = (conversation_id, turn)
+        self.registry._streams[self.key] = self
+
+    def publish(self, data: dict) -> None:
+        event_id = f"{self.key[0]}:{self.key[1]}:{self.next_seq}" if self.key else None
+        self._frames.append(sse_event(data, event_id))
+        if len(self._frames) > self.registry.max_frames:
+            # Ring buffer: drop the oldest quarter
+            drop = len(self._frames) // 4
+            del self._frames[:drop]
+            self._first_seq += drop
+        self._wake()
+
+    def finish(self) -> None:
+        self._done = True
+        self._cancel_grace()
+        self._wake()
+        self.registry._expire_later(self)
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self, after_seq: int = 0) -> AsyncIterator[bytes]:
+        """Frames after seq after_seq (0 = from the start), then live ones until the turn ends"""
+        self.subscribers += 1
+        self._cancel_grace()
+        try:
+            seq = after_seq
+            while True:
+                changed = self._changed
+                while seq + 1 < self.next_seq:
+                    if seq + 1 < self._first_seq:
+                        # Fell out of the buffer while the client was away
+                        yield sse_event({'error': 'Stream can no longer be resumed', 'done': True})
+                        return
+                    seq += 1
+                    yield self._frames[seq - self._first_seq]
+                if self._done:
+                    return
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            self._arm_grace()
+
+    def _arm_grace(self) -> None:
+        """Nobody is listening: stop the turn unless someone subscribes in time"""
+        if not self.subscribers and not self._done and self._grace is None:
+            self._grace = asyncio.get_running_loop().call_later(
+                self.registry.grace_seconds, self._abandon
+            )
+
+    def _cancel_grace(self) -> None:
+        if self._grace is not None:
+            self._grace.cancel()
+            self._grace = None
+
+    def _abandon(self) -> None:
+        self._grace = None
+        if not self.subscribers and not self._done and self.task is not None:
+            logger.info(f"Nobody resumed turn {self.key} within the grace period, stopping it")
+            self.registry.abandoned += 1
+            self.task.cancel()
+
+
+class TurnStreamRegistry:
+    """This worker's streamed turns, by (conversation_id, turn)"""
+
+    def __init__(self, grace_seconds: float, ttl_seconds: float, max_frames: int):
+        self.grace_seconds = grace_seconds
+        self.ttl_seconds = ttl_seconds
+        self.max_frames = max_frames
+        self._streams: Dict[Tuple[int, int], TurnStream] = {}
+        self.started = 0
+        self.resumed = 0
+        self.abandoned = 0
+
+    def start(self, user_id: str, produce: Callable[[TurnStream], Awaitable[None]]) -> TurnStream:
+        """Run produce(turn) in the background; subscribe to the returned turn for its frames"""
+        turn = TurnStream(self, user_id)
+        turn.task = spawn(self._run(turn, produce), name="turn-stream")
+        turn._arm_grace()  # in case the response never starts
+        self.started += 1
+        return turn
+
+    async def _run(self, turn: TurnStream, produce: Callable[[TurnStream], Awaitable[None]]) -> None:
+        try:
+            await produce(turn)
+        finally:
+            turn.finish()
+
+    def get(self, conversation_id: int, turn: int) -> Optional[TurnStream]:
+        return self._streams.get((conversation_id, turn))
+
+    def _expire_later(self, turn: TurnStream) -> None:
+        if turn.key is not None:
+            asyncio.get_running_loop().call_later(self.ttl_seconds, self._expire, turn)
+
+    def _expire(self, turn: TurnStream) -> None:
+        if self._streams.get(turn.key) is turn:
+            del self._streams[turn.key]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "turns": len(self._streams),
+            "live": sum(1 for t in self._streams.values() if not t.done),
+            "subscribers": sum(t.subscribers for t in self._streams.values()),
+            "started": self.started,
+            "resumed": self.resumed,
+            "abandoned": self.abandoned,
+        }
+
+
+turn_streams = TurnStreamRegistry(
+    grace_seconds=settings.STREAM_RESUME_GRACE_SECONDS,
+    ttl_seconds=settings.STREAM_RESUME_TTL_SECONDS,
+    max_frames=settings.STREAM_RESUME_MAX_FRAMES
+)
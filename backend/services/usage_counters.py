@@ -0,0 +1,320 @@
+# backend/services/usage_counters.py
+
+"""
+In-memory per-user quota counters (messages today, cost this month).
+
+Each user's counters are seeded from the DB once per window and then kept
+current by record_message / record_cost, so steady-state quota checks make
+no DB reads. The same seed keeps the user's subscription (plan, expiry,
+is_premium flag) for tier routing until a "user" invalidation (upgrade,
+cancellation) drops it. Windows roll over at the same boundaries the rate limiter
+reports (midnight UTC, 1st of the month). Usage recorded here reaches the
+other workers as a delta (quota_notice, sent with the write that stores it)
+which they add to their own counters; only a plain invalidation (missed
+notifications, replayed usage) makes them reseed from the DB.
+
+Generations in flight hold a QuotaReservation (one message plus an estimated
+cost) so parallel requests can't all pass the same check. Reservations are
+checked and taken in one synchronous step on the event loop, so there is no
+lock; they are kept apart from the counters so a reseed doesn't drop them.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from core.config import settings
+from db.queries import active_plan, get_user_quota_snapshot
+from services.invalidation_service import (
+    invalidation_notice,
+    publish_update,
+    register_invalidation_handler,
+    register_update_handler,
+)
+from utils.background import spawn
+
+logger = logging.getLogger(__name__)
+
+
+def next_daily_reset(now: Optional[datetime] = None) -> datetime:
+    """Midnight UTC tomorrow"""
+    now = now or datetime.utcnow()
+    return (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_monthly_reset(now: Optional[datetime] = None) -> datetime:
+    """The 1st of next month, UTC"""
+    now = now or datetime.utcnow()
+    if now.month == 12:
+        return now.replace(year=now.year + 1, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    return now.replace(month=now.month + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def quota_notice(user_id: str, messages: int = 0, cost: float = 0.0) -> Tuple[str, str]:
+    """(channel, payload) telling other workers to add this usage to their counters"""
+    return invalidation_notice("quota", user_id, {"m": messages, "c": cost})
+
+
+class _UserUsage:
+    __slots__ = ("messages", "daily_reset_at", "cost", "monthly_reset_at",
+                 "plan", "status", "expired_at", "is_premium")
+
+    def __init__(self, messages: int, cost: float, now: datetime, snapshot: Optional[dict] = None):
+        self.messages = messages
+        self.cost = cost
+        self.daily_reset_at = next_daily_reset(now)
+        self.monthly_reset_at = next_monthly_reset(now)
+        snapshot = snapshot or {}
+        self.plan = snapshot.get("plan")
+        self.status = snapshot.get("status")
+        self.expired_at = snapshot.get("expired_at")  # checked on every read, not just at seed time
+        self.is_premium = bool(snapshot.get("is_premium"))
+
+    def roll(self, now: datetime) -> None:
+        """Start fresh windows once their reset time has passed"""
+        if now >= self.daily_reset_at:
+            self.messages = 0
+            self.daily_reset_at = next_daily_reset(now)
+        if now >= self.monthly_reset_at:
+            self.cost = 0.0
+            self.monthly_reset_at = next_monthly_reset(now)
+
+
+class QuotaReservation:
+    """
+    Quota held by one generation. Exactly one of settle() / release() takes
+    effect; later calls are no-ops, so callers can release in a finally.
+    A reservation nobody settles or releases (a stream whose body never
+    started) stops counting once it expires.
+    """
+
+    __slots__ = ("user_id", "messages", "cost", "expires_at", "_counters", "_message_pending", "_open")
+
+    def __init__(self, counters: "UsageCounters", user_id: str, messages: int, cost: float, ttl: float):
+        self._counters = counters
+        self.user_id = user_id
+        self.messages = messages
+        self.cost = cost
+        self.expires_at = time.monotonic() + ttl
+        self._message_pending = messages > 0
+        self._open = True
+
+    @property
+    def held(self) -> Tuple[int, float]:
+        """(messages, cost) still held against the limits"""
+        if not self._open:
+            return 0, 0.0
+        return (self.messages if self._message_pending else 0), self.cost
+
+    def commit_message(self, notify: bool = True) -> None:
+        """The user's message was stored: count it for real"""
+        if self._open and self._message_pending:
+            self._message_pending = False
+            self._counters.record_message(self.user_id, self.messages, notify)
+
+    def settle(self, cost: float, notify: bool = True) -> bool:
+        """
+        Replace the estimate with the generation's actual cost.
+        False if the reservation was already released (the cost isn't counted).
+        """
+        if not self._open:
+            return False
+        self._close()
+        self._counters.record_cost(self.user_id, cost, notify)
+        return True
+
+    def release(self) -> None:
+        """Give back whatever is still held (failure, disconnect)"""
+        if self._open:
+            self._close()
+
+    def _close(self) -> None:
+        self._open = False
+        self._counters._unreserve(self)
+
+
+class UsageCounters:
+    """Bounded LRU of per-user usage counters for this worker"""
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._users: "OrderedDict[str, _UserUsage]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Task] = {}
+        self._reserved: Dict[str, List[QuotaReservation]] = {}  # in-flight generations per user
+        self._stale: set = set()  # users updated by another worker while their seed was loading
+        self.seeds = 0
+        self.hits = 0
+        self.deltas = 0
+
+    async def _seed(self, user_id: str) -> _UserUsage:
+        snapshot = await get_user_quota_snapshot(user_id)
+        self.seeds += 1
+        return _UserUsage(snapshot["messages_today"], snapshot["monthly_cost"], datetime.utcnow(), snapshot)
+
+    def _store(self, user_id: str, usage: _UserUsage) -> None:
+        self._users[user_id] = usage
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    async def _entry(self, user_id: str) -> _UserUsage:
+        user_id = str(user_id)
+        usage = self._users.get(user_id)
+        if usage is not None:
+            self.hits += 1
+            self._users.move_to_end(user_id)
+            usage.roll(datetime.utcnow())
+            return usage
+
+        # One DB read per cold user, shared by concurrent callers
+        task = self._loading.get(user_id)
+        if task is None:
+            task = asyncio.ensure_future(self._seed(user_id))
+            self._loading[user_id] = task
+            try:
+                usage = await task
+                # A delta that arrived meanwhile may or may not be in the
+                # snapshot: use it for this call but don't keep it
+                if user_id not in self._stale:
+                    self._store(user_id, usage)
+            finally:
+                self._loading.pop(user_id, None)
+                self._stale.discard(user_id)
+            return usage
+        await task
+        return self._users.get(user_id) or task.result()
+
+    async def get(self, user_id: str) -> Tuple[int, float]:
+        """(messages today, cost this month)"""
+        usage = await self._entry(user_id)
+        return usage.messages, usage.cost
+
+    async def subscription(self, user_id: str) -> Tuple[Optional[str], bool]:
+        """(active plan or None, is_premium flag)"""
+        usage = await self._entry(user_id)
+        return active_plan(usage.plan, usage.status, usage.expired_at), usage.is_premium
+
+    async def reserve(
+        self,
+        user_id: str,
+        message_limit: int,
+        cost_limit: float,
+        cost: float,
+        messages: int = 1,
+        ttl: float = 600
+    ) -> Tuple[Optional[QuotaReservation], int, float]:
+        """
+        Hold `messages` and `cost` if they fit under the limits together with
+        recorded usage and the user's other live reservations.
+        Returns (reservation or None if over a limit, messages in use, cost in use).
+        """
+        user_id = str(user_id)
+        usage = await self._entry(user_id)
+        # No await from here on: check and reserve happen as one step
+        messages_in_use, cost_in_use = usage.messages, usage.cost
+        live = self._live_reservations(user_id)
+        for reservation in live:
+            held_messages, held_cost = reservation.held
+            messages_in_use += held_messages
+            cost_in_use += held_cost
+        if messages_in_use + messages > message_limit or cost_in_use + cost > cost_limit:
+            return None, messages_in_use, cost_in_use
+
+        reservation = QuotaReservation(self, user_id, messages, cost, ttl)
+        live.append(reservation)
+        self._reserved[user_id] = live
+        return reservation, messages_in_use, cost_in_use
+
+    def _live_reservations(self, user_id: str) -> List[QuotaReservation]:
+        now = time.monotonic()
+        live = [r for r in self._reserved.get(user_id, ()) if r.expires_at > now]
+        if not live:
+            self._reserved.pop(user_id, None)
+        return live
+
+    def _unreserve(self, reservation: QuotaReservation) -> None:
+        held = self._reserved.get(reservation.user_id)
+        if held is None:
+            return
+        try:
+            held.remove(reservation)
+        except ValueError:
+            pass
+        if not held:
+            del self._reserved[reservation.user_id]
+
+    def record_message(self, user_id: str, count: int = 1, notify: bool = True) -> None:
+        """
+        notify=False when the write that stores the message sends the
+        quota_notice itself (chat_history_service.add_message does)
+        """
+        self._add(str(user_id), count, 0.0)
+        if notify:
+            self._notify_others(str(user_id), {"m": count, "c": 0.0})
+
+    def record_cost(self, user_id: str, cost: float, notify: bool = True) -> None:
+        """
+        notify=False when the write that stores the cost tells the other
+        workers itself (the batched usage log does, once the rows are in)
+        """
+        self._add(str(user_id), 0, cost)
+        if notify:
+            self._notify_others(str(user_id), {"m": 0, "c": cost})
+
+    def apply_delta(self, user_id: str, data: dict) -> None:
+        """Usage another worker recorded (a quota_notice payload)"""
+        user_id = str(user_id)
+        try:
+            messages, cost = int(data.get("m", 0)), float(data.get("c", 0.0))
+        except (TypeError, ValueError):
+            self.forget(user_id)
+            return
+        self.deltas += 1
+        if user_id in self._loading:
+            self._stale.add(user_id)
+        self._add(user_id, messages, cost)
+
+    def _add(self, user_id: str, messages: int, cost: float) -> None:
+        usage = self._users.get(user_id)
+        if usage is not None:
+            usage.roll(datetime.utcnow())
+            usage.messages += messages
+            usage.cost += cost
+
+    def forget(self, user_id: Optional[str] = None) -> None:
+        if user_id is None:
+            self._users.clear()
+            self._stale.update(self._loading)
+        else:
+            self._users.pop(str(user_id), None)
+            if str(user_id) in self._loading:
+                self._stale.add(str(user_id))
+
+    def _notify_others(self, user_id: str, delta: dict) -> None:
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return  # no running loop (scripts/tests)
+        spawn(publish_update("quota", user_id, delta), name="quota-update")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "users": len(self._users),
+            "hits": self.hits,
+            "seeds": self.seeds,
+            "deltas": self.deltas,
+            "users_with_reservations": len(self._reserved),
+        }
+
+
+usage_counters = UsageCounters(settings.QUOTA_COUNTER_MAX_USERS)
+
+# Another worker recorded usage for this user: add it to ours
+register_update_handler("quota", usage_counters.apply_delta)
+# Usage we can't account for (missed notifications, replays): reseed from the DB next time
+register_invalidation_handler("quota", usage_counters.forget)
+# Subscription changed (upgrade, cancellation): reseed the plan with the counters
+register_invalidation_handler("user", usage_counters.forget)
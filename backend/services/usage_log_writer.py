@@ -0,0 +1,313 @@
+# backend/services/usage_log_writer.py
+
+"""
+Batched writer for api_usage_logs.
+
+Generations call record(), which only appends to an in-memory buffer. A
+background task writes the buffer with write_api_usage_batch (one statement
+for the rows, the monthly cost rollup and the quota updates) every
+USAGE_LOG_FLUSH_SECONDS, or sooner once USAGE_LOG_BATCH_SIZE records are
+waiting.
+
+If the DB can't be written, the records are appended to a spill file
+(JSON lines, USAGE_LOG_SPILL_PATH) and replayed before the next write, so
+usage survives an outage and a restart. The file is shared by the workers on
+a host and locked while it is appended to. To replay, one worker renames it
+to a claim file (<path>.replay, held with a lock of its own) and records how
+many of its lines are committed after each batch; the claim is deleted only
+once all of it is in the DB. A replay that fails or a worker that dies
+leaves the claim for the next attempt, and records are never lost: at
+worst a batch committed just before a crash is written twice. stop()
+writes whatever is left (or spills it) at shutdown.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from core.config import settings
+from db.queries import write_api_usage_batch
+from services.invalidation_service import invalidation_notice
+from services.usage_counters import quota_notice
+
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, only this process is locked out
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# (user_id, conversation_id, input_tokens, output_tokens, cost, created_at)
+UsageRecord = Tuple[str, Optional[int], int, int, float, datetime]
+
+
+def _parse(line: str) -> Optional[UsageRecord]:
+    try:
+        user_id, conversation_id, input_tokens, output_tokens, cost, created_at = json.loads(line)
+        return user_id, conversation_id, input_tokens, output_tokens, cost, datetime.fromisoformat(created_at)
+    except (ValueError, TypeError):
+        logger.error(f"Skipping malformed usage spill line: {line!r}")
+        return None
+
+
+class _SpillFile:
+    """Append-only JSON lines file, locked across processes where possible"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.claim_path = path + ".replay"
+        self.offset_path = path + ".replay.offset"
+        self._thread_lock = threading.Lock()
+        self._replay_lock = None  # open while this process owns the claim
+
+    def _locked(self, fn, *args):
+        with self._thread_lock, open(self.path + ".lock", "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return fn(*args)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def append(self, records: List[UsageRecord]) -> None:
+        self._locked(self._append, records)
+
+    def _append(self, records: List[UsageRecord]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            for user_id, conversation_id, input_tokens, output_tokens, cost, created_at in records:
+                f.write(json.dumps([user_id, conversation_id, input_tokens, output_tokens, cost, created_at.isoformat()]) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def claim(self) -> Optional[List[UsageRecord]]:
+        """
+        Records still to replay: those of an unfinished claim, or else the
+        spill file's, renamed to a new claim. None if another process is
+        replaying. Call commit() per written batch and finish() at the end.
+        """
+        if self._replay_lock is None:
+            lock = open(self.claim_path + ".lock", "a")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock.close()
+                    return None
+            self._replay_lock = lock
+        if not os.path.exists(self.claim_path):
+            self._locked(self._rename)
+        if not os.path.exists(self.claim_path):
+            self.finish()
+            return []
+        with open(self.claim_path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        # The offset counts parsed records: the claim never changes once taken
+        records = [r for r in map(_parse, lines) if r is not None][self._offset():]
+        if not records:
+            self.finish()
+        return records
+
+    def _rename(self) -> None:
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            os.replace(self.path, self.claim_path)
+
+    def _offset(self) -> int:
+        try:
+            with open(self.offset_path, "r") as f:
+                return int(f.read() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def commit(self, count: int) -> None:
+        """count more of the claim's records are in the DB"""
+        tmp = self.offset_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(self._offset() + count))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.offset_path)
+
+    def finish(self) -> None:
+        """The claim is fully written: delete it and let others replay again"""
+        for path in (self.claim_path, self.offset_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        if self._replay_lock is not None:
+            self._replay_lock.close()  # closing drops the flock
+            self._replay_lock = None
+
+
+class UsageLogWriter:
+    def __init__(self, batch_size: int, flush_seconds: float, spill_path: str, max_buffer: int):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_buffer = max_buffer
+        self.spill = _SpillFile(spill_path)
+        self._buffer: List[UsageRecord] = []
+        self._wake: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        # Claimed spill records not yet written, kept while the DB is down
+        self._claimed: Optional[List[UsageRecord]] = None
+        self.written = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.dropped = 0
+        self.failures = 0
+
+    def record(
+        self,
+        user_id: str,
+        conversation_id: Optional[int],
+        input_tokens: int,
+        output_tokens: int,
+        cost: float
+    ) -> None:
+        """Queue one generation's usage (never blocks, never raises)"""
+        self._buffer.append((str(user_id), conversation_id, int(input_tokens), int(output_tokens), float(cost), datetime.utcnow()))
+        if len(self._buffer) > self.max_buffer:
+            # Only reachable if spilling fails too
+            overflow = len(self._buffer) - self.max_buffer
+            del self._buffer[:overflow]
+            self.dropped += overflow
+            logger.error(f"Usage log buffer full, dropped {overflow} records")
+        self.start()
+        if len(self._buffer) >= self.batch_size and self._wake is not None:
+            self._wake.set()
+
+    def start(self) -> None:
+        """Start the flush loop (also replays any spill file on its first run)"""
+        if self._task is not None and not self._task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # no running loop (scripts): flush() explicitly
+        self._wake = asyncio.Event()
+        self._task = loop.create_task(self._run(), name="usage-log-writer")
+
+    async def stop(self) -> None:
+        """Stop the loop and write (or spill) everything buffered"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            if not await self._replay_spill():
+                await self._spill(self._take_buffer())
+                return
+            while self._buffer:
+                batch = self._take_buffer(self.batch_size)
+                if not await self._write(batch):
+                    await self._spill(batch + self._take_buffer())
+                    return
+
+    def _take_buffer(self, limit: Optional[int] = None) -> List[UsageRecord]:
+        batch = self._buffer[:limit] if limit else self._buffer
+        self._buffer = self._buffer[len(batch):]
+        return batch
+
+    async def _write(self, records: List[UsageRecord], replay: bool = False) -> bool:
+        # Once the rows are in, other workers add each user's cost to their
+        # quota counters. Replayed records were counted in memory by whichever
+        # worker spilled them, maybe not this one: everyone else reseeds instead
+        costs: Dict[str, float] = {}
+        for record in records:
+            costs[record[0]] = costs.get(record[0], 0.0) + record[4]
+        channel = None
+        payloads = []
+        for user_id, cost in sorted(costs.items()):
+            if replay:
+                channel, payload = invalidation_notice("quota", user_id)
+            else:
+                channel, payload = quota_notice(user_id, cost=cost)
+            payloads.append(payload)
+        try:
+            self.written += await write_api_usage_batch(records, notify=(channel, payloads))
+            return True
+        except Exception as e:
+            self.failures += 1
+            logger.warning(f"Could not write {len(records)} usage records: {e}")
+            return False
+
+    async def _spill(self, records: List[UsageRecord]) -> None:
+        if not records:
+            return
+        try:
+            await asyncio.to_thread(self.spill.append, records)
+            self.spilled += len(records)
+        except Exception as e:
+            logger.error(f"Could not spill {len(records)} usage records to {self.spill.path}: {e}")
+            # Keep them in memory and try again next flush
+            self._buffer[:0] = records
+
+    async def _replay_spill(self) -> bool:
+        """Write spilled records first; False if the DB is still unavailable"""
+        while True:
+            if self._claimed is None:
+                try:
+                    self._claimed = await asyncio.to_thread(self.spill.claim)
+                except Exception as e:
+                    logger.error(f"Could not read usage spill file {self.spill.path}: {e}")
+                    return True  # the buffer can still be written
+                if not self._claimed:
+                    self._claimed = None  # nothing spilled, or another worker is replaying
+                    return True
+            replayed = 0
+            while self._claimed:
+                batch = self._claimed[:self.batch_size]
+                if not await self._write(batch, replay=True):
+                    return False  # the claim stays on disk; retried next flush
+                self._claimed = self._claimed[len(batch):]
+                self.replayed += len(batch)
+                replayed += len(batch)
+                try:
+                    await asyncio.to_thread(self.spill.commit, len(batch))
+                except Exception as e:
+                    logger.error(f"Could not record usage replay progress (a crash now would replay it twice): {e}")
+            self._claimed = None
+            await asyncio.to_thread(self.spill.finish)
+            logger.info(f"Replayed {replayed} spilled usage records")
+            # Records spilled while this claim was pending are in a new spill file
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "buffered": len(self._buffer),
+            "written": self.written,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "dropped": self.dropped,
+            "failures": self.failures,
+        }
+
+
+usage_log_writer = UsageLogWriter(
+    batch_size=settings.USAGE_LOG_BATCH_SIZE,
+    flush_seconds=settings.USAGE_LOG_FLUSH_SECONDS,
+    spill_path=settings.USAGE_LOG_SPILL_PATH,
+    max_buffer=settings.USAGE_LOG_MAX_BUFFER
+)
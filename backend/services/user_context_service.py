@@ -0,0 +1,120 @@
+# backend/services/user_context_service.py
+
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+from services.usage_counters import usage_counters
+
+logger = logging.getLogger(__name__)
+
+# Plan names seen in the subscriptions table -> rate limit tier
+TIER_ALIASES = {
+    "premium": "elite",  # Map premium to elite tier
+    "premuim": "elite",  # Handle typo variant
+    "tier1": "pro",
+    "tier_1": "pro",
+    "tier2": "elite",
+    "tier_2": "elite",
+}
+KNOWN_TIERS = {"free", "pro", "elite"}
+
+# Tier -> Gemini model. 'pro' -> gemini-2.5-flash (text-only),
+# 'elite' -> gemini-2.5-flash-lite (text + tts / multimodal)
+MODEL_BY_TIER = {
+    "free": "gemini-2.5-flash",
+    "pro": "gemini-2.5-flash",
+    "elite": "gemini-2.5-flash-lite",
+}
+DEFAULT_MODEL = "gemini-2.0-flash"  # used when there is no user to route on
+
+# Model -> models to degrade to, in order, when it is failing
+MODEL_FALLBACKS = {
+    "gemini-2.5-flash": ("gemini-2.0-flash",),
+    "gemini-2.5-flash-lite": ("gemini-2.5-flash", "gemini-2.0-flash"),
+}
+
+
+def normalize_tier(plan: Optional[str]) -> Optional[str]:
+    """Map a raw plan name to one of KNOWN_TIERS (None if unknown/empty)"""
+    if not isinstance(plan, str) or not plan:
+        return None
+    tier = plan.lower()
+    tier = TIER_ALIASES.get(tier, tier)
+    return tier if tier in KNOWN_TIERS else None
+
+
+def model_for_tier(tier: Optional[str]) -> str:
+    """Pick the Gemini model for a tier"""
+    return MODEL_BY_TIER.get(tier or "free", MODEL_BY_TIER["free"])
+
+
+def fallback_chain(model_name: str) -> Tuple[str, ...]:
+    """The model followed by the ones to degrade to"""
+    return (model_name, *MODEL_FALLBACKS.get(model_name, ()))
+
+
+class UserContext:
+    """
+    Request-scoped view of the caller: user row, normalized tier and the
+    model the tier routes to. Resolved once per request and shared by auth,
+    the rate limiter and the Gemini model router.
+    """
+
+    def __init__(
+        self,
+        user_id: str,
+        user: Optional[Dict[str, Any]],
+        tier: str,
+        model_name: str,
+        plan: Optional[str] = None
+    ):
+        self.user_id = user_id
+        self.user = user
+        self.tier = tier
+        self.model_name = model_name
+        self.plan = plan  # raw plan name from subscriptions, if any
+
+    @property
+    def is_premium(self) -> bool:
+        return self.tier != "free"
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "user_id": self.user_id,
+            "tier": self.tier,
+            "model": self.model_name,
+            "plan": self.plan,
+        }
+
+
+async def resolve_user_context(user_id: str, user: Optional[Dict[str, Any]] = None) -> UserContext:
+    """
+    Resolve tier and model for a user.
+    The subscription comes from the in-memory quota counters, which read it
+    from the DB (with today's usage, in one round trip) only when the user is
+    cold or a "user" invalidation dropped it.
+    Pass the user row when the caller already has it (auth does).
+    """
+    plan = None
+    tier = None
+    try:
+        plan, is_premium = await usage_counters.subscription(user_id)
+        tier = normalize_tier(plan)
+        if plan and not tier:
+            logger.warning(f"Unknown plan '{plan}' for user {user_id}, defaulting to 'free'")
+            tier = "free"
+
+        if tier is None:
+            # No active subscription: fall back to the is_premium flag
+            tier = "elite" if is_premium else "free"
+    except Exception as e:
+        logger.warning(f"Error resolving user context for {user_id}: {e}", exc_info=True)
+        tier = tier or "free"
+
+    return UserContext(
+        user_id=user_id,
+        user=user,
+        tier=tier,
+        model_name=model_for_tier(tier),
+        plan=plan
+    )
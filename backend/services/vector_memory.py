@@ -0,0 +1,298 @@
+# backend/services/vector_memory.py
+
+"""
+Long-term memory: similarity search over a user's past messages across
+conversations.
+
+Messages are embedded by a pluggable Embedder; HashingEmbedder works
+offline (signed feature hashing of words and word pairs). Each user gets a
+UserVectorIndex of NumPy arrays searched with one matrix-vector product.
+
+A user's index is built from the DB in the background the first time they
+are looked up (that turn gets no memories), then kept current by
+add_message in this worker. Messages written by other workers show up when
+the index is next rebuilt (VECTOR_MEMORY_REFRESH_SECONDS). Only message ids
+are indexed; snippet text is read back from the DB for the few hits.
+Indexes are evicted least recently used first once they hold more than
+VECTOR_MEMORY_MAX_BYTES (or VECTOR_MEMORY_MAX_USERS users) in total.
+"""
+
+import asyncio
+import logging
+import math
+import re
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from core.config import settings
+from db.queries import get_user_messages_for_index
+from utils.background import spawn
+
+logger = logging.getLogger(__name__)
+
+# Only the start of very long messages is embedded
+MAX_EMBED_CHARS = 8000
+
+_WORDS = re.compile(r"[^\W_]+", re.UNICODE)
+_STOPWORDS = frozenset(
+    "a an and are as at be but by can do for from have how i if in is it me my no not of on or "
+    "so that the this to was we what when where which who why will with you your".split()
+)
+
+
+class Embedder(ABC):
+    """Maps texts to L2-normalized float32 vectors of size dim"""
+
+    dim: int
+
+    @abstractmethod
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        ...
+
+
+class HashingEmbedder(Embedder):
+    """
+    Offline embedder: words and adjacent word pairs hashed (crc32) into dim
+    signed buckets with sublinear term weights. Deterministic across
+    processes, no vocabulary to fit.
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _features(self, text: str) -> Counter:
+        words = [w for w in _WORDS.findall(text[:MAX_EMBED_CHARS].lower()) if w not in _STOPWORDS]
+        features = Counter(words)
+        features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+        return features
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        rows, cols, values = [], [], []
+        for row, text in enumerate(texts):
+            for feature, count in self._features(text).items():
+                h = zlib.crc32(feature.encode())
+                rows.append(row)
+                cols.append(h % self.dim)
+                weight = 1.0 + math.log(count)
+                values.append(weight if h & 0x80000000 else -weight)
+
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        if rows:
+            np.add.at(vectors, (np.asarray(rows), np.asarray(cols)), np.asarray(values, dtype=np.float32))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class UserVectorIndex:
+    """Growable arrays of one user's message vectors"""
+
+    __slots__ = ("vectors", "message_ids", "conversation_ids", "size", "max_size", "built_at")
+
+    def __init__(self, dim: int, max_size: int, capacity: int = 256):
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.message_ids = np.zeros(capacity, dtype=np.int64)
+        self.conversation_ids = np.zeros(capacity, dtype=np.int64)
+        self.size = 0
+        self.max_size = max_size
+        self.built_at = time.monotonic()
+
+    def add(self, vectors: np.ndarray, message_ids: Sequence[int], conversation_ids: Sequence[int]) -> None:
+        count = len(vectors)
+        if self.size + count > self.max_size:
+            # Keep the newest messages
+            keep = max(0, min(self.size, self.max_size * 3 // 4 - count))
+            drop = self.size - keep
+            for arr in (self.vectors, self.message_ids, self.conversation_ids):
+                arr[:keep] = arr[drop:self.size]
+            self.size = keep
+            if count > self.max_size:
+                vectors = vectors[-self.max_size:]
+                message_ids = message_ids[-self.max_size:]
+                conversation_ids = conversation_ids[-self.max_size:]
+                count = self.max_size
+        needed = self.size + count
+        if needed > len(self.vectors):
+            capacity = min(max(needed, len(self.vectors) * 2), self.max_size)
+            self.vectors = _grow(self.vectors, capacity)
+            self.message_ids = _grow(self.message_ids, capacity)
+            self.conversation_ids = _grow(self.conversation_ids, capacity)
+        self.vectors[self.size:needed] = vectors
+        self.message_ids[self.size:needed] = message_ids
+        self.conversation_ids[self.size:needed] = conversation_ids
+        self.size = needed
+
+    def search(
+        self,
+        query: np.ndarray,
+        k: int,
+        exclude_conversation_id: Optional[int] = None,
+        min_score: float = 0.0
+    ) -> List[Tuple[int, int, float]]:
+        """Top-k (message_id, conversation_id, cosine score), best first"""
+        if self.size == 0 or k <= 0:
+            return []
+        scores = self.vectors[:self.size] @ query
+        if exclude_conversation_id is not None:
+            scores[self.conversation_ids[:self.size] == exclude_conversation_id] = -np.inf
+        k = min(k, self.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (int(self.message_ids[i]), int(self.conversation_ids[i]), float(scores[i]))
+            for i in top if scores[i] > min_score
+        ]
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.message_ids.nbytes + self.conversation_ids.nbytes
+
+
+def _grow(arr: np.ndarray, capacity: int) -> np.ndarray:
+    grown = np.zeros((capacity,) + arr.shape[1:], dtype=arr.dtype)
+    grown[:len(arr)] = arr
+    return grown
+
+
+class VectorMemory:
+    """Per-user indexes for this worker, LRU-bounded by total bytes and user count"""
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        max_bytes: int,
+        max_users: int,
+        max_messages_per_user: int,
+        refresh_seconds: float
+    ):
+        self.embedder = embedder
+        self.max_bytes = max_bytes
+        self.max_users = max_users
+        self.max_messages_per_user = max_messages_per_user
+        self.refresh_seconds = refresh_seconds
+        self._indexes: "OrderedDict[str, UserVectorIndex]" = OrderedDict()
+        self._building: Dict[str, asyncio.Task] = {}
+        # Messages added while a user's index is being built
+        self._pending: Dict[str, List[Tuple[int, int, str]]] = {}
+        self.nbytes = 0
+        self.builds = 0
+        self.searches = 0
+        self.evictions = 0
+
+    def index_message(self, user_id: str, conversation_id: int, message_id: int, text: str) -> None:
+        """Add a freshly stored message (no-op for users without a loaded index)"""
+        user_id = str(user_id)
+        if user_id in self._building:
+            self._pending.setdefault(user_id, []).append((message_id, conversation_id, text))
+            return
+        index = self._indexes.get(user_id)
+        if index is not None and text:
+            before = index.nbytes
+            index.add(self.embedder.embed([text]), [message_id], [conversation_id])
+            self.nbytes += index.nbytes - before
+            self._evict()
+
+    async def search(
+        self,
+        user_id: str,
+        query: str,
+        k: int,
+        exclude_conversation_id: Optional[int] = None,
+        min_score: float = 0.0
+    ) -> List[Tuple[int, int, float]]:
+        """
+        Top-k past messages for a query. Returns [] while the user's index is
+        first being built.
+        """
+        user_id = str(user_id)
+        index = self._indexes.get(user_id)
+        if index is None or time.monotonic() - index.built_at > self.refresh_seconds:
+            self._schedule_build(user_id)
+        if index is None:
+            return []
+        self._indexes.move_to_end(user_id)
+        self.searches += 1
+        query_vector = self.embedder.embed([query])[0]
+        return index.search(query_vector, k, exclude_conversation_id, min_score)
+
+    def _schedule_build(self, user_id: str) -> None:
+        if user_id not in self._building:
+            self._building[user_id] = spawn(self._build(user_id), name=f"vector-index-{user_id}")
+
+    async def _build(self, user_id: str) -> None:
+        try:
+            rows = await get_user_messages_for_index(user_id, self.max_messages_per_user)
+            # Oldest first so the index keeps the newest when it overflows
+            rows = list(reversed(rows))
+            index = await asyncio.to_thread(self._build_index, rows)
+
+            # Catch up on messages stored during the build
+            known = int(index.message_ids[:index.size].max()) if index.size else 0
+            for message_id, conversation_id, text in self._pending.pop(user_id, ()):
+                if message_id > known and text:
+                    index.add(self.embedder.embed([text]), [message_id], [conversation_id])
+
+            self._discard(user_id)
+            self._indexes[user_id] = index
+            self.nbytes += index.nbytes
+            self._evict()
+            self.builds += 1
+        finally:
+            self._pending.pop(user_id, None)
+            self._building.pop(user_id, None)
+
+    def _build_index(self, rows: List[dict]) -> UserVectorIndex:
+        index = UserVectorIndex(self.embedder.dim, self.max_messages_per_user, capacity=max(256, len(rows)))
+        batch = 1024
+        for start in range(0, len(rows), batch):
+            chunk = rows[start:start + batch]
+            index.add(
+                self.embedder.embed([r["message_text"] for r in chunk]),
+                [r["id"] for r in chunk],
+                [r["conversation_id"] for r in chunk]
+            )
+        return index
+
+    def _discard(self, user_id: str) -> None:
+        index = self._indexes.pop(user_id, None)
+        if index is not None:
+            self.nbytes -= index.nbytes
+
+    def _evict(self) -> None:
+        while self._indexes and (self.nbytes > self.max_bytes or len(self._indexes) > self.max_users):
+            _, index = self._indexes.popitem(last=False)
+            self.nbytes -= index.nbytes
+            self.evictions += 1
+
+    def forget(self, user_id: Optional[str] = None) -> None:
+        if user_id is None:
+            self._indexes.clear()
+            self.nbytes = 0
+        else:
+            self._discard(str(user_id))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "users": len(self._indexes),
+            "messages": sum(i.size for i in self._indexes.values()),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "building": len(self._building),
+            "builds": self.builds,
+            "searches": self.searches,
+        }
+
+
+vector_memory = VectorMemory(
+    HashingEmbedder(settings.VECTOR_MEMORY_DIM),
+    max_bytes=settings.VECTOR_MEMORY_MAX_BYTES,
+    max_users=settings.VECTOR_MEMORY_MAX_USERS,
+    max_messages_per_user=settings.VECTOR_MEMORY_MAX_MESSAGES_PER_USER,
+    refresh_seconds=settings.VECTOR_MEMORY_REFRESH_SECONDS
+)
@@ -0,0 +1,168 @@
+# backend/test_api_key_pool.py
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+from google.generativeai import protos
+
+from services import gemini_service
+from services.api_key_pool import ApiKeyPool
+from services.gemini_resilience import ResilientCaller
+from services.model_registry import ModelRegistry
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _pool(secrets=("key-a", "key-b"), clock=None, client_factory=None, **overrides):
+    options = dict(rpm_limit=100, tpm_limit=10000, cooldown=10.0, max_cooldown=40.0)
+    options.update(overrides)
+    return ApiKeyPool(
+        list(secrets), client_factory=client_factory or (lambda secret: (None, None)),
+        clock=clock or FakeClock(), **options
+    )
+
+
+def _release(pool, key, tokens=None, error=None):
+    pool.release(key, tokens=tokens, error=error)
+
+
+def test_picks_the_key_with_most_budget_left():
+    pool = _pool(secrets=("key-a", "key-b", "key-c"))
+
+    # Idle keys are taken in turn
+    leased = [pool.acquire() for _ in range(3)]
+    assert [k.index for k in leased] == [0, 1, 2]
+    for key, tokens in zip(leased, (5000, 100, 2000)):
+        _release(pool, key, tokens=tokens)
+
+    # key-b has used the least of its token budget
+    assert pool.acquire().index == 1
+
+
+def test_throttled_key_cools_down_with_backoff():
+    clock = FakeClock()
+    pool = _pool(clock=clock)
+
+    key = pool.acquire()
+    _release(pool, key, error=google_exceptions.ResourceExhausted("quota"))
+    assert pool.key_stats()[0]["cooldown_seconds"] == 10.0
+    assert [pool.acquire().index for _ in range(3)] == [1, 1, 1]
+
+    # Once the cooldown is over it is usable, but a 429 in a row doubles the wait
+    clock.now += 61
+    key = pool.acquire()
+    assert key.index == 0
+    _release(pool, key, error=google_exceptions.ResourceExhausted("quota"))
+    assert pool.key_stats()[0]["cooldown_seconds"] == 20.0
+
+    # Other errors don't cool a key down; success resets the streak
+    clock.now += 61
+    key = pool.acquire()
+    _release(pool, key, error=google_exceptions.InternalServerError("boom"))
+    assert pool.key_stats()[0]["cooldown_seconds"] == 0
+    _release(pool, pool.acquire(), tokens=10)
+    assert pool.keys[0].throttle_streak == 0
+
+
+def test_pool_stats_show_no_key_details():
+    pool = _pool()
+    _release(pool, pool.acquire(), error=google_exceptions.ResourceExhausted("quota"))
+
+    stats = pool.stats()
+    assert stats == {"keys": 2, "cooling_down": 1, "calls": 1, "in_flight": 0, "throttles": 1}
+    assert all(key.secret[-4:] not in key.label for key in pool.keys)
+
+
+def test_all_keys_throttled_uses_the_first_to_recover():
+    clock = FakeClock()
+    pool = _pool(clock=clock)
+    a, b = pool.acquire(), pool.acquire()
+    _release(pool, b, error=google_exceptions.ResourceExhausted("quota"))
+    clock.now += 1
+    _release(pool, a, error=google_exceptions.ResourceExhausted("quota"))
+
+    assert pool.acquire().index == 1
+
+
+def _response(text, prompt_tokens=5, reply_tokens=3):
+    return protos.GenerateContentResponse(
+        candidates=[protos.Candidate(
+            content=protos.Content(parts=[protos.Part(text=text)], role="model"),
+            finish_reason=protos.Candidate.FinishReason.STOP,
+        )],
+        usage_metadata=protos.GenerateContentResponse.UsageMetadata(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=reply_tokens,
+            total_token_count=prompt_tokens + reply_tokens,
+        ),
+    )
+
+
+class FakeAsyncClient:
+    """Stands in for the SDK's GenerativeServiceAsyncClient of one API key"""
+
+    def __init__(self, secret, throttled=False):
+        self.secret = secret
+        self.throttled = throttled
+        self.calls = 0
+
+    async def generate_content(self, request, **kwargs):
+        self.calls += 1
+        if self.throttled:
+            raise google_exceptions.ResourceExhausted(f"{self.secret} over quota")
+        return _response(f"reply via {self.secret}")
+
+    async def stream_generate_content(self, request, **kwargs):
+        self.calls += 1
+        if self.throttled:
+            raise google_exceptions.ResourceExhausted(f"{self.secret} over quota")
+
+        async def chunks():
+            yield _response(f"streamed via {self.secret}", reply_tokens=2)
+            yield _response(" (done)", reply_tokens=4)
+
+        return chunks()
+
+
+@pytest.fixture
+def fake_keys(monkeypatch):
+    clients = {"key-a": FakeAsyncClient("key-a", throttled=True), "key-b": FakeAsyncClient("key-b")}
+    pool = _pool(client_factory=lambda secret: (None, clients[secret]))
+    no_sleep_retries = ResilientCaller(
+        retries=2, base_delay=0, max_delay=0, breaker_failures=5, breaker_cooldown=60,
+        hedge=False, hedge_min_delay=0, hedge_min_samples=20,
+    )
+    monkeypatch.setattr(gemini_service, "api_key_pool", pool)
+    monkeypatch.setattr(gemini_service, "model_registry", ModelRegistry(gemini_service._build_model))
+    monkeypatch.setattr(gemini_service, "gemini_resilience", no_sleep_retries)
+    return pool, clients
+
+
+@pytest.mark.asyncio
+async def test_generation_moves_off_a_throttled_key(fake_keys):
+    pool, clients = fake_keys
+
+    result = await gemini_service.generate_ai_response("hi", model_name="gemini-2.0-flash", tier="free")
+
+    assert result["text"] == "reply via key-b"
+    assert clients["key-a"].calls == 1
+    a, b = pool.key_stats()
+    assert a["throttles"] == 1 and a["cooldown_seconds"] > 0
+    assert b["in_flight"] == 0 and b["tokens_this_minute"] == 8
+
+
+@pytest.mark.asyncio
+async def test_stream_releases_its_key_with_usage(fake_keys):
+    pool, clients = fake_keys
+
+    chunks = [c async for c in gemini_service.generate_ai_response_stream("hi", model_name="gemini-2.0-flash", tier="free")]
+
+    assert "".join(chunks) == "streamed via key-b (done)"
+    _, b = pool.key_stats()
+    assert b["in_flight"] == 0
+    assert b["tokens_this_minute"] == 9  # usage_metadata of the last chunk
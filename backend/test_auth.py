@@ -0,0 +1,123 @@
+# backend/test_auth.py
+
+import json
+import time
+from types import SimpleNamespace
+
+import jwt
+import pytest
+from fastapi import HTTPException
+
+from core.config import settings
+from middleware import auth
+from services import invalidation_service
+from utils.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeUsers:
+    """get_user_by_id / get_user_by_email stand-in that counts lookups"""
+
+    def __init__(self):
+        self.rows = {}
+        self.lookups = 0
+
+    async def by_id(self, user_id):
+        self.lookups += 1
+        return self.rows.get(user_id)
+
+    async def by_email(self, email):
+        self.lookups += 1
+        return next((r for r in self.rows.values() if r["email"] == email), None)
+
+
+@pytest.fixture
+def users(monkeypatch):
+    fake = FakeUsers()
+    clock = FakeClock()
+    monkeypatch.setattr(auth, "get_user_by_id", fake.by_id)
+    monkeypatch.setattr(auth, "get_user_by_email", fake.by_email)
+    monkeypatch.setattr(auth, "_token_cache", TTLCache(100, 300, clock=clock))
+    monkeypatch.setattr(auth, "_negative_cache", TTLCache(100, 30, clock=clock))
+    monkeypatch.setattr(invalidation_service, "_handlers", {
+        "user": [auth._on_user_invalidated],
+        "user_email": [auth._on_user_email_invalidated],
+    })
+    fake.clock = clock
+    return fake
+
+
+def _token(user_id, expires_in=3600):
+    payload = {"sub": user_id, "aud": "authenticated", "exp": int(time.time() + expires_in)}
+    return jwt.encode(payload, settings.SUPABASE_JWT_SECRET, algorithm="HS256")
+
+
+async def _verify(token):
+    return await auth.verify_supabase_token(SimpleNamespace(state=SimpleNamespace()), f"Bearer {token}")
+
+
+def _from_the_db(entity, key):
+    """A notification sent by the migration's triggers"""
+    payload = json.dumps({"e": entity, "k": key, "o": "db"})
+    invalidation_service._on_notification(None, 0, invalidation_service.CHANNEL, payload)
+
+
+@pytest.mark.asyncio
+async def test_cached_token_never_outlives_its_exp(users):
+    users.rows["u1"] = {"id": "u1", "email": "a@example.com", "active": True}
+    token = _token("u1", expires_in=20)
+
+    assert await _verify(token) == "u1"
+    assert await _verify(token) == "u1"
+    assert users.lookups == 1
+
+    expires_at, _ = auth._token_cache._data[auth._token_key(token)]
+    assert expires_at <= users.clock.now + 20  # not the cache's 300s
+
+
+@pytest.mark.asyncio
+async def test_deactivation_evicts_cached_tokens(users):
+    users.rows["u1"] = {"id": "u1", "email": "a@example.com", "active": True}
+    token = _token("u1")
+    await _verify(token)
+    await _verify("a@example.com")
+
+    users.rows["u1"]["active"] = False
+    _from_the_db("user", "u1")
+    assert len(auth._token_cache) == 0
+
+    for credential in (token, "a@example.com"):
+        with pytest.raises(HTTPException) as exc:
+            await _verify(credential)
+        assert exc.value.status_code == 403
+
+
+@pytest.mark.asyncio
+async def test_unknown_user_is_cached_until_the_ttl_or_signup(users):
+    token = _token("u2")
+    for _ in range(2):
+        with pytest.raises(HTTPException):
+            await _verify(token)
+    assert users.lookups == 1
+
+    # Negative entries expire on their own
+    users.clock.now += 31
+    with pytest.raises(HTTPException):
+        await _verify(token)
+    assert users.lookups == 2
+
+    # The signup's INSERT clears them at once, by user id and by address
+    with pytest.raises(HTTPException):
+        await _verify("b@example.com")
+    users.rows["u2"] = {"id": "u2", "email": "b@example.com", "active": True}
+    _from_the_db("user", "u2")
+    _from_the_db("user_email", "b@example.com")
+    assert await _verify(token) == "u2"
+    assert await _verify("b@example.com") == "u2"
@@ -0,0 +1,128 @@
+# backend/test_chat_stream_disconnect.py
+
+import asyncio
+import json
+
+import pytest
+
+import main
+from middleware.auth import get_user_context, verify_supabase_token
+from routes import chat
+from services.generation_scheduler import generation_scheduler
+from services.turn_streams import turn_streams
+from services.user_context_service import UserContext
+from utils import background
+
+CTX = UserContext("u1", None, "elite", "gemini-2.0-flash")
+
+
+class FakeReservation:
+    user_id = "u1"
+    messages = 1
+
+    def __init__(self):
+        self.released = False
+
+    def release(self):
+        self.released = True
+
+    def commit_message(self, notify=True):
+        pass
+
+
+@pytest.fixture
+def route(monkeypatch):
+    """/chat/send/stream with the stores, limits and model faked out"""
+    state = {"saved": [], "slots": set(), "reservation": None, "chunks": [], "streaming": asyncio.Event()}
+
+    async def _add_message(conv_id, role, text, user_id=None, reservation=None, truncated=False):
+        state["saved"].append((role, text, truncated))
+        return len(state["saved"])
+
+    async def _context(*args):
+        return []
+
+    async def _limits(ctx):
+        return {}
+
+    async def _acquire_slot(ctx):
+        state["slots"].add("slot")
+        return "slot"
+
+    async def _release_slot(user_id, slot_id):
+        state["slots"].discard(slot_id)
+
+    async def _reserve(ctx, cost):
+        state["reservation"] = FakeReservation()
+        return state["reservation"]
+
+    async def _generate(*args, **kwargs):
+        for chunk in state["chunks"]:
+            yield chunk
+        state["streaming"].set()
+        await asyncio.sleep(60)  # the reply is still being generated
+
+    monkeypatch.setattr(chat, "add_message", _add_message)
+    monkeypatch.setattr(chat, "format_conversation_for_context", _context)
+    monkeypatch.setattr(chat, "_check_send_limits", _limits)
+    monkeypatch.setattr(chat, "generate_ai_response_stream", _generate)
+    monkeypatch.setattr(chat.rate_limiter, "acquire_stream_slot", _acquire_slot)
+    monkeypatch.setattr(chat.rate_limiter, "release_stream_slot", _release_slot)
+    monkeypatch.setattr(chat.rate_limiter, "reserve", _reserve)
+    monkeypatch.setattr(turn_streams, "grace_seconds", 0.01)
+    monkeypatch.setitem(main.app.dependency_overrides, verify_supabase_token, lambda: "u1")
+    monkeypatch.setitem(main.app.dependency_overrides, get_user_context, lambda: CTX)
+    return state
+
+
+async def _send_and_disconnect(state):
+    """POST a message, then drop the connection once the reply is mid-stream"""
+    body = json.dumps({"conversation_id": 5, "message": "hello there"}).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+        "scheme": "http", "path": "/chat/send/stream", "raw_path": b"/chat/send/stream",
+        "root_path": "", "query_string": b"", "client": ("test", 1), "server": ("test", 80),
+        "headers": [(b"content-type", b"application/json"), (b"authorization", b"Bearer x")],
+    }
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await state["streaming"].wait()
+        await asyncio.sleep(0.05)  # let the frames before it go out
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        pass
+
+    await asyncio.wait_for(main.app(scope, receive, send), timeout=5)
+    # Nobody resumes: the turn is cancelled after the grace period
+    for _ in range(100):
+        if state["reservation"].released and not state["slots"]:
+            break
+        await asyncio.sleep(0.01)
+    await background.drain(timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_partial_reply_is_saved_as_truncated(route):
+    route["chunks"] = ["Once upon ", "a time"]
+    await _send_and_disconnect(route)
+
+    assert route["saved"] == [("user", "hello there", False), ("assistant", "Once upon a time", True)]
+    assert route["reservation"].released
+    assert route["slots"] == set()
+    assert generation_scheduler.active == 0
+
+
+@pytest.mark.asyncio
+async def test_nothing_generated_saves_no_reply(route):
+    await _send_and_disconnect(route)
+
+    assert route["saved"] == [("user", "hello there", False)]
+    assert route["reservation"].released
+    assert route["slots"] == set()
+    assert generation_scheduler.active == 0
@@ -0,0 +1,174 @@
+# backend/test_context_cache.py
+
+import asyncio
+
+import pytest
+from google.generativeai import protos
+
+from services import gemini_service
+from services.api_key_pool import ApiKeyPool
+from services.context_cache import ContextCache
+from services.model_registry import ModelRegistry
+
+SYSTEM_PROMPT = "You are a helpful assistant. " * 20
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeCacheBackend:
+    """Local stand-in for Gemini cachedContents"""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.created = {}
+        self.deleted = []
+
+    async def create(self, key, model, system_instruction, history, ttl):
+        if self.fail:
+            raise RuntimeError("too small to cache")
+        name = f"cachedContents/{len(self.created) + 1}"
+        self.created[name] = (model, system_instruction, [e["parts"][0] for e in history])
+        return name
+
+    async def delete(self, key, name):
+        self.deleted.append(name)
+
+
+class RecordingAsyncClient:
+    """GenerativeServiceAsyncClient that keeps every request it gets"""
+
+    def __init__(self):
+        self.requests = []
+
+    async def generate_content(self, request, **kwargs):
+        self.requests.append(request)
+        cached = 0
+        if request.cached_content:
+            cached = 100
+        return protos.GenerateContentResponse(
+            candidates=[protos.Candidate(
+                content=protos.Content(parts=[protos.Part(text="ok")], role="model"),
+                finish_reason=protos.Candidate.FinishReason.STOP,
+            )],
+            usage_metadata=protos.GenerateContentResponse.UsageMetadata(
+                prompt_token_count=200, candidates_token_count=1, total_token_count=201,
+                cached_content_token_count=cached,
+            ),
+        )
+
+
+def _context(turns):
+    """System prompt, `turns` earlier user/assistant pairs, then the new message"""
+    context = [{"role": "system", "content": SYSTEM_PROMPT}]
+    for i in range(turns):
+        context.append({"role": "user", "content": f"question {i} " + "detail " * 30})
+        context.append({"role": "assistant", "content": f"answer {i} " + "detail " * 30})
+    context.append({"role": "user", "content": "next question"})
+    return context
+
+
+@pytest.fixture
+def fake_gemini(monkeypatch):
+    client = RecordingAsyncClient()
+    pool = ApiKeyPool(["key-a"], rpm_limit=100, tpm_limit=100000, cooldown=1, max_cooldown=1,
+                      client_factory=lambda secret: (None, client))
+    backend = FakeCacheBackend()
+    cache = ContextCache(backend, enabled=True, min_tokens=200, ttl=600, max_entries=10)
+    monkeypatch.setattr(gemini_service, "api_key_pool", pool)
+    monkeypatch.setattr(gemini_service, "model_registry", ModelRegistry(gemini_service._build_model))
+    monkeypatch.setattr(gemini_service, "context_cache", cache)
+    return client, backend, cache
+
+
+async def _ask(context):
+    return await gemini_service.generate_ai_response(
+        context[-1]["content"], context, model_name="gemini-2.0-flash", tier="free"
+    )
+
+
+@pytest.mark.asyncio
+async def test_system_prompt_is_the_system_instruction(fake_gemini):
+    client, backend, cache = fake_gemini
+    cache.enabled = False
+
+    await _ask(_context(turns=1))
+
+    request = client.requests[-1]
+    assert request.system_instruction.parts[0].text == SYSTEM_PROMPT
+    assert [c.role for c in request.contents] == ["user", "model", "user"]
+    assert not request.cached_content
+
+
+@pytest.mark.asyncio
+async def test_long_prefix_is_cached_and_only_the_rest_is_sent(fake_gemini):
+    client, backend, cache = fake_gemini
+
+    # Nothing cached yet: the whole history goes out, a prefix upload starts
+    first = await _ask(_context(turns=2))
+    assert not client.requests[-1].cached_content
+    await asyncio.sleep(0)
+    assert list(backend.created) == ["cachedContents/1"]
+    model, instruction, contents = backend.created["cachedContents/1"]
+    assert (model, instruction, len(contents)) == ("gemini-2.0-flash", SYSTEM_PROMPT, 4)
+
+    # The next turn reuses it and sends only the new entries
+    second = await _ask(_context(turns=3))
+    request = client.requests[-1]
+    assert request.cached_content == "cachedContents/1"
+    assert not request.system_instruction.parts
+    assert len(request.contents) == 3  # turn 3 question/answer, then the new message
+    assert second["cost"] < first["cost"]  # cached input tokens are billed at a discount
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_rewritten_history_misses_and_failures_back_off():
+    clock = FakeClock()
+    backend = FakeCacheBackend(fail=True)
+    cache = ContextCache(backend, enabled=True, min_tokens=10, ttl=600, max_entries=10, clock=clock)
+    key = ApiKeyPool(["key-a"], 100, 100000, 1, 1, client_factory=lambda s: (None, None)).keys[0]
+    history = [{"role": "user", "parts": ["some words " * 20]}]
+
+    assert cache.lookup("m", key, "system", history) == (None, history)
+    await asyncio.sleep(0)
+    assert cache.failures == 1
+    # A failed prefix isn't retried until the TTL has passed
+    cache.lookup("m", key, "system", history)
+    await asyncio.sleep(0)
+    assert cache.failures == 1
+
+    backend.fail = False
+    clock.now += 601
+    cache.lookup("m", key, "system", history)
+    await asyncio.sleep(0)
+    assert cache.created == 1
+    prefix, rest = cache.lookup("m", key, "system", history)
+    assert prefix is not None and rest == []
+
+    # A different start (summary rewritten) doesn't match the cached prefix
+    rewritten = [{"role": "model", "parts": ["summary"]}] + history
+    assert cache.lookup("m", key, "system", rewritten)[0] is None
+
+
+@pytest.mark.asyncio
+async def test_failed_prefixes_are_pruned():
+    clock = FakeClock()
+    cache = ContextCache(FakeCacheBackend(fail=True), enabled=True, min_tokens=1, ttl=600, max_entries=3, clock=clock)
+    key = ApiKeyPool(["key-a"], 100, 100000, 1, 1, client_factory=lambda s: (None, None)).keys[0]
+
+    for i in range(5):
+        cache.lookup("m", key, "system", [{"role": "user", "parts": [f"message {i}"]}])
+        await asyncio.sleep(0)
+    assert cache.failures == 5 and len(cache._failed) <= 3
+
+    # Once their back-off is over they are dropped at the next upload
+    clock.now += 601
+    cache.lookup("m", key, "system", [{"role": "user", "parts": ["another"]}])
+    await asyncio.sleep(0)
+    assert len(cache._failed) == 1
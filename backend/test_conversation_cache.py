@@ -0,0 +1,112 @@
+# backend/test_conversation_cache.py
+
+import pytest
+
+from core.config import settings
+from services import chat_history_service, invalidation_service, memory_service
+from services.conversation_cache import ConversationCache, _on_conversation_invalidated
+
+
+def _rows(summary=None, messages=(), recent_count=None):
+    """Rows shaped like _fetch_context_rows' (summary first, then oldest to newest)"""
+    rows = []
+    count = len(messages) if recent_count is None else recent_count
+    if summary is not None:
+        rows.append({"is_summary": True, "id": 0, "role": "system", "message_text": summary[0],
+                     "token_count": summary[1], "recent_count": count})
+    for message_id, role, text, tokens in messages:
+        rows.append({"is_summary": False, "id": message_id, "role": role, "message_text": text,
+                     "token_count": tokens, "recent_count": count})
+    return rows
+
+
+MESSAGES = [(i, "user" if i % 2 else "assistant", f"message {i}", 10) for i in range(1, 7)]
+
+
+def test_tail_round_trips_to_the_same_context():
+    tail = memory_service._tail_from_rows(5, _rows(("earlier", 7), MESSAGES), max_messages=200)
+    assert tail.complete
+
+    # Everything fits: the summary and all six messages, in order
+    context = tail.pack(token_budget=1000, max_messages=200)
+    assert context[0] == {"role": "system", "content": "Summary of the earlier conversation:\nearlier", "tokens": 7}
+    assert [(e["role"], e["content"], e["tokens"]) for e in context[1:]] == [(r, t, n) for _, r, t, n in MESSAGES]
+
+    # A smaller budget keeps the newest that fit after the summary
+    context = tail.pack(token_budget=7 + 30, max_messages=200)
+    assert [e["content"] for e in context[1:]] == ["message 4", "message 5", "message 6"]
+    # The newest message is always included
+    assert [e["content"] for e in tail.pack(token_budget=0, max_messages=200)[1:]] == ["message 6"]
+
+
+def test_incomplete_tail_defers_to_the_db():
+    # Four of ten messages after the summary came back: older ones exist only in the DB
+    tail = memory_service._tail_from_rows(5, _rows(None, MESSAGES[2:], recent_count=10), max_messages=200)
+    assert not tail.complete
+    assert tail.pack(token_budget=1000, max_messages=200) is None
+    assert len(tail.pack(token_budget=25, max_messages=200)) == 2
+
+
+@pytest.fixture
+def cached(monkeypatch):
+    cache = ConversationCache(max_bytes=1 << 20, max_messages=settings.MAX_CONTEXT_MESSAGES, max_tokens=1000)
+    fetches = []
+    stored = {"next_id": len(MESSAGES) + 1}
+
+    async def fetch(conversation_id, token_budget, max_messages, include_summary):
+        fetches.append(conversation_id)
+        return _rows(None, MESSAGES)
+
+    async def db_add_message(conversation_id, role, text, tokens, notify=None, truncated=False):
+        stored["next_id"] += 1
+        return {"id": stored["next_id"] - 1, "user_id": None}
+
+    monkeypatch.setattr(memory_service, "conversation_cache", cache)
+    monkeypatch.setattr(chat_history_service, "conversation_cache", cache)
+    monkeypatch.setattr(memory_service, "_fetch_context_rows", fetch)
+    monkeypatch.setattr(chat_history_service, "db_add_message", db_add_message)
+    monkeypatch.setattr(memory_service.settings, "CONVERSATION_CACHE_ENABLED", True)
+    monkeypatch.setattr(memory_service.invalidation_listener, "connected", True)
+    monkeypatch.setattr(invalidation_service, "_handlers", {"conversation": [_on_conversation_invalidated]})
+    monkeypatch.setattr("services.conversation_cache.conversation_cache", cache)
+    return cache, fetches
+
+
+@pytest.mark.asyncio
+async def test_add_message_extends_the_cached_tail(cached):
+    cache, fetches = cached
+    first = await memory_service.get_conversation_context(5, token_budget=1000)
+    assert len(first) == 6 and fetches == [5]
+
+    await chat_history_service.add_message(5, "user", "a new question")
+    context = await memory_service.get_conversation_context(5, token_budget=1000)
+    assert context[:-1] == first
+    assert context[-1]["content"] == "a new question"
+    assert fetches == [5]  # served from memory
+    assert cache.stats()["hits"] == 1
+
+
+@pytest.mark.asyncio
+async def test_write_in_another_worker_drops_the_tail(cached):
+    cache, fetches = cached
+    await memory_service.get_conversation_context(5, token_budget=1000)
+
+    channel, payload = invalidation_service.invalidation_notice("conversation", 5)
+    invalidation_service._on_notification(None, 0, channel, payload.replace(invalidation_service.WORKER_ID, "other"))
+    assert cache.get(5) is None
+
+    await memory_service.get_conversation_context(5, token_budget=1000)
+    assert fetches == [5, 5]
+
+
+@pytest.mark.asyncio
+async def test_write_during_a_load_is_not_lost(cached):
+    cache, fetches = cached
+    cache.begin_load(5)
+    await chat_history_service.add_message(5, "user", "raced the read")
+    cache.put(memory_service._tail_from_rows(5, _rows(None, MESSAGES), max_messages=200))
+
+    # The tail read before the write isn't installed; the next turn reads again
+    assert cache.get(5) is None
+    await memory_service.get_conversation_context(5, token_budget=1000)
+    assert fetches == [5]
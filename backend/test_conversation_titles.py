@@ -0,0 +1,83 @@
+# backend/test_conversation_titles.py
+
+import asyncio
+
+import pytest
+
+from services import chat_history_service
+
+LONG_MESSAGE = "Can you help me plan a two week trip through Japan in the spring with a small budget"
+
+
+@pytest.fixture
+def titles(monkeypatch):
+    """Conversations and title updates in memory; the batcher answers when released"""
+    conversations = {}
+    answer = asyncio.Event()
+    generated = {"title": "Japan Spring Trip"}
+
+    async def _create(user_id, title):
+        conv_id = len(conversations) + 1
+        conversations[conv_id] = title
+        return conv_id
+
+    async def _update(conv_id, user_id, title, expected_title=None):
+        if expected_title is None or conversations[conv_id] == expected_title:
+            conversations[conv_id] = title
+
+    async def _generate(first_message):
+        await answer.wait()
+        if isinstance(generated["title"], Exception):
+            raise generated["title"]
+        return generated["title"]
+
+    monkeypatch.setattr(chat_history_service, "db_create_conversation", _create)
+    monkeypatch.setattr(chat_history_service, "update_conversation_title", _update)
+    monkeypatch.setattr(chat_history_service.title_batcher, "generate", _generate)
+    return conversations, answer, generated
+
+
+@pytest.mark.asyncio
+async def test_short_first_message_is_the_title(titles):
+    conversations, _, _ = titles
+    conv_id, task = await chat_history_service.start_conversation("u1", "hello there!")
+    assert task is None
+    assert conversations[conv_id] == "Hello there"
+
+
+@pytest.mark.asyncio
+async def test_provisional_title_is_replaced_once_generated(titles):
+    conversations, answer, _ = titles
+    conv_id, task = await chat_history_service.start_conversation("u1", LONG_MESSAGE)
+
+    # Returned before the title model answered
+    assert not task.done()
+    assert conversations[conv_id] == LONG_MESSAGE[:40] + "..."
+
+    answer.set()
+    assert await task == "Japan Spring Trip"
+    assert conversations[conv_id] == "Japan Spring Trip"
+
+
+@pytest.mark.asyncio
+async def test_renamed_conversation_keeps_the_users_title(titles):
+    conversations, answer, _ = titles
+    conv_id, task = await chat_history_service.start_conversation("u1", LONG_MESSAGE)
+    conversations[conv_id] = "My trip"
+
+    answer.set()
+    await task
+    assert conversations[conv_id] == "My trip"
+
+
+@pytest.mark.asyncio
+async def test_failed_title_keeps_the_provisional_one(titles, caplog):
+    conversations, answer, generated = titles
+    generated["title"] = RuntimeError("upstream down")
+    conv_id, task = await chat_history_service.start_conversation("u1", LONG_MESSAGE)
+
+    answer.set()
+    provisional = LONG_MESSAGE[:40] + "..."
+    assert await task == provisional
+    assert conversations[conv_id] == provisional
+    assert "upstream down" in caplog.text
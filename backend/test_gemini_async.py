@@ -0,0 +1,177 @@
+# backend/test_gemini_async.py
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+import main
+from services import gemini_service
+
+
+class _Chunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _BlockingModel:
+    """Model with only the blocking SDK surface (like _ModelShim)."""
+
+    def __init__(self, chunks: int = 10, delay: float = 0.02):
+        self.chunks = chunks
+        self.delay = delay
+        self.open_streams = 0
+        self.max_open_streams = 0
+        self.read_threads = set()
+        self._lock = threading.Lock()
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        def _stream():
+            with self._lock:
+                self.open_streams += 1
+                self.max_open_streams = max(self.max_open_streams, self.open_streams)
+            try:
+                for i in range(self.chunks):
+                    self.read_threads.add(threading.get_ident())
+                    time.sleep(self.delay)  # simulates a slow upstream read
+                    yield _Chunk(f"{i} ")
+            finally:
+                with self._lock:
+                    self.open_streams -= 1
+
+        if stream:
+            return _stream()
+        time.sleep(self.delay * self.chunks)
+        return _Chunk("done")
+
+
+async def _drain(prompt: str) -> str:
+    parts = []
+    async for chunk in gemini_service.generate_ai_response_stream(prompt):
+        parts.append(chunk)
+    return "".join(parts)
+
+
+@pytest.mark.asyncio
+async def test_event_loop_stays_responsive_with_50_open_streams(monkeypatch):
+    """`/` keeps being served while 50 blocking upstream streams are open."""
+    model = _BlockingModel()
+    monkeypatch.setattr(gemini_service, "_get_model", lambda *a, **k: model)
+    # Room for all 50 at once: the default pool and admission limits are smaller
+    executor = ThreadPoolExecutor(max_workers=50, thread_name_prefix="gemini-test")
+    monkeypatch.setattr(gemini_service, "_executor", executor)
+    monkeypatch.setattr(gemini_service.generation_scheduler, "max_concurrent", 50)
+
+    loop_thread = threading.get_ident()
+    streams = [asyncio.create_task(_drain(f"prompt {i}")) for i in range(50)]
+    served = 0
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        while not all(t.done() for t in streams):
+            resp = await client.get("/")
+            assert resp.status_code == 200
+            served += 1
+            await asyncio.sleep(0.005)
+
+    results = await asyncio.gather(*streams)
+    executor.shutdown()
+    assert all(r == "".join(f"{i} " for i in range(10)) for r in results)
+    assert model.max_open_streams == 50
+
+    # No upstream read ever ran on the loop, which kept serving requests the
+    # whole time (the reads alone take 10 chunks x 20ms per stream)
+    assert loop_thread not in model.read_threads
+    assert served > 10
+
+
+@pytest.mark.asyncio
+async def test_closing_a_stream_mid_reply_closes_the_upstream(monkeypatch):
+    model = _BlockingModel(chunks=100, delay=0.005)
+    monkeypatch.setattr(gemini_service, "_get_model", lambda *a, **k: model)
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="gemini-test")
+    monkeypatch.setattr(gemini_service, "_executor", executor)
+
+    stream = gemini_service.generate_ai_response_stream("hello")
+    await stream.__anext__()
+    await stream.__anext__()
+    assert model.open_streams == 1
+    await stream.aclose()
+
+    # The worker finishes its current read, closes the generator and returns
+    await asyncio.to_thread(executor.shutdown)
+    assert model.open_streams == 0
+
+
+@pytest.mark.asyncio
+async def test_blocking_stream_reads_ahead_a_bounded_amount(monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="gemini-test")
+    monkeypatch.setattr(gemini_service, "_executor", executor)
+    read = 0
+
+    def _upstream():
+        nonlocal read
+        for i in range(1000):
+            read += 1
+            yield i
+
+    chunks = gemini_service._iterate_blocking(_upstream())
+    assert await chunks.__anext__() == 0
+    for _ in range(20):
+        await asyncio.sleep(0.005)  # a consumer slower than the upstream
+    # The buffer, the item the worker is waiting to hand over and the one taken
+    assert read <= gemini_service._STREAM_BUFFER + 2
+
+    await chunks.aclose()
+    await asyncio.to_thread(executor.shutdown)
+    assert read < 1000
+
+
+@pytest.mark.asyncio
+async def test_non_streaming_and_title_run_off_loop(monkeypatch):
+    monkeypatch.setattr(gemini_service, "_get_model", lambda *a, **k: _BlockingModel(delay=0.01))
+
+    ticks = 0
+
+    async def _ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.005)
+
+    ticker = asyncio.create_task(_ticker())
+    result = await gemini_service.generate_ai_response("hello")
+    title = await gemini_service.generate_conversation_title("hello")
+    ticker.cancel()
+
+    assert result["text"] == "done"
+    assert title == "done"
+    assert ticks >= 10
+
+
+@pytest.mark.asyncio
+async def test_stream_cancelled_before_opening_is_not_billed(monkeypatch):
+    opening = asyncio.Event()
+    billed = []
+
+    async def _open_stream(*args, **kwargs):
+        opening.set()
+        await asyncio.sleep(10)  # the upstream request never gets going
+
+    monkeypatch.setattr(gemini_service, "_open_stream", _open_stream)
+    monkeypatch.setattr(gemini_service, "_log_usage", lambda *args: billed.append(args))
+
+    stream = gemini_service.generate_ai_response_stream(
+        "hello", user_id="u1", conversation_id=1, model_name="gemini-2.0-flash", tier="free"
+    )
+    first = asyncio.create_task(stream.__anext__())
+    await opening.wait()
+    first.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await first
+
+    assert billed == []
+    assert gemini_service.generation_scheduler.active == 0
@@ -0,0 +1,192 @@
+# backend/test_gemini_resilience.py
+
+import asyncio
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from services import gemini_service
+from services.gemini_resilience import ResilientCaller, UpstreamUnavailable
+
+
+async def _no_sleep(_seconds):
+    pass
+
+
+def _caller(**overrides):
+    options = dict(
+        retries=2, base_delay=0.01, max_delay=0.1,
+        breaker_failures=3, breaker_cooldown=60.0,
+        hedge=False, hedge_min_delay=0.01, hedge_min_samples=5,
+        sleep=_no_sleep,
+    )
+    options.update(overrides)
+    return ResilientCaller(**options)
+
+
+class FakeUpstream:
+    """Per-model scripted behaviour: a list of errors to raise, then latency per call"""
+
+    def __init__(self, errors=None, latency=None):
+        self.errors = {model: list(errs) for model, errs in (errors or {}).items()}
+        self.latency = latency or {}
+        self.calls = []
+        self.finished = []
+
+    async def __call__(self, model: str):
+        self.calls.append(model)
+        errors = self.errors.get(model)
+        if errors:
+            raise errors.pop(0)
+        delays = self.latency.get(model, 0)
+        delay = delays.pop(0) if isinstance(delays, list) else delays
+        await asyncio.sleep(delay)
+        self.finished.append(model)
+        return f"reply from {model}"
+
+
+@pytest.mark.asyncio
+async def test_retries_retryable_errors_then_succeeds():
+    upstream = FakeUpstream(errors={"a": [google_exceptions.ServiceUnavailable("down"), google_exceptions.ResourceExhausted("quota")]})
+    caller = _caller()
+
+    result, model = await caller.call(["a", "b"], upstream)
+
+    assert (result, model) == ("reply from a", "a")
+    assert upstream.calls == ["a", "a", "a"]
+    assert caller.retried == 2
+    assert caller.breaker("a").state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_non_retryable_error_is_raised_at_once():
+    upstream = FakeUpstream(errors={"a": [google_exceptions.InvalidArgument("bad prompt")]})
+    caller = _caller()
+
+    with pytest.raises(google_exceptions.InvalidArgument):
+        await caller.call(["a", "b"], upstream)
+    assert upstream.calls == ["a"]
+
+
+@pytest.mark.asyncio
+async def test_falls_back_and_breaker_skips_the_failing_model():
+    down = [google_exceptions.ServiceUnavailable("down")] * 10
+    upstream = FakeUpstream(errors={"a": down})
+    caller = _caller(retries=1, breaker_failures=3)
+
+    # Two attempts on a, then b
+    assert await caller.call(["a", "b"], upstream) == ("reply from b", "b")
+    assert upstream.calls == ["a", "a", "b"]
+
+    # Third failure opens a's circuit; after that a isn't tried at all
+    assert await caller.call(["a", "b"], upstream) == ("reply from b", "b")
+    assert caller.breaker("a").state == "open"
+    upstream.calls.clear()
+    assert await caller.call(["a", "b"], upstream) == ("reply from b", "b")
+    assert upstream.calls == ["b"]
+    assert caller.fallbacks == 3
+
+    with pytest.raises(UpstreamUnavailable):
+        await caller.call(["a"], upstream)
+
+
+@pytest.mark.asyncio
+async def test_half_open_probe_closes_the_circuit():
+    upstream = FakeUpstream(errors={"a": [google_exceptions.ServiceUnavailable("down")] * 2})
+    caller = _caller(retries=0, breaker_failures=2, breaker_cooldown=0.05)
+
+    for _ in range(2):
+        assert (await caller.call(["a", "b"], upstream))[1] == "b"
+    assert caller.breaker("a").state == "open"
+
+    await asyncio.sleep(0.06)
+    assert caller.breaker("a").state == "half_open"
+    assert await caller.call(["a", "b"], upstream) == ("reply from a", "a")
+    assert caller.breaker("a").state == "closed"
+
+
+@pytest.mark.asyncio
+async def test_hedge_fires_after_p95_and_first_reply_wins():
+    caller = _caller(hedge=True, hedge_min_delay=0.01, hedge_min_samples=5)
+    # Warm the latency window at ~10ms
+    warm = FakeUpstream(latency={"a": 0.01})
+    for _ in range(5):
+        await caller.call(["a"], warm)
+    assert caller.hedges == 0
+
+    # First attempt stalls, the hedge answers quickly
+    upstream = FakeUpstream(latency={"a": [1.0, 0.01]})
+    discarded = []
+
+    async def discard(result):
+        discarded.append(result)
+
+    started = asyncio.get_running_loop().time()
+    result, model = await caller.call(["a"], upstream, discard=discard)
+    elapsed = asyncio.get_running_loop().time() - started
+
+    assert result == "reply from a"
+    assert upstream.calls == ["a", "a"]
+    assert caller.hedges == 1 and caller.hedge_wins == 1
+    assert elapsed < 0.5
+    await asyncio.sleep(0)
+    assert upstream.finished == ["a"]  # the stalled attempt was cancelled
+    assert discarded == []
+
+
+class _Chunk:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _FlakyModel:
+    """Blocking-SDK model that fails its first `failures` calls"""
+
+    def __init__(self, name, failures):
+        self.name = name
+        self.failures = failures
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        if self.failures:
+            self.failures -= 1
+            raise google_exceptions.ServiceUnavailable(f"{self.name} unavailable")
+        if stream:
+            return iter([_Chunk(f"{self.name} "), _Chunk("streamed")])
+        return _Chunk(f"{self.name} reply")
+
+
+@pytest.mark.asyncio
+async def test_generation_degrades_to_the_fallback_model(monkeypatch):
+    models = {"gemini-2.5-flash": _FlakyModel("primary", failures=100), "gemini-2.0-flash": _FlakyModel("fallback", failures=1)}
+    monkeypatch.setattr(gemini_service, "_get_model", lambda name, *a, **k: models[name])
+    monkeypatch.setattr(gemini_service, "gemini_resilience", _caller(retries=1))
+
+    result = await gemini_service.generate_ai_response("hi", model_name="gemini-2.5-flash", tier="free")
+    assert result["text"] == "fallback reply"
+    assert result["model"] == "gemini-2.0-flash"
+
+    chunks = [c async for c in gemini_service.generate_ai_response_stream("hi", model_name="gemini-2.5-flash", tier="free")]
+    assert "".join(chunks) == "fallback streamed"
+
+
+@pytest.mark.asyncio
+async def test_cancelled_probe_frees_the_half_open_circuit():
+    upstream = FakeUpstream(errors={"a": [google_exceptions.ServiceUnavailable("down")] * 2}, latency={"a": [10.0, 0]})
+    caller = _caller(retries=0, breaker_failures=2, breaker_cooldown=0.05)
+    for _ in range(2):
+        with pytest.raises(google_exceptions.ServiceUnavailable):
+            await caller.call(["a"], upstream)
+    await asyncio.sleep(0.06)
+
+    # The probe's client goes away mid-call
+    probe = asyncio.create_task(caller.call(["a"], upstream))
+    await asyncio.sleep(0.01)
+    assert caller.breaker("a").probing
+    probe.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await probe
+
+    # Not counted either way: the next call probes again
+    assert caller.breaker("a").state == "half_open" and not caller.breaker("a").probing
+    assert await caller.call(["a"], upstream) == ("reply from a", "a")
+    assert caller.breaker("a").state == "closed"
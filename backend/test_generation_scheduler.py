@@ -0,0 +1,98 @@
+# backend/test_generation_scheduler.py
+
+import asyncio
+
+import pytest
+
+from routes import chat
+from services.generation_scheduler import GenerationScheduler, SchedulerRejected
+
+TIERS = {
+    "free": {"tier_name": "free", "generation_weight": 1},
+    "pro": {"tier_name": "pro", "generation_weight": 3},
+    "elite": {"tier_name": "elite", "generation_weight": 6},
+}
+
+
+def _scheduler(max_concurrent=1, max_queue=100, queue_timeout=5.0):
+    return GenerationScheduler(TIERS, max_concurrent=max_concurrent, max_queue=max_queue, queue_timeout=queue_timeout)
+
+
+@pytest.mark.asyncio
+async def test_freed_slots_go_to_tiers_by_weight():
+    scheduler = _scheduler()
+    holder = await scheduler.acquire("holder", "free")
+    order = []
+
+    async def run(user_id, tier):
+        admission = await scheduler.acquire(user_id, tier)
+        order.append(tier)
+        await asyncio.sleep(0)
+        admission.release()
+
+    tasks = [asyncio.create_task(run(f"{tier}{i}", tier)) for i in range(10) for tier in ("free", "pro", "elite")]
+    await asyncio.sleep(0)
+    assert scheduler.stats()["queued"] == 30
+
+    holder.release()
+    await asyncio.gather(*tasks)
+
+    # The first ten slots handed out split 6:3:1
+    first = order[:10]
+    assert (first.count("elite"), first.count("pro"), first.count("free")) == (6, 3, 1)
+    assert scheduler.active == 0 and scheduler.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_release_is_idempotent():
+    scheduler = _scheduler(max_concurrent=2)
+    held = [await scheduler.acquire("u1", "free") for _ in range(2)]
+    held[0].release()
+    held[0].release()
+    assert scheduler.active == 1
+    held[1].release()
+    assert scheduler.active == 0
+
+
+@pytest.mark.asyncio
+async def test_full_queue_and_timeout_are_rejected():
+    scheduler = _scheduler(max_queue=1, queue_timeout=0.05)
+    holder = await scheduler.acquire("holder", "elite")
+    waiting = asyncio.create_task(scheduler.acquire("u1", "free"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(SchedulerRejected) as exc:
+        await scheduler.acquire("u2", "elite")
+    assert (exc.value.reason, exc.value.tier) == ("queue_full", "elite")
+
+    with pytest.raises(SchedulerRejected) as exc:
+        await waiting
+    assert exc.value.reason == "timeout"
+    assert scheduler.stats()["rejected"] == {"queue_full": 1, "timeout": 1}
+
+    # The timed-out waiter left the queue; the slot still frees normally
+    holder.release()
+    (await scheduler.acquire("u1", "free")).release()
+    assert scheduler.active == 0 and scheduler.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_leaves_the_queue():
+    scheduler = _scheduler()
+    holder = await scheduler.acquire("holder", "pro")
+    waiting = asyncio.create_task(scheduler.acquire("u1", "pro"))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiting
+
+    assert scheduler.queued == 0
+    holder.release()
+    assert scheduler.active == 0
+
+
+def test_rejection_is_a_503_with_retry_after():
+    error = chat._busy_error(SchedulerRejected("queue_full", "pro", retry_after=10))
+    assert error.status_code == 503
+    assert error.headers == {"Retry-After": "10"}
+    assert error.detail["tier"] == "pro"
@@ -0,0 +1,40 @@
+# backend/test_model_registry.py
+
+from services.model_registry import ModelRegistry
+
+
+def _registry(max_entries):
+    built = []
+
+    def _factory(name, generation_config, system_instruction, key_index):
+        built.append((name, system_instruction))
+        return object()
+
+    return ModelRegistry(_factory, max_entries=max_entries), built
+
+
+def test_same_settings_share_one_model():
+    registry, built = _registry(max_entries=4)
+    first = registry.get("gemini-2.0-flash", {"temperature": 0.7}, "prompt")
+    assert registry.get("gemini-2.0-flash", {"temperature": 0.7}, "prompt") is first
+    assert len(built) == 1
+    assert registry.stats()["hits"] == 1
+
+
+def test_least_recently_used_model_is_dropped_past_the_cap():
+    registry, built = _registry(max_entries=2)
+    a = registry.get("m", system_instruction="prompt v1")
+    registry.get("m", system_instruction="prompt v2")
+    registry.get("m", system_instruction="prompt v1")  # v2 is now the oldest
+    registry.get("m", system_instruction="prompt v3")
+
+    assert registry.stats()["entries"] == 2 and registry.stats()["evictions"] == 1
+    assert registry.get("m", system_instruction="prompt v1") is a
+    registry.get("m", system_instruction="prompt v2")
+    assert built.count(("m", "prompt v2")) == 2
+
+
+def test_warm_up_respects_the_cap():
+    registry, _ = _registry(max_entries=2)
+    registry.warm_up(["a", "b", "c"])
+    assert [e["model"] for e in registry.entries()] == ["b", "c"]
@@ -0,0 +1,85 @@
+# backend/test_rate_limit_backend.py
+
+import asyncio
+
+import pytest
+
+from services.rate_limit_backend import InMemoryRateLimitBackend, RateLimitBackend, RedisRateLimitBackend
+
+
+def _memory_backend():
+    return InMemoryRateLimitBackend()
+
+
+def _redis_backend():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")  # fakeredis needs it for EVALSHA
+    return RedisRateLimitBackend(client=fakeredis.FakeAsyncRedis())
+
+
+def test_backend_must_implement_every_primitive():
+    class TokensOnly(RateLimitBackend):
+        async def take_token(self, key, capacity, refill_per_second, cost=1):
+            return True, 0.0
+
+    with pytest.raises(TypeError):
+        TokensOnly()
+
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request):
+    return _memory_backend() if request.param == "memory" else _redis_backend()
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_allows_burst_then_throttles(backend):
+    results = [await backend.take_token("u1", capacity=3, refill_per_second=0.5) for _ in range(4)]
+
+    assert [allowed for allowed, _ in results] == [True, True, True, False]
+    assert 0 < results[-1][1] <= 2.0  # one token at 0.5/s
+    # Buckets are per key
+    assert (await backend.take_token("u2", capacity=3, refill_per_second=0.5))[0]
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_refills(backend):
+    for _ in range(2):
+        assert (await backend.take_token("u1", capacity=2, refill_per_second=20))[0]
+    assert not (await backend.take_token("u1", capacity=2, refill_per_second=20))[0]
+
+    await asyncio.sleep(0.1)  # ~2 tokens back
+    assert (await backend.take_token("u1", capacity=2, refill_per_second=20))[0]
+
+
+@pytest.mark.asyncio
+async def test_slots_limit_concurrency_and_release(backend):
+    assert await backend.acquire_slot("u1", 2, "a", lease_seconds=60)
+    assert await backend.acquire_slot("u1", 2, "b", lease_seconds=60)
+    assert not await backend.acquire_slot("u1", 2, "c", lease_seconds=60)
+
+    await backend.release_slot("u1", "a")
+    assert await backend.acquire_slot("u1", 2, "c", lease_seconds=60)
+
+
+@pytest.mark.asyncio
+async def test_unreleased_slots_expire(backend):
+    assert await backend.acquire_slot("u1", 1, "a", lease_seconds=0.05)
+    assert not await backend.acquire_slot("u1", 1, "b", lease_seconds=0.05)
+
+    await asyncio.sleep(0.1)
+    assert await backend.acquire_slot("u1", 1, "b", lease_seconds=0.05)
+
+
+@pytest.mark.asyncio
+async def test_redis_backend_shares_state_between_workers():
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    worker_a = RedisRateLimitBackend(client=fakeredis.FakeAsyncRedis(server=server))
+    worker_b = RedisRateLimitBackend(client=fakeredis.FakeAsyncRedis(server=server))
+
+    assert (await worker_a.take_token("u1", capacity=1, refill_per_second=0.01))[0]
+    assert not (await worker_b.take_token("u1", capacity=1, refill_per_second=0.01))[0]
+
+    assert await worker_a.acquire_slot("u1", 1, "a", lease_seconds=60)
+    assert not await worker_b.acquire_slot("u1", 1, "b", lease_seconds=60)
@@ -0,0 +1,88 @@
+# backend/test_response_cache.py
+
+import pytest
+
+from services import gemini_service
+from services.response_cache import ResponseCache
+
+SYSTEM = {"role": "system", "content": "You are helpful.", "tokens": 4}
+
+
+def _cache(**overrides):
+    options = dict(enabled=True, maxsize=100, ttl=60, max_context_tokens=50, max_reply_chars=1000)
+    options.update(overrides)
+    return ResponseCache(**options)
+
+
+def test_key_ignores_whitespace_but_not_history():
+    cache = _cache()
+    first = [SYSTEM, {"role": "user", "content": "hi"}]
+    assert cache.key("m", "hi", first) == cache.key("m", "  hi\n", [SYSTEM, {"role": "user", "content": "hi "}])
+    assert cache.key("m", "hi", first) != cache.key("other", "hi", first)
+    assert cache.key("m", "hi", first) != cache.key("m", "hi", first, {"temperature": 0})
+
+    followup = [SYSTEM, {"role": "user", "content": "hi"}, {"role": "assistant", "content": "Hello!"}, {"role": "user", "content": "hi"}]
+    assert cache.key("m", "hi", followup) not in (None, cache.key("m", "hi", first))
+
+    # Too much history (or the cache switched off) isn't cacheable
+    long = [SYSTEM, {"role": "user", "content": "x", "tokens": 60}, {"role": "user", "content": "hi"}]
+    assert cache.key("m", "hi", long) is None
+    assert _cache(enabled=False).key("m", "hi", first) is None
+
+
+def test_hits_report_saved_tokens_per_tier():
+    cache = _cache()
+    key = cache.key("m", "hi")
+    assert cache.get(key, "free") is None
+    cache.put(key, "Hello!", 10, 5, 0.002, "m")
+    cache.put(cache.key("m", "long"), "x" * 2000, 10, 500, 0.2, "m")
+
+    assert cache.get(key, "pro").text == "Hello!"
+    stats = cache.stats()
+    assert stats["size"] == 1
+    assert stats["tiers"]["free"] == {"hits": 0, "misses": 1, "hit_rate": 0.0, "saved_tokens": 0, "saved_cost": 0.0}
+    assert stats["tiers"]["pro"]["saved_tokens"] == 15
+    assert stats["tiers"]["pro"]["saved_cost"] == 0.002
+
+
+class _Reply:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class _CountingModel:
+    def __init__(self):
+        self.calls = 0
+
+    def start_chat(self, history=None):
+        return self
+
+    def send_message(self, prompt, generation_config=None, stream=False):
+        return self.generate_content(prompt, generation_config, stream)
+
+    def generate_content(self, prompt, generation_config=None, stream=False):
+        self.calls += 1
+        if stream:
+            return iter([_Reply("Hello"), _Reply(" there!")])
+        return _Reply("Hello there!")
+
+
+@pytest.mark.asyncio
+async def test_repeated_first_message_is_served_from_cache(monkeypatch):
+    model = _CountingModel()
+    monkeypatch.setattr(gemini_service, "_get_model", lambda *a, **k: model)
+    monkeypatch.setattr(gemini_service, "response_cache", _cache())
+    context = [SYSTEM, {"role": "user", "content": "hi"}]
+
+    first = await gemini_service.generate_ai_response("hi", context, model_name="gemini-2.0-flash", tier="free")
+    again = await gemini_service.generate_ai_response("hi", context, model_name="gemini-2.0-flash", tier="free")
+    assert first["text"] == again["text"] == "Hello there!"
+    assert again["cost"] == 0.0
+    assert model.calls == 1
+
+    # A completed stream is cached too, and replayed as a stream
+    for _ in range(2):
+        chunks = [c async for c in gemini_service.generate_ai_response_stream("what can you do?", model_name="gemini-2.0-flash", tier="pro")]
+        assert "".join(chunks) == "Hello there!"
+    assert model.calls == 2
+    assert gemini_service.response_cache.stats()["tiers"]["pro"]["hits"] == 1
@@ -0,0 +1,123 @@
+# backend/test_rolling_summary.py
+
+import pytest
+
+from core.config import settings
+from services import memory_service
+from test_conversation_cache import _rows
+
+
+class FakeStore:
+    """One conversation's messages and rolling summary, queried like db.queries"""
+
+    def __init__(self, message_count, tokens=10):
+        self.messages = [(i, "user" if i % 2 else "assistant", f"message {i}", tokens)
+                         for i in range(1, message_count + 1)]
+        self.summary = None  # (text, tokens)
+        self.summarized_through_id = 0
+        self.summarized = []  # the turns each summarisation call was given
+
+    def _pending(self):
+        return [m for m in self.messages if m[0] > self.summarized_through_id]
+
+    async def get_unsummarized_messages(self, conversation_id, keep_recent):
+        pending = self._pending()
+        pending = pending[:max(len(pending) - keep_recent, 0)]
+        return {
+            "user_id": "u1",
+            "summary": self.summary[0] if self.summary else None,
+            "summarized_through_id": self.summarized_through_id,
+            "messages": [{"id": i, "role": r, "message_text": t, "token_count": n} for i, r, t, n in pending],
+        }
+
+    async def upsert_conversation_summary(self, conversation_id, summary, token_count, summarized_through_id):
+        if summarized_through_id > self.summarized_through_id:
+            self.summary = (summary, token_count)
+            self.summarized_through_id = summarized_through_id
+
+    async def fetch_context_rows(self, conversation_id, token_budget, max_messages, include_summary):
+        return _rows(self.summary if include_summary else None, self._pending())
+
+
+@pytest.fixture
+def store(monkeypatch):
+    fake = FakeStore(message_count=8)
+    published = []
+
+    async def _summarize(previous, turns, user_id, conversation_id):
+        fake.summarized.append([t["content"] for t in turns])
+        return f"summary of {len(turns)} turns"
+
+    async def _publish(entity, key, local=True):
+        published.append((entity, key))
+
+    monkeypatch.setattr(settings, "SUMMARY_TRIGGER_TOKENS", 40)
+    monkeypatch.setattr(settings, "SUMMARY_KEEP_RECENT_MESSAGES", 2)
+    monkeypatch.setattr(settings, "CONVERSATION_CACHE_ENABLED", False)
+    monkeypatch.setattr(memory_service, "get_unsummarized_messages", fake.get_unsummarized_messages)
+    monkeypatch.setattr(memory_service, "upsert_conversation_summary", fake.upsert_conversation_summary)
+    monkeypatch.setattr(memory_service, "_fetch_context_rows", fake.fetch_context_rows)
+    monkeypatch.setattr(memory_service, "generate_conversation_summary", _summarize)
+    monkeypatch.setattr(memory_service, "publish_invalidation", _publish)
+    fake.published = published
+    return fake
+
+
+async def _context(conversation_id=1):
+    context = await memory_service.get_conversation_context(conversation_id, token_budget=1000)
+    return [e["content"] for e in context]
+
+
+@pytest.mark.asyncio
+async def test_short_backlog_is_not_folded(store):
+    store.messages = store.messages[:5]  # 3 foldable turns, 30 tokens < 40
+    assert not await memory_service.update_conversation_summary(1)
+    assert store.summarized == [] and store.summary is None
+    assert await _context() == [f"message {i}" for i in range(1, 6)]
+
+
+@pytest.mark.asyncio
+async def test_older_turns_fold_into_the_summary(store):
+    assert await memory_service.update_conversation_summary(1)
+
+    # Everything but the newest two went to the model, oldest first
+    assert store.summarized == [[f"message {i}" for i in range(1, 7)]]
+    assert store.summarized_through_id == 6
+    assert store.published == [("conversation", 1)]
+
+    # The summary takes the folded turns' place; the recent ones stay verbatim
+    assert await _context() == [
+        "Summary of the earlier conversation:\nsummary of 6 turns",
+        "message 7",
+        "message 8",
+    ]
+
+
+@pytest.mark.asyncio
+async def test_packed_tail_uses_the_summary_too(store):
+    await memory_service.update_conversation_summary(1)
+    rows = await store.fetch_context_rows(1, 1000, 200, True)
+    tail = memory_service._tail_from_rows(1, rows, max_messages=200)
+    context = tail.pack(token_budget=1000, max_messages=200)
+    assert [e["content"] for e in context] == await _context()
+
+
+@pytest.mark.asyncio
+async def test_failed_summarisation_leaves_the_context_alone(store, monkeypatch):
+    before = await _context()
+
+    async def _fails(*args):
+        raise RuntimeError("upstream down")
+
+    monkeypatch.setattr(memory_service, "generate_conversation_summary", _fails)
+    await memory_service._run_summary_update(1)  # logged, not raised
+    assert store.summary is None and store.published == []
+    assert await _context() == before
+
+    # An empty answer is a failure too
+    async def _empty(*args):
+        return ""
+
+    monkeypatch.setattr(memory_service, "generate_conversation_summary", _empty)
+    assert not await memory_service.update_conversation_summary(1)
+    assert await _context() == before == [f"message {i}" for i in range(1, 9)]
@@ -0,0 +1,73 @@
+# backend/test_sse.py
+
+import asyncio
+
+import pytest
+
+from utils.sse import StreamWriter, sse_event
+
+
+async def _upstream(chunks, closed=None, then_wait=False):
+    try:
+        for chunk in chunks:
+            yield chunk
+            await asyncio.sleep(0)
+        if then_wait:
+            await asyncio.sleep(10)
+    finally:
+        if closed is not None:
+            closed.set()
+
+
+def test_sse_event_frames():
+    assert sse_event({"chunk": "hi"}) == b'data: {"chunk":"hi"}\n\n'
+    assert sse_event({"done": True}, "5:1:2") == b'id: 5:1:2\ndata: {"done":true}\n\n'
+
+
+@pytest.mark.asyncio
+async def test_frames_keep_chunk_order_and_the_rest_is_flushed_at_the_end():
+    writer = StreamWriter(flush_bytes=1024, flush_seconds=10)
+    chunks = [f"{i} " for i in range(20)]
+
+    frames = [f async for f in writer.coalesce(_upstream(chunks))]
+
+    # The first chunk goes out at once; the others are held until the stream ends
+    assert frames == ["0 ", "".join(chunks[1:])]
+    assert writer.text() == "".join(chunks) and writer.frames == 2
+
+
+@pytest.mark.asyncio
+async def test_quiet_upstream_flushes_after_the_interval():
+    writer = StreamWriter(flush_bytes=1024, flush_seconds=0.02)
+    frames = writer.coalesce(_upstream(["a", "b", "c"], then_wait=True))
+
+    assert await frames.__anext__() == "a"
+    assert await asyncio.wait_for(frames.__anext__(), 1) == "bc"
+    await frames.aclose()
+
+
+@pytest.mark.asyncio
+async def test_closing_waits_for_the_upstream_to_close():
+    closed = asyncio.Event()
+    writer = StreamWriter(flush_bytes=1024, flush_seconds=10)
+    frames = writer.coalesce(_upstream(["a"], closed, then_wait=True))
+
+    assert await frames.__anext__() == "a"
+    await frames.aclose()  # the client went away
+    assert closed.is_set()
+
+
+@pytest.mark.asyncio
+async def test_upstream_error_is_raised_after_the_text_before_it():
+    async def failing():
+        yield "partial"
+        await asyncio.sleep(0)
+        yield " more"
+        raise RuntimeError("upstream broke")
+
+    writer = StreamWriter(flush_bytes=1024, flush_seconds=10)
+    frames = []
+    with pytest.raises(RuntimeError):
+        async for frame in writer.coalesce(failing()):
+            frames.append(frame)
+    assert frames == ["partial", " more"]
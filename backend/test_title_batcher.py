@@ -0,0 +1,78 @@
+# backend/test_title_batcher.py
+
+import asyncio
+
+import pytest
+
+from services import title_batcher as title_batcher_module
+from services.title_batcher import TitleBatcher
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Records the title calls; batched calls fail while `fail` is set"""
+    calls = {"batched": [], "single": [], "fail": False}
+
+    async def _titles(messages):
+        calls["batched"].append(list(messages))
+        if calls["fail"]:
+            raise ValueError("malformed JSON")
+        return [f"Title: {m}" for m in messages]
+
+    async def _title(message):
+        calls["single"].append(message)
+        return f"Single: {message}"
+
+    monkeypatch.setattr(title_batcher_module, "cached_title", lambda message: None)
+    monkeypatch.setattr(title_batcher_module, "generate_conversation_titles", _titles)
+    monkeypatch.setattr(title_batcher_module, "generate_conversation_title", _title)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_full_batch_is_sent_without_waiting(upstream):
+    batcher = TitleBatcher(max_batch_size=3, window_seconds=10.0)
+    titles = await asyncio.wait_for(
+        asyncio.gather(*(batcher.generate(f"m{i}") for i in range(3))), timeout=1.0
+    )
+
+    # One upstream call, each caller gets the title for its own message
+    assert upstream["batched"] == [["m0", "m1", "m2"]]
+    assert titles == ["Title: m0", "Title: m1", "Title: m2"]
+    assert batcher.stats() == {"pending": 0, "batches": 1, "titles": 3, "fallbacks": 0}
+
+
+@pytest.mark.asyncio
+async def test_partial_batch_is_sent_when_the_window_closes(upstream):
+    batcher = TitleBatcher(max_batch_size=10, window_seconds=0.02)
+    first = asyncio.create_task(batcher.generate("a"))
+    second = asyncio.create_task(batcher.generate("b"))
+    await asyncio.sleep(0)
+    assert batcher.stats()["pending"] == 2
+    assert upstream["batched"] == []
+
+    assert await asyncio.gather(first, second) == ["Title: a", "Title: b"]
+    assert upstream["batched"] == [["a", "b"]]
+
+    # A lone message in its window goes out as a plain single-title request
+    assert await batcher.generate("c") == "Single: c"
+    assert upstream["single"] == ["c"]
+
+
+@pytest.mark.asyncio
+async def test_failed_batch_falls_back_to_one_request_each(upstream):
+    upstream["fail"] = True
+    batcher = TitleBatcher(max_batch_size=2, window_seconds=10.0)
+    titles = await asyncio.gather(batcher.generate("x"), batcher.generate("y"))
+
+    assert titles == ["Single: x", "Single: y"]
+    assert sorted(upstream["single"]) == ["x", "y"]
+    assert batcher.stats()["fallbacks"] == 1
+
+
+@pytest.mark.asyncio
+async def test_cached_title_skips_the_batch(upstream, monkeypatch):
+    monkeypatch.setattr(title_batcher_module, "cached_title", lambda message: "Cached")
+    batcher = TitleBatcher(max_batch_size=2, window_seconds=10.0)
+    assert await batcher.generate("x") == "Cached"
+    assert upstream["batched"] == [] and batcher.stats()["pending"] == 0
@@ -0,0 +1,145 @@
+# backend/test_turn_streams.py
+
+import asyncio
+import json
+
+import pytest
+
+from middleware.rate_limit import rate_limiter
+from routes import chat
+from services.turn_streams import TurnStreamRegistry, parse_event_id
+from services.user_context_service import UserContext
+
+
+def _frames(raw):
+    """(event id, data) of SSE frames"""
+    out = []
+    for frame in raw:
+        text = frame.decode() if isinstance(frame, bytes) else frame
+        event_id = data = None
+        for line in text.strip().split("\n"):
+            if line.startswith("id: "):
+                event_id = line[4:]
+            elif line.startswith("data: "):
+                data = json.loads(line[6:])
+        out.append((event_id, data))
+    return out
+
+
+def _registry(grace=5.0, ttl=60.0, max_frames=100):
+    return TurnStreamRegistry(grace_seconds=grace, ttl_seconds=ttl, max_frames=max_frames)
+
+
+async def _collect(turn, after_seq=0, limit=None):
+    frames = []
+    async for frame in turn.subscribe(after_seq):
+        frames.append(frame)
+        if limit and len(frames) == limit:
+            break
+    return _frames(frames)
+
+
+def test_parse_event_id():
+    assert parse_event_id("5:101:7") == (5, 101, 7)
+    assert parse_event_id("5:101") is None
+    assert parse_event_id("a:b:c") is None
+    assert parse_event_id(None) is None
+
+
+@pytest.mark.asyncio
+async def test_reconnect_replays_after_the_event_id_then_follows_live():
+    registry = _registry()
+    release = asyncio.Event()
+
+    async def produce(turn):
+        turn.bind(5, 101)
+        for i in range(3):
+            turn.publish({"chunk": f"c{i}", "done": False})
+        await release.wait()
+        turn.publish({"done": True})
+
+    turn = registry.start("u1", produce)
+    await asyncio.sleep(0)
+
+    # First client reads two frames and drops
+    first = await _collect(turn, limit=2)
+    assert [eid for eid, _ in first] == ["5:101:1", "5:101:2"]
+
+    # The reconnect gets what it missed, then the live end of the turn
+    resumed = asyncio.create_task(_collect(registry.get(5, 101), after_seq=2))
+    await asyncio.sleep(0)
+    release.set()
+    frames = await resumed
+    assert frames == [("5:101:3", {"chunk": "c2", "done": False}), ("5:101:4", {"done": True})]
+    assert registry.abandoned == 0
+
+
+@pytest.mark.asyncio
+async def test_turn_is_cancelled_when_nobody_returns_within_the_grace_period():
+    registry = _registry(grace=0.05)
+    cancelled = asyncio.Event()
+
+    async def produce(turn):
+        turn.bind(5, 102)
+        turn.publish({"chunk": "partial", "done": False})
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    turn = registry.start("u1", produce)
+    await _collect(turn, limit=1)  # the only client leaves
+
+    await asyncio.wait_for(cancelled.wait(), 1)
+    await asyncio.sleep(0)
+    assert turn.done and registry.abandoned == 1
+
+
+@pytest.mark.asyncio
+async def test_finished_turn_is_replayed_until_it_expires():
+    registry = _registry(ttl=0.05)
+
+    async def produce(turn):
+        turn.bind(5, 103)
+        turn.publish({"chunk": "all of it", "done": False})
+        turn.publish({"done": True})
+
+    turn = registry.start("u1", produce)
+    await turn.task
+
+    assert await _collect(registry.get(5, 103), after_seq=1) == [("5:103:2", {"done": True})]
+    assert len(await _collect(registry.get(5, 103))) == 2
+    await asyncio.sleep(0.06)
+    assert registry.get(5, 103) is None
+
+
+@pytest.mark.asyncio
+async def test_resume_spends_no_rate_limit(monkeypatch):
+    taken = []
+
+    async def take_token(*args):
+        taken.append(args)
+        return False, 30.0  # would be a 429
+
+    monkeypatch.setattr(rate_limiter.backend, "take_token", take_token)
+    monkeypatch.setattr(chat, "turn_streams", _registry())
+
+    async def produce(turn):
+        turn.bind(5, 104)
+        turn.publish({"done": True})
+
+    await chat.turn_streams.start("u1", produce).task
+    ctx = UserContext("u1", None, "free", "gemini-2.0-flash")
+
+    response = await chat.send_message_stream(None, user_id="u1", ctx=ctx, last_event_id="5:104:0")
+    frames = [f async for f in response.body_iterator]
+    assert _frames(frames) == [("5:104:1", {"done": True})]
+    assert taken == []
+
+    # Only a new turn is rate limited
+    with pytest.raises(chat.HTTPException) as exc:
+        await chat.send_message_stream(
+            chat.SendMessageRequest(conversation_id=5, message="hi"), user_id="u1", ctx=ctx, last_event_id=None
+        )
+    assert exc.value.status_code == 429 and len(taken) == 1
@@ -0,0 +1,187 @@
+# backend/test_usage_counters.py
+
+import asyncio
+import json
+
+import pytest
+
+from services import invalidation_service, usage_counters as uc, user_context_service
+from services.usage_counters import UsageCounters, quota_notice
+
+
+class FakeSnapshots:
+    """get_user_quota_snapshot stand-in that counts DB reads"""
+
+    def __init__(self, messages=0, cost=0.0):
+        self.messages = messages
+        self.cost = cost
+        self.plan = None
+        self.reads = 0
+        self.gate = None
+
+    async def read(self, user_id):
+        self.reads += 1
+        if self.gate is not None:
+            await self.gate.wait()
+        return {"messages_today": self.messages, "monthly_cost": self.cost, "plan": self.plan,
+                "status": "active" if self.plan else None, "expired_at": None, "is_premium": False}
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeSnapshots()
+    monkeypatch.setattr(uc, "get_user_quota_snapshot", fake.read)
+    return fake
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    counters = UsageCounters(max_users=100)
+    monkeypatch.setattr(invalidation_service, "_updaters", {"quota": [counters.apply_delta]})
+    monkeypatch.setattr(invalidation_service, "_handlers", {"quota": [counters.forget], "user": [counters.forget]})
+    monkeypatch.setattr(user_context_service, "usage_counters", counters)
+    return counters
+
+
+def _from_another_worker(channel_payload):
+    channel, payload = channel_payload
+    message = json.loads(payload)
+    message["o"] = "another-worker"
+    invalidation_service._on_notification(None, 0, channel, json.dumps(message))
+
+
+@pytest.mark.asyncio
+async def test_other_workers_usage_is_added_without_a_reseed(db, counters):
+    db.messages, db.cost = 2, 1.5
+    assert await counters.get("u1") == (2, 1.5)
+
+    _from_another_worker(quota_notice("u1", messages=1))
+    _from_another_worker(quota_notice("u1", cost=0.25))
+    assert await counters.get("u1") == (3, 1.75)
+    assert db.reads == 1 and counters.deltas == 2
+
+    # Our own notifications were applied when recorded
+    channel, payload = quota_notice("u1", messages=1)
+    invalidation_service._on_notification(None, 0, channel, payload)
+    assert await counters.get("u1") == (3, 1.75)
+
+
+@pytest.mark.asyncio
+async def test_plain_invalidation_reseeds(db, counters):
+    await counters.get("u1")
+    _from_another_worker(invalidation_service.invalidation_notice("quota", "u1"))
+    db.messages = 4
+    assert await counters.get("u1") == (4, 0.0)
+    assert db.reads == 2
+
+
+@pytest.mark.asyncio
+async def test_delta_during_a_seed_keeps_the_seed_from_being_cached(db, counters):
+    db.gate = asyncio.Event()
+    first = asyncio.create_task(counters.get("u1"))
+    await asyncio.sleep(0)
+
+    # The snapshot may have been read before or after this usage was stored
+    _from_another_worker(quota_notice("u1", messages=1))
+    db.messages = 1
+    db.gate.set()
+    await first
+
+    assert await counters.get("u1") == (1, 0.0)
+    assert db.reads == 2
+    assert await counters.get("u1") == (1, 0.0)
+    assert db.reads == 2
+
+
+@pytest.mark.asyncio
+async def test_user_context_reads_the_db_only_when_cold_or_invalidated(db, counters):
+    db.plan = "pro"
+    for _ in range(3):
+        ctx = await user_context_service.resolve_user_context("u1")
+        assert ctx.tier == "pro"
+    await counters.get("u1")
+    assert db.reads == 1
+
+    # Cancelled in another worker
+    db.plan = None
+    _from_another_worker(invalidation_service.invalidation_notice("user", "u1"))
+    assert (await user_context_service.resolve_user_context("u1")).tier == "free"
+    assert db.reads == 2
+
+
+@pytest.mark.asyncio
+async def test_reservation_is_refused_once_the_quota_is_exhausted(db, counters):
+    db.messages = 4
+    held, messages, _ = await counters.reserve("u1", message_limit=5, cost_limit=1.0, cost=0.1)
+    assert held is not None and messages == 4
+
+    # The held message counts even though it isn't stored yet
+    refused, messages, _ = await counters.reserve("u1", message_limit=5, cost_limit=1.0, cost=0.1)
+    assert refused is None and messages == 5
+
+    # So does the estimated cost
+    refused, _, cost = await counters.reserve("u2", message_limit=5, cost_limit=0.15, cost=0.2)
+    assert refused is None and cost == 0.0
+
+
+@pytest.mark.asyncio
+async def test_settle_charges_the_actual_cost_not_the_estimate(db, counters):
+    reservation, _, _ = await counters.reserve("u1", message_limit=5, cost_limit=1.0, cost=0.5)
+    reservation.commit_message()
+    assert reservation.held == (0, 0.5)
+
+    assert reservation.settle(0.02)
+    assert await counters.get("u1") == (1, 0.02)
+    assert counters._reserved == {}
+    # Settled once; a release in a finally changes nothing
+    reservation.release()
+    assert not reservation.settle(0.3)
+    assert await counters.get("u1") == (1, 0.02)
+
+
+@pytest.mark.asyncio
+async def test_release_on_error_refunds_the_hold(db, counters):
+    reservation, _, _ = await counters.reserve("u1", message_limit=1, cost_limit=1.0, cost=0.9)
+    assert (await counters.reserve("u1", message_limit=1, cost_limit=1.0, cost=0.1))[0] is None
+
+    reservation.release()  # Gemini failed before anything was stored
+    assert await counters.get("u1") == (0, 0.0)
+    assert (await counters.reserve("u1", message_limit=1, cost_limit=1.0, cost=0.9))[0] is not None
+
+
+@pytest.mark.asyncio
+async def test_concurrent_reservations_cannot_share_the_last_slot(db, counters):
+    db.messages = 4
+    db.gate = asyncio.Event()  # both requests wait on the same cold seed
+    racing = [asyncio.create_task(counters.reserve("u1", message_limit=5, cost_limit=1.0, cost=0.1))
+              for _ in range(2)]
+    await asyncio.sleep(0)
+    db.gate.set()
+    results = await asyncio.gather(*racing)
+
+    assert sorted(r is None for r, _, _ in results) == [False, True]
+    assert db.reads == 1
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_reserve_raises_429_when_over_the_tier_limit(db, counters, monkeypatch):
+    from fastapi import HTTPException
+
+    from middleware import rate_limit
+    from services.user_context_service import UserContext
+
+    monkeypatch.setattr(rate_limit, "usage_counters", counters)
+    monkeypatch.setitem(rate_limit.rate_limiter.tier_config, "free",
+                        {**rate_limit.rate_limiter.tier_config["free"],
+                         "daily_message_limit": 5, "monthly_cost_limit": 1.0})
+    ctx = UserContext("u1", None, "free", "gemini-2.5-flash")
+    db.messages = 4
+
+    reservation = await rate_limit.rate_limiter.reserve(ctx, estimated_cost=0.001)
+    with pytest.raises(HTTPException) as exc:
+        await rate_limit.rate_limiter.reserve(ctx, estimated_cost=0.001)
+    assert exc.value.status_code == 429
+    assert exc.value.detail["error"] == "Daily message limit reached"
+
+    reservation.release()
+    assert await rate_limit.rate_limiter.reserve(ctx, estimated_cost=0.001) is not None
@@ -0,0 +1,112 @@
+# backend/test_usage_log_writer.py
+
+import os
+
+import pytest
+
+from services import usage_log_writer as ulw
+from services.usage_log_writer import UsageLogWriter
+
+
+class FakeDB:
+    """write_api_usage_batch stand-in: fails while down or once its budget of batches is spent"""
+
+    def __init__(self):
+        self.down = False
+        self.batches_left = None
+        self.rows = []
+
+    async def write(self, records, notify=None):
+        if self.down or self.batches_left == 0:
+            raise ConnectionError("db down")
+        if self.batches_left is not None:
+            self.batches_left -= 1
+        self.rows.extend(records)
+        return len(records)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeDB()
+    monkeypatch.setattr(ulw, "write_api_usage_batch", fake.write)
+    return fake
+
+
+def _writer(tmp_path, batch_size=100):
+    return UsageLogWriter(batch_size=batch_size, flush_seconds=3600,
+                          spill_path=str(tmp_path / "spill.jsonl"), max_buffer=1000)
+
+
+def _record(writer, n, user="u1"):
+    for i in range(n):
+        writer._buffer.append((user, 1, i, i, 0.001, ulw.datetime.utcnow()))
+
+
+@pytest.mark.asyncio
+async def test_records_spill_while_the_db_is_down_and_replay_on_recovery(tmp_path, db):
+    writer = _writer(tmp_path)
+    db.down = True
+    _record(writer, 3)
+    await writer.flush()
+    _record(writer, 2)
+    await writer.flush()
+
+    assert db.rows == [] and writer._buffer == []
+    # The second flush claimed the first three for replay; the rest are spilled after them
+    on_disk = 0
+    for path in (writer.spill.claim_path, writer.spill.path):
+        with open(path) as f:
+            on_disk += len(f.readlines())
+    assert on_disk == 5
+
+    db.down = False
+    _record(writer, 1, user="u2")
+    await writer.flush()
+
+    assert [r[0] for r in db.rows] == ["u1"] * 5 + ["u2"]
+    assert writer.stats()["replayed"] == 5
+    assert not os.path.exists(writer.spill.path) and not os.path.exists(writer.spill.claim_path)
+
+
+@pytest.mark.asyncio
+async def test_failed_replay_loses_nothing(tmp_path, db):
+    writer = _writer(tmp_path, batch_size=2)
+    db.down = True
+    _record(writer, 5)
+    await writer.flush()
+
+    # The DB comes back for one batch, then fails again mid-replay
+    db.down, db.batches_left = False, 1
+    await writer.flush()
+    assert len(db.rows) == 2
+    assert os.path.exists(writer.spill.claim_path)
+
+    # A restarted worker picks up the claim where the last one stopped
+    writer.spill._replay_lock.close()  # the old worker died, its lock with it
+    restarted = _writer(tmp_path, batch_size=2)
+    db.batches_left = None
+    await restarted.flush()
+
+    assert sorted(r[2] for r in db.rows) == [0, 1, 2, 3, 4]
+    assert not os.path.exists(restarted.spill.claim_path)
+
+
+@pytest.mark.asyncio
+async def test_db_down_reads_the_claim_once(tmp_path, db, monkeypatch):
+    writer = _writer(tmp_path)
+    db.down = True
+    _record(writer, 3)
+    await writer.flush()
+    await writer.flush()  # first claim of the spill file
+
+    reads = []
+    claim = writer.spill.claim
+    monkeypatch.setattr(writer.spill, "claim", lambda: reads.append(1) or claim())
+    for _ in range(3):
+        _record(writer, 1)
+        await writer.flush()
+    assert reads == []  # kept in memory, not re-read or rewritten
+
+    db.down = False
+    await writer.flush()
+    assert len(db.rows) == 6
@@ -0,0 +1,40 @@
+# backend/test_vector_memory.py
+
+import pytest
+
+from services import vector_memory as vm
+from services.vector_memory import Embedder, HashingEmbedder, VectorMemory
+
+
+def test_embedder_must_implement_embed():
+    class Incomplete(Embedder):
+        dim = 8
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+@pytest.mark.asyncio
+async def test_indexes_are_evicted_by_total_bytes(monkeypatch):
+    async def messages(user_id, limit):
+        return [
+            {"id": i, "conversation_id": 1, "message_text": f"{user_id} message {i}"}
+            for i in range(300, 0, -1)
+        ]
+
+    monkeypatch.setattr(vm, "get_user_messages_for_index", messages)
+    embedder = HashingEmbedder(64)
+    per_index = 300 * (64 * 4 + 16)  # vectors + message/conversation ids
+    memory = VectorMemory(embedder, max_bytes=2 * per_index, max_users=100,
+                          max_messages_per_user=1000, refresh_seconds=3600)
+
+    for user in ("a", "b", "c"):
+        await memory._build(user)
+
+    stats = memory.stats()
+    assert stats["users"] == 2 and stats["evictions"] == 1
+    assert stats["bytes"] == sum(i.nbytes for i in memory._indexes.values()) <= 2 * per_index
+    assert "a" not in memory._indexes  # least recently used goes first
+
+    memory.forget("b")
+    assert memory.nbytes == memory._indexes["c"].nbytes
@@ -0,0 +1,37 @@
+# backend/utils/background.py
+
+import asyncio
+import logging
+from typing import Coroutine, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Strong references so fire-and-forget tasks aren't garbage collected mid-run
+_tasks: Set[asyncio.Task] = set()
+
+
+def spawn(coro: Coroutine, name: Optional[str] = None) -> asyncio.Task:
+    """
+    Run a coroutine in the background without awaiting it.
+    Exceptions are logged rather than lost.
+    """
+    task = asyncio.create_task(coro, name=name)
+    _tasks.add(task)
+    task.add_done_callback(_on_done)
+    return task
+
+
+def _on_done(task: asyncio.Task) -> None:
+    _tasks.discard(task)
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        logger.error(f"Background task {task.get_name()} failed: {exc}", exc_info=exc)
+
+
+async def drain(timeout: float = 10.0) -> None:
+    """Wait (bounded) for outstanding background tasks, e.g. at shutdown."""
+    pending = [t for t in _tasks if not t.done()]
+    if pending:
+        await asyncio.wait(pending, timeout=timeout)
@@ -0,0 +1,177 @@
+# backend/utils/sse.py
+
+"""
+Server-sent event encoding for the chat streams.
+
+SSEResponse is a text/event-stream StreamingResponse that closes its
+generator as soon as the response ends, including when the client
+disconnects, so the generator's cleanup runs right away instead of
+whenever it is garbage collected (for chat streams: the turn learns it has
+lost its subscriber, see services/turn_streams.py).
+
+sse_event encodes one frame as bytes, with orjson when it is installed
+(falls back to json), and an optional event ID. StreamWriter coalesces the model's text chunks into
+fewer, larger frames: pending text goes out once SSE_FLUSH_BYTES have
+piled up or SSE_FLUSH_INTERVAL_MS have passed since the last frame, and
+the first chunk goes out at once so time to first token is unchanged. It
+also keeps the full reply as a list of parts joined once at the end.
+"""
+
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, List, Optional
+
+from starlette.responses import StreamingResponse
+
+from core.config import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+if orjson is not None:
+    def _dumps(data: Any) -> bytes:
+        return orjson.dumps(data)
+else:
+    def _dumps(data: Any) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def sse_event(data: Any, event_id: Optional[str] = None) -> bytes:
+    """One `data:` frame, with an `id:` line when event_id is given"""
+    if event_id is None:
+        return b"data: " + _dumps(data) + b"\n\n"
+    return b"id: " + event_id.encode() + b"\ndata: " + _dumps(data) + b"\n\n"
+
+
+class StreamWriter:
+    """Coalesces text chunks; each flush is the text of one frame"""
+
+    __slots__ = ("flush_bytes", "flush_seconds", "parts", "frames", "_pending", "_pending_size", "_last_flush", "_clock")
+
+    def __init__(
+        self,
+        flush_bytes: Optional[int] = None,
+        flush_seconds: Optional[float] = None,
+        clock=time.monotonic
+    ):
+        self.flush_bytes = settings.SSE_FLUSH_BYTES if flush_bytes is None else flush_bytes
+        self.flush_seconds = settings.SSE_FLUSH_INTERVAL_MS / 1000 if flush_seconds is None else flush_seconds
+        self.parts: List[str] = []  # the whole reply so far
+        self.frames = 0
+        self._pending: List[str] = []
+        self._pending_size = 0
+        self._last_flush: Optional[float] = None
+        self._clock = clock
+
+    def _take(self, chunk: str) -> bool:
+        """Queue a chunk; True when a frame is due"""
+        self.parts.append(chunk)
+        self._pending.append(chunk)
+        self._pending_size += len(chunk)
+        return (
+            self._last_flush is None
+            or self._pending_size >= self.flush_bytes
+            or self._clock() - self._last_flush >= self.flush_seconds
+        )
+
+    def add(self, chunk: str) -> Optional[str]:
+        """Take a chunk; returns a frame's text when one is due"""
+        if chunk and self._take(chunk):
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        """Text for everything pending (None if nothing is)"""
+        self._last_flush = self._clock()
+        if not self._pending:
+            return None
+        text = self._pending[0] if len(self._pending) == 1 else "".join(self._pending)
+        self._pending = []
+        self._pending_size = 0
+        self.frames += 1
+        return text
+
+    async def coalesce(self, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+        """
+        The text of each frame for a chunk stream. The stream is read by a
+        helper task, so pending text also goes out when the upstream goes
+        quiet for the flush interval; the cost is one timer per frame rather
+        than per chunk.
+        Upstream errors are raised here after the text before them is sent.
+        """
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        timer: Optional[asyncio.TimerHandle] = None
+        finished = False
+
+        async def pump():
+            nonlocal timer, finished
+            try:
+                async for chunk in chunks:
+                    if not chunk:
+                        continue
+                    if self._take(chunk):
+                        ready.set()
+                    elif timer is None:
+                        timer = loop.call_later(
+                            max(0.0, self._last_flush + self.flush_seconds - self._clock()),
+                            ready.set
+                        )
+            finally:
+                finished = True
+                ready.set()
+
+        task = loop.create_task(pump())
+        try:
+            while True:
+                await ready.wait()
+                ready.clear()
+                if timer is not None:
+                    timer.cancel()
+                    timer = None
+                last = finished  # nothing can be added after this flush
+                text = self.flush()
+                if text:
+                    yield text
+                if last:
+                    break
+            await task
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if not task.done():
+                # Wait for the pump to close the upstream before returning;
+                # asyncio.wait doesn't raise the pump's CancelledError
+                task.cancel()
+                await asyncio.wait({task})
+            if not task.cancelled():
+                task.exception()  # retrieved: it was raised above or doesn't matter now
+
+    def text(self) -> str:
+        """The whole reply"""
+        if len(self.parts) > 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0] if self.parts else ""
+
+
+class SSEResponse(StreamingResponse):
+    def __init__(self, content, headers: Optional[dict] = None, **kwargs):
+        headers = {
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+            **(headers or {}),
+        }
+        super().__init__(content, media_type="text/event-stream", headers=headers, **kwargs)
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
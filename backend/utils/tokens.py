@@ -0,0 +1,21 @@
+# backend/utils/tokens.py
+
+import re
+
+# Words, single CJK characters, or single other non-space characters
+_PIECES = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]|[^\W_]+|\S", re.UNICODE)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Local approximation of Gemini's token count, no API call.
+    Words are one token plus one per further ~6 characters;
+    punctuation, symbols and CJK characters are about one token each.
+    Errs slightly high, which is the safe side for budgets.
+    """
+    if not text:
+        return 0
+    tokens = 0
+    for piece in _PIECES.findall(text):
+        tokens += 1 + (len(piece) - 1) // 6
+    return tokens